@@ -40,7 +40,7 @@ if 'user' in app_cfg:
         )
 
 if 'port' in app_cfg:
-    netloc += ':' + str(port)
+    netloc += ':' + str(app_cfg['port'])
 
 url = 'postgres://' + netloc + '/' + app_cfg.get('database', 'glotpod.ident')
 config.set_main_option("sqlalchemy.url", url)
@@ -0,0 +1,34 @@
+"""change log for the change feed
+
+Revision ID: 4957dce48f88
+Revises: 586d7f045d5b
+Create Date: 2026-10-19 15:41:08.207316
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4957dce48f88'
+down_revision = '586d7f045d5b'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table('changes',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('type', sa.Enum('new', 'patch', name='change_type'), nullable=False),
+    sa.Column('document', postgresql.JSON(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('changes')
+    sa.Enum(name='change_type').drop(op.get_bind(), checkfirst=False)
@@ -0,0 +1,31 @@
+"""trigram indexes for fuzzy search
+
+Revision ID: 586d7f045d5b
+Revises: 22670a333aab
+Create Date: 2026-10-19 10:12:40.418231
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '586d7f045d5b'
+down_revision = '22670a333aab'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index('users_name_trgm', 'users', ['name'],
+                    postgresql_using='gin',
+                    postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('users_email_address_trgm', 'users', ['email_address'],
+                    postgresql_using='gin',
+                    postgresql_ops={'email_address': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('users_email_address_trgm', 'users')
+    op.drop_index('users_name_trgm', 'users')
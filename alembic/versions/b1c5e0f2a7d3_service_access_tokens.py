@@ -0,0 +1,24 @@
+"""encrypted access tokens for services
+
+Revision ID: b1c5e0f2a7d3
+Revises: 4957dce48f88
+Create Date: 2026-10-19 18:02:37.514920
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b1c5e0f2a7d3'
+down_revision = '4957dce48f88'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('services', sa.Column('access_token', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('services', 'access_token')
@@ -0,0 +1,4 @@
+"""Benchmarks for the identity micro-service.
+
+See the modules in this package; each one is runnable with ``python -m``.
+"""
@@ -0,0 +1,49 @@
+"""Compare two sets of results saved by ``bench.load``.
+
+    $ python -m bench.compare results/before.json results/after.json
+"""
+import argparse
+import json
+
+
+def change(before, after):
+    if not before or after is None:
+        return '-'
+    return "{:+.1f}%".format((after - before) / before * 100)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.compare',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('before', type=argparse.FileType('r'))
+    parser.add_argument('after', type=argparse.FileType('r'))
+    args = parser.parse_args(argv)
+
+    before, after = json.load(args.before), json.load(args.after)
+
+    print("before: {}".format(before['meta'].get('commit')))
+    print("after:  {}".format(after['meta'].get('commit')))
+    print()
+    print("{:<24} {:>10} {:>10} {:>10} {:>10}".format(
+        "endpoint", "req/s", "p50", "p95", "p99"
+    ))
+
+    for name, a in after['endpoints'].items():
+        b = before['endpoints'].get(name)
+
+        if b is None:
+            continue
+
+        print("{:<24} {:>10} {:>10} {:>10} {:>10}".format(
+            name, change(b['throughput'], a['throughput']),
+            *(change(b['latency_ms'][k], a['latency_ms'][k])
+              for k in ('p50', 'p95', 'p99'))
+        ))
+
+    print("{:<24} {:>10}".format(
+        "total", change(before['throughput'], after['throughput'])
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Microbenchmarks of the request handlers on their own, over in-memory
+storage, so that only the Python side of each request is measured:
+validation, patching and serialisation.
+
+    $ python -m bench.handlers --users 10000 --number 2000
+
+The views are called directly with minimal stand-in requests; neither HTTP
+nor Postgres is involved.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from aiohttp.multidict import CIMultiDict
+
+from glotpod.ident import handlers, init_app, prefix, storage
+
+from bench.seed import synthetic_user
+
+
+class NullSender:
+    # Stands in for the notification sender
+
+    def notify(self, *args):
+        pass
+
+
+class FakeRequest(dict):
+    """Just enough of aiohttp's Request for the views in handlers."""
+
+    def __init__(self, app, method, *, match_info=None, query=None,
+                 headers=None, body=None):
+        super().__init__()
+        self.app = app
+        self.method = method
+        self.match_info = match_info or {}
+        self.query_string = urlencode(query or {})
+        self.headers = CIMultiDict(headers or {})
+        self.content_type = self.headers.get('Content-Type',
+                                             'application/octet-stream')
+        self._body = body
+
+    async def read(self):
+        return self._body.encode('utf-8')
+
+
+def make_app(users, loop):
+    app = init_app([], loop=loop)
+    app['subscribers'] = NullSender()
+    app['storage'] = store = storage.MemoryStorage(loop=loop)
+
+    async def seed():
+        async with store.session() as session:
+            for n in range(1, users + 1):
+                name, email = synthetic_user(n)
+                await session.create_user({
+                    'name': name, 'email': email,
+                    'services': {'github': {'id': str(n)}}
+                })
+
+    loop.run_until_complete(seed())
+
+    app['prefix_index'] = index = prefix.PrefixIndex(loop=loop)
+    loop.run_until_complete(index.load(store))
+    return app
+
+
+def cases(app, users):
+    # Each case builds a request for its n-th run
+    def request(*args, **kwargs):
+        req = FakeRequest(app, *args, **kwargs)
+        req['storage'] = app['storage']
+        return req
+
+    def user_get(n):
+        return handlers.User, request(
+            'GET', match_info={'id': str(n % users + 1)}
+        )
+
+    def user_list_search(n):
+        return handlers.AllUsers, request(
+            'GET', query={'name': synthetic_user(n % users + 1)[0]}
+        )
+
+    def prefix_search(n):
+        name = synthetic_user(n % users + 1)[0]
+        return prefix.PrefixSearch, request('GET', query={'q': name[:3]})
+
+    def user_list_ids(n):
+        return handlers.AllUsers, request('GET', headers={
+            'Accept': 'application/vnd.glotpod.resource-url+json'
+        })
+
+    def user_list_post(n):
+        return handlers.AllUsers, request('POST', body=json.dumps({
+            'name': "Bench Mark", 'email': "bench.{}@handlers".format(n),
+            'services': {'facebook': {'id': "bench.{}".format(n)}}
+        }))
+
+    def user_patch(n):
+        ops = [{'op': 'replace', 'path': '/name', 'value': "Patched"},
+               {'op': 'add', 'path': '/services/facebook',
+                'value': {'id': "patch.{}".format(n)}}]
+        return handlers.User, request(
+            'PATCH', match_info={'id': str(n % users + 1)},
+            headers={'Content-Type': 'application/json-patch+json'},
+            body=json.dumps(ops)
+        )
+
+    return OrderedDict([
+        ('user.get', user_get),
+        ('user-list.search-name', user_list_search),
+        ('user-list.ids', user_list_ids),
+        ('prefix-search', prefix_search),
+        ('user-list.post', user_list_post),
+        ('user.patch', user_patch),
+    ])
+
+
+def measure(loop, build, number):
+    async def run():
+        start = time.perf_counter()
+
+        for n in range(number):
+            view, request = build(n)
+            await view(request)
+
+        return time.perf_counter() - start
+
+    return loop.run_until_complete(run())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.handlers',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('-u', '--users', type=int, default=1000,
+                        help="number of users in storage (default: 1000)")
+    parser.add_argument('-n', '--number', type=int, default=1000,
+                        help="runs of each case (default: 1000)")
+    parser.add_argument('-o', '--output', help="file to save results to, "
+                                               "as JSON")
+    args = parser.parse_args(argv)
+
+    loop = asyncio.get_event_loop()
+    app = make_app(args.users, loop)
+    results = OrderedDict()
+
+    print("{:<24} {:>12} {:>12}".format("case", "ops/s", "us/op"))
+
+    for name, build in cases(app, args.users).items():
+        elapsed = measure(loop, build, args.number)
+        results[name] = {'ops': args.number / elapsed,
+                         'us_per_op': elapsed / args.number * 1e6}
+        print("{:<24} {:>12.0f} {:>12.1f}".format(
+            name, results[name]['ops'], results[name]['us_per_op']
+        ))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'users': args.users, 'number': args.number,
+                       'cases': results}, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
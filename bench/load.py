@@ -0,0 +1,284 @@
+"""Drive the identity service with a concurrent load, and report throughput
+and latency percentiles for each endpoint.
+
+    $ python -m bench.seed --users 1000000 --reset
+    $ python -m bench.load --users 1000000 --concurrency 64 --duration 30 \\
+          --output results/$(git rev-parse --short HEAD).json
+
+Unless ``--url`` points at a running instance, a server is started from
+``glotpod.ident:init_app`` for the duration of the run, with the settings
+in ``IDENT_SETTINGS``. The load assumes the database was seeded from empty
+by ``bench.seed``, so that users 1 to ``--users`` exist. Results saved with
+``--output`` can be compared with ``python -m bench.compare``.
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from collections import OrderedDict
+from itertools import accumulate, count
+from urllib.parse import urlencode
+
+import aiohttp
+
+from glotpod.ident.monitor import percentile
+
+from bench.seed import synthetic_user
+
+
+class Scenario:
+    """An endpoint under load, with its share of the requests."""
+
+    def __init__(self, name, weight, build):
+        self.name = name
+        self.weight = weight
+        self.build = build
+        self.latencies = []
+        self.errors = 0
+
+    def record(self, latency, status):
+        if status is None or status >= 500:
+            self.errors += 1
+        else:
+            self.latencies.append(latency)
+
+    def report(self, duration):
+        ms = [latency * 1000 for latency in self.latencies]
+        return OrderedDict([
+            ('requests', len(ms) + self.errors),
+            ('errors', self.errors),
+            ('throughput', len(ms) / duration),
+            ('latency_ms', OrderedDict(
+                (key, percentile(ms, q)) for key, q in
+                (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))
+            ))
+        ])
+
+
+def scenarios(users, weights):
+    # Each build function returns (method, path, body, headers)
+    serial = count()
+
+    def random_id(rng):
+        return rng.randint(1, users)
+
+    def get_user(rng):
+        return 'GET', '/{}'.format(random_id(rng)), None, {}
+
+    def search_name(rng):
+        name, _ = synthetic_user(random_id(rng))
+        return 'GET', '/?' + urlencode({'name': name}), None, {}
+
+    def search_email(rng):
+        _, email = synthetic_user(random_id(rng))
+        return 'GET', '/?' + urlencode({'email': email}), None, {}
+
+    def create_user(rng):
+        n = next(serial)
+        body = {'name': "Load Tester",
+                'email': "load.{}.{}@bench.glotpod".format(time.time(), n)}
+        return 'POST', '/', json.dumps(body), {
+            'Content-Type': 'application/json'
+        }
+
+    def patch_user(rng):
+        ops = [{'op': 'replace', 'path': '/name',
+                'value': synthetic_user(rng.randint(1, users))[0]}]
+        return 'PATCH', '/{}'.format(random_id(rng)), json.dumps(ops), {
+            'Content-Type': 'application/json-patch+json'
+        }
+
+    builders = OrderedDict([
+        ('user.get', get_user),
+        ('user-list.search-name', search_name),
+        ('user-list.search-email', search_email),
+        ('user-list.post', create_user),
+        ('user.patch', patch_user),
+    ])
+
+    return [Scenario(name, weights.get(name, 0), build)
+            for name, build in builders.items() if weights.get(name, 0) > 0]
+
+
+async def worker(session, base_url, chosen, deadline, interval, rng, loop):
+    # Sends requests until the deadline, at most one every `interval`
+    # seconds if that's given
+    next_send = loop.time()
+
+    while loop.time() < deadline:
+        scenario = chosen(rng)
+        method, path, body, headers = scenario.build(rng)
+        start = loop.time()
+
+        try:
+            resp = await session.request(method, base_url + path, data=body,
+                                         headers=headers)
+            await resp.read()
+            status = resp.status
+        except (aiohttp.ClientError, OSError):
+            status = None
+
+        scenario.record(loop.time() - start, status)
+
+        if interval:
+            next_send += interval
+            await asyncio.sleep(max(0, next_send - loop.time()), loop=loop)
+
+
+async def run_load(base_url, scenarios, *, concurrency, duration, rate,
+                   seed, loop):
+    cumulative = list(accumulate(s.weight for s in scenarios))
+
+    def chosen(rng):
+        index = bisect.bisect(cumulative, rng.random() * cumulative[-1])
+        return scenarios[min(index, len(scenarios) - 1)]
+
+    interval = concurrency / rate if rate else None
+    connector = aiohttp.TCPConnector(limit=concurrency, loop=loop)
+    session = aiohttp.ClientSession(connector=connector, loop=loop)
+    deadline = loop.time() + duration
+
+    try:
+        await asyncio.gather(*[
+            worker(session, base_url, chosen, deadline, interval,
+                   random.Random(seed + i), loop)
+            for i in range(concurrency)
+        ], loop=loop)
+    finally:
+        session.close()
+
+
+def start_server(host, port):
+    server = subprocess.Popen([
+        sys.executable, '-m', 'aiohttp.web', '-H', host, '-P', str(port),
+        'glotpod.ident:init_app'
+    ])
+
+    for _ in range(100):
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError("The server didn't start listening.")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_weights(text):
+    weights = {}
+
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        weights[name.strip()] = float(weight)
+
+    return weights
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.load',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('--url', help="base URL of a running instance "
+                                      "(default: start one)")
+    parser.add_argument('--port', type=int, default=5050,
+                        help="port to start the server on (default: 5050)")
+    parser.add_argument('-u', '--users', type=int, default=10000,
+                        help="number of seeded users (default: 10000)")
+    parser.add_argument('-c', '--concurrency', type=int, default=32,
+                        help="concurrent connections (default: 32)")
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help="seconds to run for (default: 10)")
+    parser.add_argument('-r', '--rate', type=float,
+                        help="target requests per second, across all "
+                             "connections (default: as fast as possible)")
+    parser.add_argument('-m', '--mix', type=parse_weights,
+                        default='user.get=70,user-list.search-name=10,'
+                                'user-list.search-email=10,'
+                                'user-list.post=5,user.patch=5',
+                        help="relative weights of the endpoints, as "
+                             "name=weight pairs separated by commas")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="random seed (default: 0)")
+    parser.add_argument('-o', '--output', help="file to save results to, "
+                                               "as JSON")
+    args = parser.parse_args(argv)
+
+    loop = asyncio.get_event_loop()
+    chosen = scenarios(args.users, args.mix)
+
+    if not chosen:
+        parser.error("the mix doesn't include any known endpoint")
+
+    server = None
+    base_url = args.url
+
+    if base_url is None:
+        server = start_server('127.0.0.1', args.port)
+        base_url = 'http://127.0.0.1:{}'.format(args.port)
+
+    try:
+        start = time.time()
+        loop.run_until_complete(run_load(
+            base_url.rstrip('/'), chosen, concurrency=args.concurrency,
+            duration=args.duration, rate=args.rate, seed=args.seed, loop=loop
+        ))
+        elapsed = time.time() - start
+
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    endpoints = OrderedDict((s.name, s.report(elapsed)) for s in chosen)
+    results = OrderedDict([
+        ('meta', OrderedDict([
+            ('commit', git_commit()),
+            ('time', start),
+            ('url', args.url),
+            ('users', args.users),
+            ('concurrency', args.concurrency),
+            ('duration', elapsed),
+            ('rate', args.rate),
+            ('mix', args.mix),
+        ])),
+        ('throughput', sum(e['throughput'] for e in endpoints.values())),
+        ('endpoints', endpoints),
+    ])
+
+    print("{:<24} {:>8} {:>7} {:>9} {:>8} {:>8} {:>8}".format(
+        "endpoint", "requests", "errors", "req/s", "p50 ms", "p95 ms",
+        "p99 ms"
+    ))
+    for name, e in endpoints.items():
+        lat = e['latency_ms']
+        print("{:<24} {:>8} {:>7} {:>9.1f} {:>8} {:>8} {:>8}".format(
+            name, e['requests'], e['errors'], e['throughput'],
+            *("{:.1f}".format(lat[k]) if lat[k] is not None else '-'
+              for k in ('p50', 'p95', 'p99'))
+        ))
+    print("total: {:.1f} req/s".format(results['throughput']))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Compare the memory and time it takes to hold and serialise a listing of
+users as dicts, the way the list path used to, and as UserRecord tuples.
+
+    $ python -m bench.records --rows 10000
+
+Rows are synthetic tuples, as the database driver would return them; the
+allocations counted are the blocks still held by the listing once it's
+built, and the peak while serialising it.
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from glotpod.ident.records import UserRecord, json_list
+
+from bench.seed import synthetic_user
+
+
+def rows(count):
+    # (id, name, email, facebook, github), with a service for most users
+    for n in range(1, count + 1):
+        name, email = synthetic_user(n)
+        yield (n, name, email, str(n) if n % 3 else None,
+               str(n) if n % 2 else None)
+
+
+def as_dicts(rows):
+    # What the list path used to build: a dict per user and per service
+    results = []
+
+    for id, name, email, facebook, github in rows:
+        item = {'id': id, 'name': name, 'email': email, 'services': {}}
+
+        if facebook is not None:
+            item['services']['facebook'] = {'id': facebook}
+        if github is not None:
+            item['services']['github'] = {'id': github}
+
+        results.append(item)
+
+    return results, json.dumps
+
+
+def as_records(rows):
+    return [UserRecord._make(row) for row in rows], json_list
+
+
+def measure(build, count):
+    source = list(rows(count))
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    start = time.perf_counter()
+    listing, serialise = build(source)
+    built = time.perf_counter() - start
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    # Only what serialising allocates is traced from here
+    tracemalloc.start()
+    start = time.perf_counter()
+    body = serialise(listing)
+    serialised = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    return {'blocks': sum(stat.count_diff for stat in stats),
+            'bytes': sum(stat.size_diff for stat in stats),
+            'serialise_peak_bytes': peak, 'build_ms': built * 1000,
+            'serialise_ms': serialised * 1000, 'body_bytes': len(body)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.records',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('-r', '--rows', type=int, default=10000,
+                        help="number of users listed (default: 10000)")
+    args = parser.parse_args(argv)
+
+    print("{:<8} {:>10} {:>12} {:>14} {:>10} {:>13}".format(
+        "", "blocks", "bytes held", "peak bytes", "build ms", "serialise ms"
+    ))
+
+    for name, build in (('dicts', as_dicts), ('records', as_records)):
+        result = measure(build, args.rows)
+        print("{:<8} {:>10} {:>12} {:>14} {:>10.1f} {:>13.1f}".format(
+            name, result['blocks'], result['bytes'],
+            result['serialise_peak_bytes'], result['build_ms'],
+            result['serialise_ms']
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Seed the identity database with synthetic users and services.
+
+    $ python -m bench.seed --users 1000000 --services 0.5 --reset
+
+The database is the one configured by ``IDENT_SETTINGS``. Users are
+generated deterministically from their sequence number (see
+`synthetic_user`), so a load test against a database seeded from empty with
+``--reset`` can predict which ids, names and email addresses exist.
+"""
+import argparse
+import csv
+import io
+import random
+import sys
+import time
+
+from sqlalchemy import create_engine
+
+from glotpod.ident.bulk import copy_import
+from glotpod.ident.config import load_config, database_args
+from glotpod.ident.model import metadata
+
+
+first_names = [
+    "Arya", "Bran", "Brienne", "Catelyn", "Cersei", "Daenerys", "Davos",
+    "Eddard", "Gendry", "Gilly", "Jaime", "Jon", "Jorah", "Lyanna",
+    "Margaery", "Melisandre", "Missandei", "Petyr", "Podrick", "Ramsay",
+    "Robb", "Samwell", "Sandor", "Sansa", "Shae", "Theon", "Tormund",
+    "Tyrion", "Varys", "Ygritte",
+]
+
+last_names = [
+    "Arryn", "Baratheon", "Bolton", "Clegane", "Dayne", "Florent",
+    "Frey", "Greyjoy", "Hightower", "Karstark", "Lannister", "Martell",
+    "Mormont", "Payne", "Reed", "Redwyne", "Royce", "Seaworth", "Snow",
+    "Stark", "Tarly", "Targaryen", "Tully", "Tyrell", "Umber", "Velaryon",
+    "Waters", "Westerling", "Whent", "Yronwood",
+]
+
+
+def synthetic_user(n):
+    """The name and email address of the n-th (1-based) synthetic user."""
+    first = first_names[n % len(first_names)]
+    last = last_names[(n // len(first_names)) % len(last_names)]
+    email = "{}.{}.{}@bench.glotpod".format(first.lower(), last.lower(), n)
+    return "{} {}".format(first, last), email
+
+
+class SyntheticUsers:
+    """A file-like object producing `count` synthetic users as CSV, in the
+    format read by `glotpod.ident.bulk.copy_import`. Each service is given
+    to a user with probability `service_ratio`."""
+    header = "name,email,github,facebook\r\n"
+
+    def __init__(self, count, service_ratio, seed=0):
+        self.count = count
+        self.service_ratio = service_ratio
+        self.random = random.Random(seed)
+        self.n = 0
+        self.buffer = b''
+        self.header_sent = False
+
+    def readline(self):
+        self.header_sent = True
+        return self.header.encode()
+
+    def read(self, size=-1):
+        if not self.header_sent:
+            self.buffer += self.readline()
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+
+        while self.n < self.count and (size < 0 or
+                                       len(self.buffer) + out.tell() < size):
+            self.n += 1
+            name, email = synthetic_user(self.n)
+            services = [
+                str(self.n) if self.random.random() < self.service_ratio
+                else None
+                for _ in ('github', 'facebook')
+            ]
+            writer.writerow([name, email] + services)
+
+        self.buffer += out.getvalue().encode()
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.seed',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('-u', '--users', type=int, default=10000,
+                        help="number of users to create (default: 10000)")
+    parser.add_argument('-s', '--services', type=float, default=0.5,
+                        help="probability of a user having each service "
+                             "(default: 0.5)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="random seed (default: 0)")
+    parser.add_argument('--reset', action='store_true',
+                        help="drop and recreate the tables first")
+    args = parser.parse_args(argv)
+
+    db_args = database_args(load_config())
+
+    if args.reset:
+        engine = create_engine('postgresql+psycopg2://', connect_args=db_args)
+        metadata.drop_all(engine)
+        metadata.create_all(engine)
+        engine.dispose()
+
+    start = time.time()
+    counts = copy_import(db_args, 'csv', SyntheticUsers(
+        args.users, args.services, args.seed
+    ))
+
+    print("Seeded {users} users and {services} services in {:.1f}s "
+          "({rejected} rejected).".format(time.time() - start, **counts),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
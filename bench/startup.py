@@ -0,0 +1,74 @@
+"""Measure the cost of importing the package, and of building the app.
+
+    $ python -m bench.startup --number 20
+
+Each measurement is made in a fresh interpreter, so that nothing is cached
+in sys.modules. Importing the package should do no I/O and pull in none of
+the libraries in `heavy_modules`; those are only paid for by `init_app`.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+from glotpod.ident.monitor import percentile
+
+
+heavy_modules = ['aiohttp', 'aiopg', 'jsonpatch', 'mimetype_match',
+                 'psycopg2', 'sqlalchemy', 'toml', 'voluptuous']
+
+probe = """
+import json, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    'elapsed': elapsed,
+    'heavy': sorted(m for m in {heavy!r} if m in sys.modules)
+}}))
+"""
+
+cases = [
+    ('import glotpod.ident', "import glotpod.ident"),
+    ('import glotpod.ident.model', "import glotpod.ident.model"),
+    ('init_app', "import glotpod.ident; glotpod.ident.init_app([])"),
+]
+
+
+def measure(statement, number):
+    code = probe.format(statement=statement, heavy=heavy_modules)
+    runs = [
+        json.loads(subprocess.check_output([sys.executable, '-c', code])
+                   .decode())
+        for _ in range(number)
+    ]
+    times = [run['elapsed'] * 1000 for run in runs]
+    return {'p50_ms': percentile(times, 50), 'min_ms': min(times),
+            'heavy_modules': runs[-1]['heavy']}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.startup',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=10,
+                        help="fresh interpreters per case (default: 10)")
+    parser.add_argument('-o', '--output', help="file to save results to, "
+                                               "as JSON")
+    args = parser.parse_args(argv)
+
+    results = {}
+
+    for name, statement in cases:
+        results[name] = result = measure(statement, args.number)
+        print("{:<28} p50 {:>8.1f} ms  min {:>8.1f} ms  imports: {}".format(
+            name, result['p50_ms'], result['min_ms'],
+            ", ".join(result['heavy_modules']) or "-"
+        ))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Compare the time it takes to validate user payloads and list parameters
+with the voluptuous schemas the handlers used to have, and with the
+validators they use now.
+
+    $ python -m bench.validation --number 100000
+"""
+import argparse
+import timeit
+
+from voluptuous import All, Any, Coerce, Length, MultipleInvalid, Range, \
+    Remove, Required, Schema
+
+from glotpod.ident import validation
+
+
+user_schema = Schema({
+    Remove('id'): int,
+    Required('name'): All(str, str.strip, Length(min=1)),
+    Required('email'): All(str, str.strip, Length(min=1)),
+    'services': {
+        Any('github', 'facebook'): {
+            Required('id'): All(str, str.strip, Length(min=1))
+        }
+    },
+})
+
+params_schema = Schema({
+    'name': str,
+    'email': str,
+    'page_size': All(Coerce(int), Range(min=1)),
+    'after_id': All(Coerce(int), Range(min=1)),
+    'before_id': All(Coerce(int), Range(min=1)),
+    'first': str,
+    'q': All(str, str.strip, Length(min=1))
+})
+
+# name -> (data, voluptuous schema, validator)
+cases = {
+    'user': ({'id': 3, 'name': "Robb Stark", 'email': "king@deceased.north",
+              'services': {'github': {'id': '25'}, 'facebook': {'id': '75'}}},
+             user_schema, validation.user),
+    'user-invalid': ({'name': "Robb Stark", 'email': " ",
+                      'services': {'gitlab': {'id': '25'}}},
+                     user_schema, validation.user),
+    'user-list-params': ({'name': "Stark", 'page_size': '20',
+                          'after_id': '100'},
+                         params_schema, validation.user_list_params),
+}
+
+
+def measure(validate, exception, data, number):
+    def call():
+        try:
+            validate(data)
+        except exception:
+            pass
+
+    return min(timeit.repeat(call, number=number, repeat=3)) / number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.validation',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help="validations per timing (default: 100000)")
+    args = parser.parse_args(argv)
+
+    print("{:<18} {:>14} {:>14} {:>9}".format(
+        "", "voluptuous us", "compiled us", "speedup"
+    ))
+
+    for name, (data, schema, validate) in cases.items():
+        before = measure(schema, MultipleInvalid, data, args.number)
+        after = measure(validate, validation.Invalid, data, args.number)
+
+        print("{:<18} {:>14.2f} {:>14.2f} {:>8.1f}x".format(
+            name, before * 1e6, after * 1e6, before / after
+        ))
+
+
+if __name__ == '__main__':
+    main()
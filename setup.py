@@ -51,7 +51,15 @@ License
                       'voluptuous~=0.8.10', 'jsonpatch~=1.13',
                       'mimetype-match~=1.0.4'],
 
-    extras_require={},
-
-    entry_points={},
+    extras_require={'uvloop': ['uvloop'],
+                    'msgpack': ['msgpack-python~=0.4.7']},
+
+    entry_points={
+        'console_scripts': [
+            'glotpod-ident = glotpod.ident.server:main',
+            'glotpod-ident-export = glotpod.ident.bulk:export_main',
+            'glotpod-ident-import = glotpod.ident.bulk:import_main',
+            'glotpod-ident-rotate-tokens = glotpod.ident.crypto:rotate_main',
+        ],
+    },
 )
@@ -0,0 +1,209 @@
+import asyncio
+import math
+
+from collections import deque
+
+
+__all__ = ['AdmissionController', 'Limiter', 'Overloaded']
+
+read_methods = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+class Overloaded(Exception):
+    """Raised instead of queueing a request that wouldn't be admitted in
+    time. `retry_after` is a suggested number of seconds to back off."""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """Admits at most `limit` requests at once, and queues up to
+    `queue_size` more for no longer than `deadline` seconds.
+
+    A request is turned away straight away if the queue is full, or if the
+    wait for it is estimated (from the average time requests take) to be
+    longer than the deadline.
+    """
+
+    def __init__(self, limit, *, queue_size=100, deadline=1.0, loop=None):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.deadline = deadline
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.active = 0
+        self.waiters = deque()
+
+        # Exponentially weighted average of how long requests take
+        self.service_time = None
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def estimated_wait(self):
+        if self.active < self.limit:
+            return 0.0
+
+        return (self.service_time or 0.0) * (len(self.waiters) + 1) / \
+            self.limit
+
+    def retry_after(self):
+        return max(1, math.ceil(self.estimated_wait()))
+
+    async def acquire(self):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+
+        if len(self.waiters) >= self.queue_size or \
+                self.estimated_wait() > self.deadline:
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+
+        waiter = asyncio.Future(loop=self.loop)
+        self.waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(waiter, self.deadline, loop=self.loop)
+
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise Overloaded(self.retry_after())
+
+        except asyncio.CancelledError:
+            # If the slot was handed over just as this request was
+            # cancelled, pass it on
+            if waiter.done() and not waiter.cancelled():
+                self._hand_over()
+            raise
+
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+        self.admitted += 1
+
+    def release(self, duration=None):
+        # The duration is left out for requests which never ran
+        if duration is None:
+            pass
+        elif self.service_time is None:
+            self.service_time = duration
+        else:
+            self.service_time = 0.9 * self.service_time + 0.1 * duration
+
+        self._hand_over()
+
+    def _hand_over(self):
+        # Give this slot to the next request still waiting, if any
+        while self.waiters:
+            waiter = self.waiters.popleft()
+
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+        self.active -= 1
+
+    def stats(self):
+        return {'limit': self.limit, 'active': self.active,
+                'queued': len(self.waiters), 'admitted': self.admitted,
+                'rejected': self.rejected, 'timed_out': self.timed_out,
+                'service_time': self.service_time}
+
+
+class AdmissionController:
+    """Holds the limiters for reads and for writes, which every request
+    goes through, and any limiters for particular routes, which requests to
+    those routes go through first.
+
+    Configuration looks like::
+
+        [admission]
+        read_limit = 10
+        write_limit = 5
+        queue_size = 100
+        deadline = 1.0
+
+        [admission.routes.user-list]
+        read_limit = 4
+    """
+
+    def __init__(self, config, *, default_limit=10, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.exempt = set(config.get('exempt', ['stats', 'profile-list',
+                                                'profile', 'export',
+                                                'changes']))
+
+        self.budgets = self.make_limiters(config, default_limit)
+        self.routes = {
+            route: self.make_limiters(dict(config, **route_cfg), None)
+            for route, route_cfg in config.get('routes', {}).items()
+        }
+
+    def make_limiters(self, config, default_limit):
+        read_limit = config.get('read_limit', default_limit)
+        write_limit = config.get('write_limit', read_limit and
+                                 max(1, read_limit // 2))
+
+        limiters = {}
+
+        for kind, limit in (('read', read_limit), ('write', write_limit)):
+            if limit:
+                limiters[kind] = Limiter(
+                    limit, queue_size=config.get('queue_size', 100),
+                    deadline=config.get('deadline', 1.0), loop=self.loop
+                )
+
+        return limiters
+
+    def limiters_for(self, request):
+        route = request.match_info.route.name
+
+        if route in self.exempt:
+            return []
+
+        kind = 'read' if request.method in read_methods else 'write'
+        limiters = [self.routes.get(route, {}).get(kind),
+                    self.budgets.get(kind)]
+
+        return [limiter for limiter in limiters if limiter is not None]
+
+    async def run(self, request, handler):
+        acquired = []
+
+        try:
+            for limiter in self.limiters_for(request):
+                await limiter.acquire()
+                acquired.append(limiter)
+
+            start = self.loop.time()
+
+            try:
+                return await handler(request)
+            finally:
+                duration = self.loop.time() - start
+
+                for limiter in acquired:
+                    limiter.release(duration)
+
+                acquired = []
+
+        finally:
+            # Give back what was acquired, if acquiring the rest failed
+            for limiter in acquired:
+                limiter.release()
+
+    def stats(self):
+        stats = {kind: limiter.stats()
+                 for kind, limiter in self.budgets.items()}
+
+        for route, limiters in self.routes.items():
+            for kind, limiter in limiters.items():
+                stats['{}.{}'.format(route, kind)] = limiter.stats()
+
+        return stats
@@ -0,0 +1,563 @@
+import asyncio
+import logging
+import math
+
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+from random import random
+
+from aiohttp import web
+from aiopg.sa import create_engine
+
+from glotpod.ident import admission, batch, bulk, cache, changes, coalesce, \
+    crypto, errors, handlers, monitor, notifications, prefix, profiling, \
+    shards, stale, storage, tracing
+from glotpod.ident.config import encryption_keys, load_config, pool_args, \
+    shard_args
+
+
+class DroppingQueueHandler(QueueHandler):
+    """A queue handler which never blocks the event loop; records are
+    counted and dropped when the queue is full instead."""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+def configure_logging(log, level=logging.INFO, queue_size=10000):
+    # Records are formatted on the calling thread, but written to stderr by
+    # a listener thread, so that slow log I/O doesn't stall the event loop.
+    # The returned listener must be stopped to flush the queue. Records
+    # aren't passed on to the root logger's handlers, which would write
+    # them again, on the event loop's thread.
+    log.setLevel(level)
+    log.propagate = False
+
+    formatter = logging.Formatter(
+        "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+    )
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    stream_handler.setLevel(level)
+
+    log_queue = Queue(queue_size)
+    log.addHandler(DroppingQueueHandler(log_queue))
+
+    listener = QueueListener(log_queue, stream_handler,
+                             respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def response_size(res):
+    # The size of a response body, if it's known up front
+    if isinstance(res, web.Response):
+        return len(res.body) if res.body is not None else 0
+    else:
+        return res.content_length
+
+
+async def db_pool_middleware_factory(app, handler):
+    # This middleware adds the storage, and the postgres connection pool
+    # behind it, to every request. It doesn't actually acquire a database
+    # connection however; handlers must do that themselves. The simplest
+    # way is opening a storage session with an async with block::
+    #
+    #   async with request['storage'].session() as session:
+    #       do_something_with(session)
+    #
+    backend = app['config'].get('storage', {}).get('backend', 'postgres')
+    search_cfg = app['config'].get('search', {})
+    search = {'similarity': search_cfg.get('similarity', 0.3),
+              'fuzzy_limit': search_cfg.get('limit', 50)}
+
+    if 'storage' not in app and backend == 'memory':
+        app['log'].info("Using in-memory storage.")
+        app['storage'] = storage.MemoryStorage(loop=app.loop, **search)
+
+    # Create a connection pool for each shard on the first request; the
+    # first shard's is app['db_engine']
+    if 'storage' not in app and 'db_engine' not in app:
+        app['log'].info("Creating pooled database connections.")
+        app['db_engines'] = engines = []
+
+        async def cleanup(app):
+            app['log'].info("Disposing pooled database connections.")
+
+            for engine in engines:
+                engine.close()
+                await engine.wait_closed()
+
+        app.on_shutdown.append(cleanup)
+
+        for args in shard_args(app['config']):
+            args = dict(args, **pool_args(app['config']))
+            engines.append(await create_engine(**args))
+
+        app['db_engine'] = engines[0]
+
+    engines = app.get('db_engines', [app.get('db_engine')])
+    cipher = app.get('cipher')
+
+    if 'storage' not in app and len(engines) == 1:
+        app['storage'] = storage.PostgresStorage(app['db_engine'],
+                                                 cipher=cipher, **search)
+
+    elif 'storage' not in app:
+        app['log'].info("Sharding users over %s databases.", len(engines))
+        app['storage'] = shards.ShardedStorage([
+            storage.PostgresStorage(engine, shard=(index, len(engines)),
+                                    cipher=cipher, **search)
+            for index, engine in enumerate(engines)
+        ], loop=app.loop)
+
+    async def middleware_handler(request):
+        request['db_pool'] = app.get('db_engine')
+        request['storage'] = app['storage']
+        return await handler(request)
+
+    return middleware_handler
+
+
+async def logging_middleware_factory(app, handler):
+    # This middleware emits one access log line per request, *and* it
+    # sets up logging.
+
+    # If the application doesn't have a log, create it
+    if 'log' not in app:
+        cfg = app['config'].get('logging', {})
+        level = logging.getLevelName(cfg.get('level', 'INFO').upper())
+
+        app['log'] = logging.getLogger(__name__)
+        app['log_listener'] = listener = configure_logging(
+            app['log'], level, cfg.get('queue_size', 10000)
+        )
+
+        async def cleanup(app):
+            listener.stop()
+
+        app.on_cleanup.append(cleanup)
+
+    access_log = logging.getLogger(__name__ + '.access')
+    sample_rate = app['config'].get('logging', {}).get('access_sample_rate',
+                                                       1.0)
+
+    async def middleware_handler(request):
+        log = app['log']
+        start = app.loop.time()
+
+        request_log = "{}.{}".format(__name__, handler.__name__)
+        request['log'] = logging.getLogger(request_log)
+        res = None
+
+        try:
+            res = await handler(request)
+
+        except web.HTTPException as e:
+            res = e
+            raise
+
+        except Exception:
+            log.exception("request handling failed.")
+            raise
+
+        else:
+            return res
+
+        finally:
+            status = res.status if res is not None else 500
+            size = response_size(res) if res is not None else None
+
+            # Successful requests may be sampled; failures are always logged
+            if status >= 400 or sample_rate >= 1 or random() < sample_rate:
+                duration = (app.loop.time() - start) * 1000
+                access_log.info(
+                    "%s %s %s %s %.1fms", request.method, request.path_qs,
+                    status, size if size is not None else '-', duration,
+                    extra={'method': request.method, 'path': request.path_qs,
+                           'status': status, 'size': size,
+                           'duration': duration}
+                )
+
+    return middleware_handler
+
+
+async def admission_middleware_factory(app, handler):
+    # This middleware sheds load before the database pool is saturated:
+    # requests queue for a limited number of slots, and are turned away with
+    # 503 if they can't get one in time
+    if 'admission' not in app:
+        cfg = app['config'].get('admission', {})
+        app['admission'] = admission.AdmissionController(
+            cfg, default_limit=pool_args(app['config']).get('maxsize', 10),
+            loop=app.loop
+        )
+        app['stats']['admission'] = lambda app: app['admission'].stats()
+
+    controller = app['admission']
+
+    async def middleware_handler(request):
+        try:
+            return await controller.run(request, handler)
+        except admission.Overloaded as e:
+            raise web.HTTPServiceUnavailable(
+                headers={'Retry-After': str(e.retry_after)}
+            )
+
+    return middleware_handler
+
+
+deadline_header = 'X-Ident-Deadline'
+
+
+def request_timeout(request, cfg):
+    # The route's deadline, or the one the request asks for if that's
+    # sooner; None if neither has one. Requests can't ask for more than
+    # the maximum, which Postgres's statement_timeout must be able to hold.
+    timeout = cfg.get('routes', {}).get(request.match_info.route.name,
+                                        cfg.get('default'))
+
+    try:
+        requested = float(request.headers[deadline_header])
+    except (KeyError, ValueError):
+        return timeout
+
+    if not math.isfinite(requested) or requested <= 0:
+        return timeout
+
+    requested = min(requested, cfg.get('max', 300))
+    return requested if timeout is None else min(timeout, requested)
+
+
+async def deadline_middleware_factory(app, handler):
+    # This middleware gives requests a deadline, after which they're
+    # answered with 504. Their statements in Postgres time out with them,
+    # and, as with clients disconnecting, are cancelled
+    cfg = app['config'].get('deadlines', {})
+
+    async def middleware_handler(request):
+        timeout = request_timeout(request, cfg)
+
+        if timeout is None:
+            return await handler(request)
+
+        request['storage'] = storage.DeadlineStorage(
+            request['storage'], app.loop.time() + timeout, loop=app.loop
+        )
+
+        try:
+            return await asyncio.wait_for(handler(request), timeout,
+                                          loop=app.loop)
+        except (asyncio.TimeoutError, errors.Timeout):
+            raise web.HTTPGatewayTimeout
+
+    return middleware_handler
+
+
+async def prefix_index_middleware_factory(app, handler):
+    # This middleware loads the typeahead index of user names in the
+    # background, once the storage is there, and reloads it now and then
+    if 'prefix_index' not in app:
+        cfg = app['config'].get('prefix_index', {})
+        app['prefix_index'] = index = prefix.PrefixIndex(
+            max_entries=cfg.get('max_entries', 1000000), loop=app.loop
+        )
+        app['stats']['prefix_index'] = lambda app: app['prefix_index'].stats()
+
+        refresh = app.loop.create_task(
+            index.refresh(app['storage'], cfg.get('refresh_interval', 300))
+        )
+
+        async def cleanup(app):
+            refresh.cancel()
+
+        app.on_shutdown.append(cleanup)
+
+    return handler
+
+
+async def change_listener_middleware_factory(app, handler):
+    # This middleware listens for the changes committed by other processes,
+    # to each shard of the database, to wake up the requests waiting for them
+    if 'db_engine' in app and 'change_listeners' not in app:
+        cfg = app['config'].get('changes', {})
+        app['change_listeners'] = listeners = [
+            app.loop.create_task(app['changes'].listen(
+                engine,
+                retry_interval=cfg.get('retry_interval', 5),
+                check_interval=cfg.get('check_interval', 30)
+            ))
+            for engine in app.get('db_engines', [app['db_engine']])
+        ]
+
+        async def cleanup(app):
+            for listener in listeners:
+                listener.cancel()
+
+            await asyncio.wait(listeners, loop=app.loop)
+
+        # Before the pools are closed, which wait for the connections
+        app.on_shutdown.insert(0, cleanup)
+
+    return handler
+
+
+async def subscribers_middleware_factory(app, handler):
+    # This middleware sends events to the notifications micro-service
+    if 'subscribers' not in app:
+        cfg = app['config'].get('notifications', {})
+
+        breaker = notifications.CircuitBreaker(
+            failure_rate=cfg.get('failure_rate', 0.5),
+            window=cfg.get('window', 20), min_calls=cfg.get('min_calls', 10),
+            reset_timeout=cfg.get('reset_timeout', 30),
+            probes=cfg.get('probes', 1), loop=app.loop
+        )
+        app['subscribers'] = sender = notifications.Sender(
+            app.loop, host=cfg.get('host'), timeout=cfg.get('timeout', 5),
+            max_pending=cfg.get('max_pending', 100), breaker=breaker,
+            warn_interval=cfg.get('warn_interval', 60)
+        )
+        app['stats']['notifications'] = lambda app: sender.stats()
+
+        async def cleanup(app):
+            await sender.cleanup()
+
+        app.on_shutdown.append(cleanup)
+
+    return handler
+
+
+async def tracing_middleware_factory(app, handler):
+    # This middleware makes each request a span, continuing the trace of the
+    # traceparent header it may come with, and traces the storage it uses
+    tracer = app['tracer']
+
+    async def middleware_handler(request):
+        route = request.match_info.route
+        span = tracer.start(
+            '{} {}'.format(request.method, route.name or request.path),
+            traceparent=request.headers.get('traceparent'),
+            **{'http.method': request.method, 'http.target': request.path_qs}
+        )
+
+        request['span'] = span
+        request['storage'] = tracing.TracedStorage(request['storage'], span)
+        error = None
+
+        try:
+            with tracing.activate(span, loop=app.loop):
+                res = await handler(request)
+
+        except web.HTTPException as e:
+            span.set('http.status_code', e.status)
+
+            if e.status >= 500:
+                error = type(e).__name__
+
+            raise
+
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+
+        else:
+            span.set('http.status_code', res.status)
+            return res
+
+        finally:
+            span.finish(error)
+
+    return middleware_handler
+
+
+async def loop_monitor_middleware_factory(app, handler):
+    # This middleware keeps track of which routes have requests in flight,
+    # so the loop monitor can tell what was running when the loop stalled
+    in_flight = app['loop_monitor'].in_flight
+
+    async def middleware_handler(request):
+        route = request.match_info.route
+        name = route.name or request.path
+
+        in_flight[name] += 1
+        try:
+            return await handler(request)
+        finally:
+            in_flight[name] -= 1
+
+    return middleware_handler
+
+
+async def profiling_middleware_factory(app, handler):
+    # This middleware runs requests under the profiler when they ask for it
+    # with the secret header, or when samples are armed for their route
+    profiler = app['profiler']
+
+    async def middleware_handler(request):
+        if profiler.wants(request):
+            return await profiler.profile(request, handler)
+        else:
+            return await handler(request)
+
+    return middleware_handler
+
+
+def init_app(_, *, loop=None):
+    """Initialise the application object, to be served by aiohttp."""
+    middlewares = [db_pool_middleware_factory,
+                   subscribers_middleware_factory, logging_middleware_factory]
+
+    config = load_config()
+    admission_cfg = config.get('admission', {})
+    monitor_cfg = config.get('monitor', {})
+    profiling_cfg = config.get('profiling', {})
+    tracing_cfg = config.get('tracing', {})
+
+    # Middleware factories run last to first, so these run after the
+    # storage is set up
+    middlewares.insert(0, change_listener_middleware_factory)
+
+    if config.get('prefix_index', {}).get('enabled', False):
+        middlewares.insert(0, prefix_index_middleware_factory)
+
+    # Spans cover everything a request does once it has the storage
+    if tracing_cfg.get('enabled', False):
+        middlewares.insert(middlewares.index(db_pool_middleware_factory) + 1,
+                           tracing_middleware_factory)
+
+    if admission_cfg.get('enabled', False):
+        middlewares.append(admission_middleware_factory)
+
+    if config.get('deadlines', {}).get('enabled', False):
+        middlewares.append(deadline_middleware_factory)
+
+    if monitor_cfg.get('enabled', False):
+        middlewares.append(loop_monitor_middleware_factory)
+
+    # Profiling is only available with a secret to guard it
+    if profiling_cfg.get('enabled', False) and profiling_cfg.get('secret'):
+        middlewares.append(profiling_middleware_factory)
+
+    app = web.Application(loop=loop, middlewares=middlewares)
+    app['config'] = config
+    app['stats'] = {'runtime': monitor.runtime_stats}
+
+    app['changes'] = changes.ChangeFeed(loop=app.loop)
+    app['stats']['changes'] = lambda app: app['changes'].stats()
+
+    keys = encryption_keys(config)
+
+    if keys:
+        database_cfg = config['database']
+        app['cipher'] = crypto.TokenCipher(
+            keys, ttl=database_cfg.get('token_cache_ttl', 60),
+            cache_size=database_cfg.get('token_cache_size', 10000),
+            loop=app.loop
+        )
+        app['stats']['access_tokens'] = lambda app: app['cipher'].stats()
+
+    app['reads'] = coalesce.SingleFlight(loop=app.loop)
+    app['stats']['coalescing'] = lambda app: app['reads'].stats()
+
+    # Routes may serve stale results when reading them again fails
+    app['stale'] = {
+        route: stale.StaleCache(
+            max_age=cfg.get('max_age', 0), window=cfg.get('window', 30),
+            timeout=cfg.get('timeout'), size=cfg.get('size', 10000),
+            retry_interval=cfg.get('retry_interval', 1.0), loop=app.loop
+        )
+        for route, cfg in config.get('stale', {}).items()
+    }
+
+    # Routes may keep the responses to repeated reads for a few seconds
+    app['response_cache'] = {
+        route: cache.ResponseCache(
+            ttl=cfg.get('ttl', 5),
+            max_bytes=cfg.get('max_bytes', 16 * 1024 * 1024), loop=app.loop
+        )
+        for route, cfg in config.get('response_cache', {}).items()
+    }
+
+    if app['response_cache']:
+        app['stats']['response_cache'] = lambda app: {
+            route: responses.stats()
+            for route, responses in app['response_cache'].items()
+        }
+
+    if app['stale']:
+        app['stats']['stale'] = lambda app: {
+            route: results.stats() for route, results in app['stale'].items()
+        }
+
+        async def close_stale(app):
+            for results in app['stale'].values():
+                await results.close()
+
+        app.on_shutdown.append(close_stale)
+
+    if monitor_cfg.get('enabled', False):
+        app['loop_monitor'] = loop_monitor = monitor.LoopMonitor(
+            app.loop,
+            interval=monitor_cfg.get('interval', 0.1),
+            threshold=monitor_cfg.get('threshold', 0.05)
+        )
+        app['stats']['loop'] = lambda app: app['loop_monitor'].stats()
+        loop_monitor.start()
+
+        async def cleanup(app):
+            loop_monitor.stop()
+
+        app.on_shutdown.append(cleanup)
+
+    if tracing_middleware_factory in middlewares:
+        app['tracer'] = tracer = tracing.Tracer(
+            tracing.make_exporter(tracing_cfg),
+            sample_rate=tracing_cfg.get('sample_rate', 1.0),
+            batch_size=tracing_cfg.get('batch_size', 100),
+            flush_interval=tracing_cfg.get('flush_interval', 5),
+            max_pending=tracing_cfg.get('max_pending', 10000),
+            loop=app.loop
+        )
+        app['stats']['tracing'] = lambda app: app['tracer'].stats()
+
+        async def close_tracer(app):
+            await tracer.close()
+
+        app.on_cleanup.append(close_tracer)
+
+    if profiling_middleware_factory in middlewares:
+        app['profiler'] = profiling.RequestProfiler(
+            profiling_cfg['secret'],
+            top=profiling_cfg.get('top', 25),
+            history=profiling_cfg.get('history', 20)
+        )
+
+    app.router.add_route('*', '/', handlers.AllUsers, name='user-list')
+    app.router.add_route('POST', '/batch', batch.Batch, name='batch')
+    app.router.add_route('GET', '/changes', changes.Changes, name='changes')
+    app.router.add_route('GET', '/export', bulk.Export, name='export')
+    app.router.add_route('GET', '/search/prefix', prefix.PrefixSearch,
+                         name='prefix-search')
+
+    # The statistics aren't guarded, so are only served when asked for
+    if monitor_cfg.get('enabled', False):
+        app.router.add_route('GET', '/_stats', monitor.Stats, name='stats')
+
+    app.router.add_route('*', '/_profile', profiling.Profiles,
+                         name='profile-list')
+    app.router.add_route('GET', '/_profile/{id}', profiling.Profiles,
+                         name='profile')
+    app.router.add_route('GET', '/{id}/access_tokens', handlers.AccessTokens,
+                         name='user-tokens')
+    app.router.add_route('*', '/{id}', handlers.User, name='user')
+
+    return app
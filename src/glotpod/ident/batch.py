@@ -0,0 +1,286 @@
+import asyncio
+import json
+
+from itertools import groupby
+from urllib.parse import urlsplit
+
+from aiohttp import web
+from aiohttp.multidict import CIMultiDict
+
+from glotpod.ident import media, validation
+from glotpod.ident.admission import Overloaded
+from glotpod.ident.handlers import AllUsers
+
+
+__all__ = ['Batch']
+
+# The routes sub-requests may be made to
+routes = ('user-list', 'user')
+
+batch_schema = validation.validator(validation.mapping({
+    'requests': validation.sequence(validation.mapping({
+        'method': validation.one_of('GET', 'POST', 'PATCH'),
+        'path': validation.text(min_length=1),
+        'headers': validation.dictionary(validation.text(),
+                                         validation.text()),
+        'body': validation.anything(),
+    }, required=['method', 'path'])),
+    'atomic': validation.boolean(),
+}, required=['requests']))
+
+
+class SubRequest(dict):
+    """Just enough of aiohttp's Request for the views of `routes`, for one
+    of the requests in a batch. Its body, if any, is sent to the view as
+    JSON."""
+
+    def __init__(self, batch, item, match_info):
+        super().__init__(batch)
+        self.app = batch.app
+        self.method = item['method']
+        self.match_info = match_info
+        url = urlsplit(item['path'])
+        self.path, self.query_string = url.path, url.query
+        self.headers = CIMultiDict(item.get('headers', {}))
+        self.body = item.get('body')
+
+        if self.method == 'PATCH':
+            self.content_type = 'application/json-patch+json'
+        else:
+            self.content_type = media.json_type
+
+    async def read(self):
+        return json.dumps(self.body).encode('utf-8')
+
+
+class SharedSession:
+    """Storage for the writes of a batch: sessions opened through it are the
+    batch's session, so that the writes share one connection."""
+
+    def __init__(self, session):
+        self._session = session
+
+    def session(self, *, timeout=None):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+class JoinedTransaction(SharedSession):
+    """Storage for the writes of a batch run in one transaction: as well as
+    sharing its session, transactions begun in it are part of the batch's
+    transaction."""
+
+    def begin(self):
+        return self
+
+
+class Failed(Exception):
+    # Rolls back the transaction of a batch when one of its writes fails
+    pass
+
+
+def result(res):
+    """The status, headers and body of the response to a sub-request, as
+    they're put in the response to the batch."""
+    # aiohttp has the names of response headers in upper case
+    headers = {k.title(): v for k, v in res.headers.items()
+               if k.upper() != 'CONTENT-LENGTH'}
+    mimetype = res.content_type
+
+    if not res.body:
+        body = None
+    elif mimetype == media.json_type or mimetype.endswith('+json'):
+        body = json.loads(res.body.decode('utf-8'))
+    elif mimetype == media.msgpack_type:
+        body = media.decode(mimetype, res.body)
+    else:
+        body = res.text
+
+    return {'status': res.status, 'headers': headers, 'body': body}
+
+
+def is_read(request):
+    _, item, _ = request
+    return item['method'] == 'GET'
+
+
+# What's answered for the requests of a batch which failed, or were undone
+failed_dependency = {'status': 424, 'headers': {}, 'body': None}
+
+
+class Batch(web.View):
+    """Several requests to the user routes in one: POST /batch with a list
+    of requests, and get a list of their responses back, in order.
+
+    The requests run in the order they're sent: reads (GETs) next to each
+    other run concurrently, and the writes run one after another, on one
+    connection, so reads see the writes sent before them. With `atomic`,
+    the writes are made in one transaction: if one of them fails, none of
+    them are made, and they're all answered with 424, bar the one that
+    failed. The reads of an atomic batch, which run before its writes, must
+    be sent before them too.
+
+    The requests in a batch are handled by their views directly, with the
+    storage, deadline and trace of the batch, and none of the middlewares,
+    except that reads are admitted by admission control, if it's enabled,
+    like requests of their own. At most `read_concurrency` of them run at
+    once.
+    """
+
+    async def post(self):
+        mimetype = AllUsers.get_best_mimetype(self.request, media.offered(
+            media.json_type
+        ))
+
+        try:
+            batch = batch_schema(await media.read(self.request))
+        except validation.Invalid:
+            raise web.HTTPBadRequest
+
+        items = batch['requests']
+        cfg = self.request.app['config'].get('batch', {})
+
+        if len(items) > cfg.get('max_requests', 50):
+            raise web.HTTPRequestEntityTooLarge
+
+        results = [None] * len(items)
+        requests = []
+
+        for index, item in enumerate(items):
+            try:
+                match_info = await self.resolve(item)
+            except web.HTTPException as e:
+                results[index] = result(e)
+                continue
+
+            requests.append((index, item, match_info))
+
+        # The reads before the first write run together; from there on, the
+        # requests run in order
+        first = next((n for n, request in enumerate(requests)
+                      if not is_read(request)), len(requests))
+        reads, rest = requests[:first], requests[first:]
+        atomic = batch.get('atomic', False)
+
+        # Reads within a transaction could be answered from caches which
+        # don't know about its writes yet
+        if atomic and any(is_read(request) for request in rest):
+            raise web.HTTPBadRequest
+
+        semaphore = asyncio.Semaphore(cfg.get('read_concurrency', 10),
+                                      loop=self.request.app.loop)
+
+        if reads:
+            await self.run_reads(reads, results, semaphore)
+
+        if rest and atomic:
+            await self.run_atomic(rest, results)
+
+        elif rest:
+            await self.run_in_order(rest, results, semaphore)
+
+        return media.response(mimetype, results)
+
+    async def resolve(self, item):
+        # The match info of the route a sub-request is for
+        path = urlsplit(item['path']).path
+        allowed = set()
+
+        for name in routes:
+            resource = self.request.app.router.named_resources()[name]
+            match_info, methods = await resource.resolve(item['method'], path)
+
+            if match_info is not None:
+                return match_info
+
+            allowed |= methods
+
+        if allowed:
+            raise web.HTTPMethodNotAllowed(item['method'], allowed)
+
+        raise web.HTTPNotFound
+
+    async def run_reads(self, reads, results, semaphore):
+        responses = await asyncio.gather(*(
+            self.read(item, match_info, semaphore)
+            for _, item, match_info in reads
+        ), loop=self.request.app.loop)
+
+        for (index, _, _), response in zip(reads, responses):
+            results[index] = response
+
+    async def read(self, item, match_info, semaphore):
+        # Reads each take a connection from the pool, so are admitted like
+        # requests of their own; the writes run within the batch's slot
+        async with semaphore:
+            return await self.run(item, match_info,
+                                  controller=self.request.app.get('admission'))
+
+    async def run(self, item, match_info, *, controller=None, **state):
+        request = SubRequest(self.request, item, match_info)
+        request.update(state)
+
+        try:
+            if controller is None:
+                res = await match_info.handler(request)
+            else:
+                res = await controller.run(request, match_info.handler)
+        except Overloaded as e:
+            res = web.HTTPServiceUnavailable(
+                headers={'Retry-After': str(e.retry_after)}
+            )
+        except web.HTTPException as e:
+            res = e
+
+        return result(res)
+
+    async def run_in_order(self, requests, results, semaphore):
+        # Run the writes one after another on one connection, and the reads
+        # between them together
+        async with self.request['storage'].session() as session:
+            storage = SharedSession(session)
+
+            for reads, run in groupby(requests, key=is_read):
+                if reads:
+                    await self.run_reads(list(run), results, semaphore)
+                    continue
+
+                for index, item, match_info in run:
+                    results[index] = await self.run(item, match_info,
+                                                    storage=storage)
+
+    async def run_atomic(self, writes, results):
+        # Run the writes on one connection, in one transaction; what they
+        # do once committed waits for the transaction to be
+        pending = []
+
+        try:
+            async with self.request['storage'].session() as session:
+                async with session.begin():
+                    storage = JoinedTransaction(session)
+
+                    for index, item, match_info in writes:
+                        results[index] = await self.run(
+                            item, match_info, storage=storage,
+                            after_commit=pending
+                        )
+
+                        if results[index]['status'] >= 400:
+                            raise Failed
+
+        except Failed:
+            for index, _, _ in writes:
+                if results[index] is None or results[index]['status'] < 400:
+                    results[index] = failed_dependency
+
+        else:
+            for callback in pending:
+                callback()
@@ -0,0 +1,684 @@
+import argparse
+import asyncio
+import csv
+import io
+import json
+import sys
+import tempfile
+
+from contextlib import ExitStack
+from functools import partial
+
+import psycopg2
+import sqlalchemy as sa
+
+from aiohttp import web
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql import select, func, exists
+
+from glotpod.ident import media
+from glotpod.ident.config import load_config, shard_args
+from glotpod.ident.handlers import AllUsers
+from glotpod.ident.model import users, services
+from glotpod.ident.shards import ShardRouter
+from glotpod.ident.storage import service_name_map
+
+
+__all__ = ['Export', 'copy_export', 'export_main', 'copy_import',
+           'import_main']
+
+# Formats understood by the export, and the media types they're served as
+export_formats = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+if media.msgpack is not None:
+    # A stream of user documents, one after the other
+    export_formats['msgpack'] = media.msgpack_type
+
+
+def _service_key(column):
+    return sa.case([(column == sv_name, key)
+                    for sv_name, key in service_name_map.items()])
+
+
+def export_query(fmt):
+    """Build the query for the rows of an export in the given format."""
+    if fmt == 'csv':
+        # One column per service, so that the output is flat
+        columns = [users.c.id, users.c.name,
+                   users.c.email_address.label('email')]
+        joined = users
+
+        for sv_name, key in sorted(service_name_map.items(),
+                                   key=lambda item: item[1]):
+            svc = services.alias(key)
+            joined = joined.outerjoin(
+                svc, (svc.c.user_id == users.c.id) & (svc.c.sv_name == sv_name)
+            )
+            columns.append(svc.c.sv_id.label(key))
+
+        return select(columns).select_from(joined).order_by(users.c.id)
+
+    elif fmt == 'ndjson':
+        # Build the same representation that the user resource has, in
+        # Postgres itself
+        svc_key = _service_key(services.c.sv_name)
+        svc_value = func.json_build_object('id', services.c.sv_id)
+        svc_object = select([func.json_object_agg(svc_key, svc_value)]) \
+            .where(services.c.user_id == users.c.id).as_scalar()
+
+        document = func.json_build_object(
+            'id', users.c.id,
+            'name', users.c.name,
+            'email', users.c.email_address,
+            'services', func.coalesce(svc_object,
+                                      sa.literal_column("'{}'::json"))
+        )
+
+        return select([document]).order_by(users.c.id)
+
+    else:
+        raise ValueError("unknown export format: {!r}".format(fmt))
+
+
+def export_statement(cursor, fmt, *, header=True):
+    """Build the COPY statement which streams an export of all users; of a
+    CSV export, with a header unless `header` is false."""
+    compiled = export_query(fmt).compile(dialect=PGDialect_psycopg2())
+    query = cursor.mogrify(str(compiled), compiled.params)
+    query = query.decode(cursor.connection.encoding)
+
+    if fmt == 'csv':
+        options = "FORMAT csv, HEADER {}".format('true' if header else 'false')
+    else:
+        # COPY's text format would escape the backslashes in each document,
+        # so use csv with a quote and delimiter that JSON never contains raw
+        options = "FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'"
+
+    return "COPY ({}) TO STDOUT WITH ({})".format(query, options)
+
+
+class MsgpackWriter:
+    """A file-like object which takes the output of an ndjson export, and
+    writes each document to `fh` as MessagePack instead."""
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.buffer = b''
+
+    def write(self, data):
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+
+        self.fh.write(b''.join(
+            media.encode(media.msgpack_type, json.loads(line.decode('utf-8')))
+            for line in lines if line
+        ))
+
+
+def copy_export(shards, fmt, fh):
+    """Stream an export of all users to the file-like object `fh`, from the
+    databases with the connection arguments `shards`, as `shard_args` gives
+    them: one shard after another, each in order of id.
+
+    This uses blocking psycopg2 connections, since COPY isn't supported on
+    asynchronous ones; run it in an executor when on the event loop.
+    """
+    if fmt == 'msgpack':
+        # Postgres can't produce MessagePack; convert its JSON on the way
+        fmt, fh = 'ndjson', MsgpackWriter(fh)
+
+    for index, args in enumerate(shards):
+        conn = psycopg2.connect(**args)
+
+        try:
+            conn.set_session(readonly=True)
+            with conn.cursor() as cursor:
+                statement = export_statement(cursor, fmt, header=index == 0)
+                cursor.copy_expert(statement, fh)
+        finally:
+            conn.close()
+
+
+class CopyPipe:
+    """A file-like object which hands data written by a worker thread over
+    to a coroutine on the event loop.
+
+    Writes are collected into chunks of `chunk_size` bytes, and at most
+    `maxsize` chunks are in flight at any one time, so a slow reader holds
+    back the writer instead of letting the data pile up in memory.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, loop, maxsize=8):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize, loop=loop)
+        self.buffer = bytearray()
+        self.aborted = False
+
+    def write(self, data):
+        if self.aborted:
+            raise IOError("The reading end of the pipe has gone away.")
+
+        self.buffer.extend(data)
+
+        if len(self.buffer) >= self.chunk_size:
+            self._put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def close(self):
+        if self.buffer and not self.aborted:
+            self._put(bytes(self.buffer))
+            self.buffer.clear()
+
+        self._put(None)
+
+    def _put(self, item):
+        coro = self.queue.put(item)
+        asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def read(self):
+        # Returns None once the writer has closed the pipe
+        return await self.queue.get()
+
+    async def abort(self):
+        # Make the writer fail on its next write, and unblock it if it's
+        # waiting for room in the queue
+        self.aborted = True
+
+        while (await self.queue.get()) is not None:
+            pass
+
+
+class Export(web.View):
+    # The first of these is the default
+    mimetypes = media.offered(export_formats['csv'], export_formats['ndjson'])
+
+    async def get(self):
+        mimetype = AllUsers.get_best_mimetype(self.request, self.mimetypes)
+        fmt = next(k for k, v in export_formats.items() if v == mimetype)
+
+        loop = self.request.app.loop
+        args = shard_args(self.request.app['config'])
+        pipe = CopyPipe(loop)
+
+        def run():
+            try:
+                copy_export(args, fmt, pipe)
+            finally:
+                pipe.close()
+
+        worker = loop.run_in_executor(None, run)
+
+        # Wait for the first chunk before sending headers, so that failing
+        # to start the export is still reported with an error status
+        chunk = await pipe.read()
+
+        if chunk is None:
+            await worker
+
+        res = media.stream(self.request, headers={'Content-Type': mimetype})
+        await res.prepare(self.request)
+
+        try:
+            while chunk is not None:
+                res.write(chunk)
+                await res.drain()
+                chunk = await pipe.read()
+
+        except Exception:
+            await pipe.abort()
+            await asyncio.wait([worker], loop=loop)
+            worker.exception()  # the abort is expected to fail the worker
+            raise
+
+        await worker
+        return res
+
+
+def export_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='glotpod-ident-export',
+        description="Export all users, with their services, from the "
+                    "identity database."
+    )
+    parser.add_argument('-f', '--format', choices=sorted(export_formats),
+                        default='csv', help="output format (default: csv)")
+    parser.add_argument('-o', '--output',
+                        help="file to write to (default: standard output)")
+    args = parser.parse_args(argv)
+
+    db_args = shard_args(load_config())
+
+    if args.output:
+        with open(args.output, 'wb') as fh:
+            copy_export(db_args, args.format, fh)
+
+    else:
+        copy_export(db_args, args.format, sys.stdout.buffer)
+
+
+# Rows are loaded into this table before they're validated and merged into
+# the users and services tables. Everything is text at first, so that one
+# malformed value rejects its row rather than failing the whole COPY.
+staging = sa.MetaData()
+
+import_rows = sa.Table('ident_import_rows', staging,
+                       sa.Column('record', sa.Integer, primary_key=True),
+                       sa.Column('id', sa.String),
+                       sa.Column('name', sa.String),
+                       sa.Column('email', sa.String),
+                       sa.Column('github', sa.String),
+                       sa.Column('facebook', sa.String),
+                       sa.Column('user_id', sa.Integer),
+                       sa.Column('reason', sa.String),
+                       prefixes=['TEMPORARY'])
+
+import_columns = ('id', 'name', 'email', 'github', 'facebook')
+
+
+class NDJSONReader:
+    """A file-like object which reads newline-delimited user documents, in
+    the same shape as the user resource, and produces CSV rows of
+    `import_columns` plus a rejection reason for COPY to consume.
+    """
+
+    def __init__(self, fh):
+        self.documents = self.decode(fh)
+        self.buffer = b''
+
+    @staticmethod
+    def decode(fh):
+        # The documents in the file; None for any which can't be decoded
+        for line in fh:
+            if line.strip():
+                try:
+                    yield json.loads(line.decode('utf-8'))
+                except ValueError:
+                    yield None
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            doc = next(self.documents, self)
+
+            if doc is self:
+                break
+
+            self.buffer += self.convert(doc)
+
+        if size < 0:
+            size = len(self.buffer)
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def convert(self, doc):
+        try:
+            values = self.parse(doc)
+        except (TypeError, ValueError, KeyError, AttributeError):
+            values = [None] * len(import_columns) + ['invalid document']
+        else:
+            values.append(None)
+
+        out = io.StringIO()
+        csv.writer(out).writerow(values)
+        return out.getvalue().encode('utf-8')
+
+    @staticmethod
+    def parse(doc):
+        values = [doc.get('id'), doc['name'], doc['email']]
+
+        if values[0] is not None and not isinstance(values[0], int):
+            raise TypeError("id must be an integer")
+
+        if not all(isinstance(v, str) for v in values[1:]):
+            raise TypeError("name and email must be strings")
+
+        services = doc.get('services', {})
+
+        if set(services) - {'github', 'facebook'}:
+            raise KeyError("unknown service")
+
+        for key in ('github', 'facebook'):
+            if key in services:
+                sv_id = services[key]['id']
+
+                if not isinstance(sv_id, str):
+                    raise TypeError("service ids must be strings")
+
+                values.append(sv_id)
+
+            else:
+                values.append(None)
+
+        return values
+
+
+class MsgpackReader(NDJSONReader):
+    """Like `NDJSONReader`, for a stream of MessagePack user documents."""
+
+    @staticmethod
+    def decode(fh):
+        # Unlike lines of JSON, there's no telling where the next document
+        # starts after a malformed one, so that fails the whole import
+        try:
+            yield from media.msgpack.Unpacker(fh, encoding='utf-8')
+        except media.msgpack.UnpackException as e:
+            raise ValueError("invalid MessagePack input: {}".format(e))
+
+
+def _load_rows(cursor, fmt, fh):
+    # Stream the input file into the staging table
+    if fmt == 'csv':
+        header = next(csv.reader([fh.readline().decode('utf-8')]), [])
+        columns = [name.strip() for name in header]
+
+        unknown = set(columns) - set(import_columns)
+        if unknown or not {'name', 'email'} <= set(columns):
+            raise ValueError(
+                "CSV header must name the columns 'name' and 'email', and "
+                "optionally 'id', 'github' and 'facebook'."
+            )
+
+        options = "FORMAT csv"
+
+    elif fmt in ('ndjson', 'msgpack'):
+        columns = list(import_columns) + ['reason']
+        options = "FORMAT csv"
+        fh = NDJSONReader(fh) if fmt == 'ndjson' else MsgpackReader(fh)
+
+    else:
+        raise ValueError("unknown import format: {!r}".format(fmt))
+
+    cursor.copy_expert(
+        "COPY {} ({}) FROM STDIN WITH ({})".format(
+            import_rows.name, ", ".join(columns), options
+        ),
+        fh
+    )
+
+
+def _duplicates(column):
+    # True for all but the first not-yet-rejected row with each value of
+    # the column; ranking with a window keeps this from being quadratic
+    ranked = select([
+        import_rows.c.record,
+        func.row_number().over(partition_by=column,
+                               order_by=import_rows.c.record).label('rank')
+    ]).where(import_rows.c.reason.is_(None) & column.isnot(None)).alias()
+
+    return import_rows.c.record.in_(
+        select([ranked.c.record]).where(ranked.c.rank > 1)
+    )
+
+
+def _rejections():
+    # The set-wise checks run against the staging table, in order. Each
+    # is a (reason, condition) pair; a row is rejected with the reason of
+    # the first condition it meets.
+    rows = import_rows.c
+    id_value = sa.case([(rows.id.op('~')('^[0-9]{1,10}$'),
+                         sa.cast(rows.id, sa.BigInteger))])
+
+    checks = [
+        ("invalid id", rows.id.isnot(None) &
+         ~func.coalesce(id_value.between(1, 2 ** 31 - 1), False)),
+        ("missing name", rows.name.is_(None) | (rows.name == '')),
+        ("missing email", rows.email.is_(None) | (rows.email == '')),
+        ("duplicate id in input", _duplicates(rows.id)),
+        ("id already in use", exists().where(users.c.id == id_value)),
+        ("duplicate email in input", _duplicates(rows.email)),
+        ("email already in use", exists().where(
+            users.c.email_address == rows.email)),
+    ]
+
+    for sv_name, key in sorted(service_name_map.items()):
+        column = rows[key]
+        checks.extend([
+            ("duplicate {} id in input".format(key), _duplicates(column)),
+            ("{} id already in use".format(key), exists().where(
+                (services.c.sv_name == sv_name) &
+                (services.c.sv_id == column))),
+        ])
+
+    return checks
+
+
+def _array(column, values):
+    # The values, sent as one array of the column's type rather than a
+    # parameter each, to compare the column to with any() or all()
+    return sa.literal(list(values), postgresql.ARRAY(column.type))
+
+
+def _reject(conns, reason, condition):
+    # Reject the rows meeting the condition on any shard, on all of them
+    rows = import_rows.c
+    update = import_rows.update().values(reason=reason)
+
+    if len(conns) == 1:
+        conns[0].execute(update.where(rows.reason.is_(None) & condition))
+        return
+
+    rejected = set()
+
+    for conn in conns:
+        result = conn.execute(update.returning(rows.record)
+                              .where(rows.reason.is_(None) & condition))
+        rejected.update(record for record, in result)
+
+    if rejected:
+        for conn in conns:
+            conn.execute(update.where(
+                rows.reason.is_(None) &
+                (rows.record == func.any(_array(rows.record, rejected)))
+            ))
+
+
+def _route_rows(conns):
+    # Leave each shard only the accepted rows which go to it: those with
+    # an id to the shard it says, and the rest to the shard of their email
+    # address, as the service would route them
+    rows = import_rows.c
+    accepted = rows.reason.is_(None)
+    router = ShardRouter(len(conns))
+    records = [[] for _ in conns]
+
+    for record, id, email in conns[0].execute(
+            select([rows.record, rows.id, rows.email]).where(accepted)):
+        if id is None:
+            records[router.for_email(email)].append(record)
+        else:
+            records[router.for_id(int(id))].append(record)
+
+    for conn, mine in zip(conns, records):
+        conn.execute(import_rows.delete().where(
+            accepted & (rows.record != func.all(_array(rows.record, mine)))
+        ))
+
+
+def _copy_rows(source, targets):
+    # Copy the staged rows from one connection to the others, by way of a
+    # temporary file
+    with tempfile.TemporaryFile() as fh:
+        with source.connection.cursor() as cursor:
+            cursor.copy_expert("COPY {} TO STDOUT".format(import_rows.name),
+                               fh)
+
+        for conn in targets:
+            fh.seek(0)
+
+            with conn.connection.cursor() as cursor:
+                cursor.copy_expert(
+                    "COPY {} FROM STDIN".format(import_rows.name), fh
+                )
+
+
+def _merge_rows(conn, shard):
+    rows = import_rows.c
+    accepted = rows.reason.is_(None)
+    seq = conn.scalar(select([func.pg_get_serial_sequence('users', 'id')]))
+
+    # Move the id sequence past any ids given explicitly, then allocate ids
+    # to the remaining rows. Of shard `index` of `count`, ids are its own
+    # sequence times the number of shards, plus its index.
+    index, count = shard
+    max_id = conn.scalar(select([func.max(sa.cast(rows.id, sa.Integer))])
+                         .where(accepted))
+    if max_id is not None:
+        max_value = (max_id - index) // count
+        last_value, is_called = conn.execute(
+            "SELECT last_value, is_called FROM {}".format(seq)
+        ).first()
+        if max_value > (last_value if is_called else last_value - 1):
+            conn.execute(select([func.setval(seq, max_value)]))
+
+    conn.execute(import_rows.update().where(accepted).values(
+        user_id=sa.case([(rows.id.is_(None),
+                          func.nextval(seq) * count + index)],
+                        else_=sa.cast(rows.id, sa.Integer))
+    ))
+
+    result = conn.execute(users.insert().from_select(
+        ['id', 'name', 'email_address'],
+        select([rows.user_id, rows.name, rows.email])
+        .where(accepted).order_by(rows.record)
+    ))
+    counts = {'users': result.rowcount, 'services': 0}
+
+    for sv_name, key in service_name_map.items():
+        sv_value = sa.cast(sa.literal(sv_name), services.c.sv_name.type)
+        result = conn.execute(services.insert().from_select(
+            ['user_id', 'sv_id', 'sv_name'],
+            select([rows.user_id, rows[key], sv_value])
+            .where(accepted & rows[key].isnot(None))
+        ))
+        counts['services'] += result.rowcount
+
+    return counts
+
+
+def copy_import(shards, fmt, fh, rejects=None):
+    """Load users, with their services, from the file-like object `fh` into
+    the databases with the connection arguments `shards`, as `shard_args`
+    gives them.
+
+    The input has the same shape as an export: either CSV with the columns
+    of `import_columns` (only `name` and `email` are required), or
+    newline-delimited user documents. Rows which would violate a constraint
+    of the users or services tables, in any shard, are skipped, and written
+    as CSV to the file-like object `rejects` if one is given. Everything
+    else goes to the shard the service would put it in, and is merged in a
+    single transaction on each shard; with no two-phase commit, those are
+    committed one after another.
+
+    Returns a dict with the number of users and services imported, and the
+    number of rows rejected.
+    """
+    engines = [sa.create_engine('postgresql+psycopg2://', poolclass=NullPool,
+                                creator=partial(psycopg2.connect, **args))
+               for args in shards]
+
+    with ExitStack() as stack:
+        conns = [stack.enter_context(engine.begin()) for engine in engines]
+        first = conns[0]
+
+        for conn in conns:
+            conn.execute(sa.schema.CreateTable(import_rows))
+
+        with first.connection.cursor() as cursor:
+            _load_rows(cursor, fmt, fh)
+
+        rows = import_rows.c
+        first.execute(import_rows.update().values(
+            id=func.nullif(func.trim(rows.id), ''),
+            name=func.trim(rows.name),
+            email=func.trim(rows.email),
+            github=func.nullif(func.trim(rows.github), ''),
+            facebook=func.nullif(func.trim(rows.facebook), '')
+        ))
+
+        if len(conns) > 1:
+            # Every shard checks the rows against its own users
+            _copy_rows(first, conns[1:])
+
+        for conn in conns:
+            conn.execute("ANALYZE {}".format(import_rows.name))
+
+            # Keep concurrent writers out while checking against existing
+            # rows; always in the same order of shards
+            conn.execute("LOCK TABLE {}, {} IN SHARE ROW EXCLUSIVE MODE"
+                         .format(users.name, services.name))
+
+        for reason, condition in _rejections():
+            _reject(conns, reason, condition)
+
+        counts = {
+            'rejected': first.scalar(
+                select([func.count()]).where(rows.reason.isnot(None))
+            )
+        }
+
+        if rejects is not None:
+            query = select([rows.record, rows.reason] +
+                           [rows[name] for name in import_columns]) \
+                .where(rows.reason.isnot(None)).order_by(rows.record)
+
+            with first.connection.cursor() as cursor:
+                compiled = query.compile(dialect=PGDialect_psycopg2())
+                query = cursor.mogrify(str(compiled), compiled.params)
+                cursor.copy_expert(
+                    "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+                    .format(query.decode(cursor.connection.encoding)),
+                    rejects
+                )
+
+        if len(conns) > 1:
+            _route_rows(conns)
+
+        counts.update(users=0, services=0)
+
+        for index, conn in enumerate(conns):
+            merged = _merge_rows(conn, (index, len(conns)))
+            counts['users'] += merged['users']
+            counts['services'] += merged['services']
+
+            conn.execute(sa.schema.DropTable(import_rows))
+
+    return counts
+
+
+def import_main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='glotpod-ident-import',
+        description="Import users, with their services, into the identity "
+                    "database."
+    )
+    parser.add_argument('input', help="file to read from ('-' for standard "
+                                      "input)")
+    parser.add_argument('-f', '--format', choices=sorted(export_formats),
+                        default='csv', help="input format (default: csv)")
+    parser.add_argument('-r', '--rejects',
+                        help="file to write rejected rows to, as CSV")
+    args = parser.parse_args(argv)
+
+    db_args = shard_args(load_config())
+
+    fh = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+
+    try:
+        if args.rejects:
+            with open(args.rejects, 'wb') as rejects:
+                counts = copy_import(db_args, args.format, fh, rejects)
+        else:
+            counts = copy_import(db_args, args.format, fh)
+
+    except ValueError as e:
+        parser.error(str(e))
+
+    finally:
+        if fh is not sys.stdin.buffer:
+            fh.close()
+
+    print("Imported {users} users and {services} services; rejected "
+          "{rejected} rows.".format(**counts), file=sys.stderr)
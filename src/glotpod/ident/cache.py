@@ -0,0 +1,72 @@
+import asyncio
+
+from collections import OrderedDict
+
+
+__all__ = ['ResponseCache']
+
+
+class ResponseCache:
+    """Response bodies, already serialised, kept for `ttl` seconds.
+
+    At most `max_bytes` of bodies are kept; the least recently used go
+    first. Every write invalidates the whole cache, and a body fetched
+    while a write happened isn't kept: put() takes the `version` the cache
+    was at when the fetch began.
+    """
+
+    def __init__(self, *, ttl=5, max_bytes=16 * 1024 * 1024, loop=None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.loop = loop or asyncio.get_event_loop()
+
+        # key -> (expiry time, body), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+
+        if entry is not None:
+            if entry[0] > self.loop.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            self.drop(key)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, body, version):
+        if version != self.version or len(body) > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self.drop(key)
+
+        self.entries[key] = (self.loop.time() + self.ttl, body)
+        self.size += len(body)
+
+        while self.size > self.max_bytes:
+            self.drop(next(iter(self.entries)))
+
+    def drop(self, key):
+        expiry, body = self.entries.pop(key)
+        self.size -= len(body)
+
+    def invalidate(self):
+        self.version += 1
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return {'entries': len(self.entries), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None}
@@ -0,0 +1,232 @@
+"""The change feed: the users created and patched, in the order those
+changes were committed, after a cursor.
+
+GET /changes?after=<cursor> answers with the changes after the cursor, up
+to `limit` of them, and the cursor to ask after next. With `wait`, it waits
+up to that many seconds for a change when there's none yet (long-polling).
+Clients accepting text/event-stream get the changes as Server-Sent Events
+instead, as they're made, resuming after the Last-Event-ID they send. With
+users in shards, each shard has its own changes, picked with `shard`.
+
+Waiting requests don't hold a database connection: they're woken up by the
+writes of this process, and, with Postgres, by a listener for the
+notifications the writes of every process send when they're committed.
+"""
+import asyncio
+import json
+import logging
+
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+from glotpod.ident import media, validation
+from glotpod.ident.handlers import AllUsers
+from glotpod.ident.storage import changes_channel
+
+
+__all__ = ['ChangeFeed', 'Changes']
+
+log = logging.getLogger(__name__)
+
+event_stream_type = 'text/event-stream'
+
+
+class ChangeFeed:
+    """Wakes up the requests waiting for changes.
+
+    Waiters take the current `changed` event before looking for changes,
+    then wait for it to be set; notify() sets it, and replaces it with a
+    new one for the next round, so a change made in between isn't missed.
+    """
+
+    def __init__(self, *, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.changed = asyncio.Event(loop=self.loop)
+
+        self.waiting = 0
+        self.notifications = 0
+        # How many databases are being listened to
+        self.listening = 0
+
+    def notify(self):
+        """Wake up everyone waiting for changes."""
+        changed, self.changed = self.changed, asyncio.Event(loop=self.loop)
+        changed.set()
+        self.notifications += 1
+
+    async def wait(self, changed, timeout):
+        """Wait up to `timeout` seconds for `changed` to be set; return
+        whether it was."""
+        self.waiting += 1
+
+        try:
+            await asyncio.wait_for(changed.wait(), timeout, loop=self.loop)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+
+    async def listen(self, engine, *, retry_interval=5, check_interval=30):
+        # Notify on the changes committed by any process, for as long as
+        # this runs. The connection is kept out of the pool for good
+        while True:
+            try:
+                async with engine.acquire() as conn:
+                    try:
+                        await self.receive(conn, check_interval)
+                    finally:
+                        # Don't give the pool a connection still listening
+                        conn.connection.close()
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                log.exception("Lost the change notifications; listening "
+                              "again in %ss.", retry_interval)
+
+            await asyncio.sleep(retry_interval, loop=self.loop)
+
+    async def receive(self, conn, check_interval):
+        await conn.execute('LISTEN {}'.format(changes_channel))
+        notifies = conn.connection.notifies
+
+        # Changes may have been made while we weren't listening
+        self.listening += 1
+        self.notify()
+
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(notifies.get(), check_interval,
+                                           loop=self.loop)
+                except asyncio.TimeoutError:
+                    # Make sure the connection is still there
+                    await conn.execute('SELECT 1')
+                    continue
+
+                # One wake-up does for every notification so far
+                while not notifies.empty():
+                    notifies.get_nowait()
+
+                self.notify()
+
+        finally:
+            self.listening -= 1
+
+    def stats(self):
+        return {'waiting': self.waiting, 'notifications': self.notifications,
+                'listening': self.listening}
+
+
+def event(record):
+    # A change as a Server-Sent Event
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        record.cursor, record.representation()['type'],
+        json.dumps(record.user)
+    ).encode('utf-8')
+
+
+class Changes(web.View):
+    async def get(self):
+        # Streaming is only for clients which ask for it by name, as
+        # EventSource does, not any that take whatever they're given
+        streaming = event_stream_type in self.request.headers.get('Accept',
+                                                                  '')
+        mimetype = AllUsers.get_best_mimetype(self.request, media.offered(
+            media.json_type
+        )) if not streaming else event_stream_type
+
+        try:
+            params = validation.change_params(
+                dict(parse_qsl(self.request.query_string))
+            )
+        except validation.Invalid:
+            raise web.HTTPBadRequest
+
+        cfg = self.request.app['config'].get('changes', {})
+        after = params.get('after', 0)
+        limit = params.get('limit', 100)
+        shard = params.get('shard', 0)
+
+        # Each shard of the users has its own changes
+        if shard >= self.request['storage'].shards:
+            raise web.HTTPNotFound
+
+        if streaming:
+            try:
+                after = int(self.request.headers.get('Last-Event-ID', after))
+            except ValueError:
+                raise web.HTTPBadRequest
+
+            return await self.stream(after, limit, shard, cfg)
+
+        wait = min(params.get('wait', 0), cfg.get('max_wait', 30))
+        records = await self.poll(after, limit, shard, self.until(wait))
+
+        return media.response(mimetype, {
+            'changes': [record.representation() for record in records],
+            'cursor': records[-1].cursor if records else after,
+        })
+
+    def until(self, wait):
+        # When to stop waiting: after `wait` seconds, or just before the
+        # request's deadline, if that's sooner
+        loop = self.request.app.loop
+        deadline = getattr(self.request['storage'], 'deadline', None)
+        until = loop.time() + wait
+
+        if deadline is not None:
+            until = min(until, deadline - 1)
+
+        return until
+
+    async def fetch(self, after, limit, shard):
+        async with self.request['storage'].session() as session:
+            return await session.list_changes(after, limit, shard=shard)
+
+    async def poll(self, after, limit, shard, until):
+        # The changes after `after`, waiting for some until `until`
+        feed = self.request.app['changes']
+
+        while True:
+            changed = feed.changed
+            records = await self.fetch(after, limit, shard)
+            remaining = until - self.request.app.loop.time()
+
+            if records or remaining <= 0:
+                return records
+
+            await feed.wait(changed, remaining)
+
+    async def stream(self, after, limit, shard, cfg):
+        # Send changes as they're made, in batches of up to `limit`, until
+        # the client goes away or the request's deadline; then the client
+        # reconnects with the last id it got
+        loop = self.request.app.loop
+        heartbeat = cfg.get('heartbeat', 15)
+        until = self.until(float('inf'))
+
+        res = media.stream(self.request, headers={
+            'Content-Type': event_stream_type + '; charset=utf-8',
+            'Cache-Control': 'no-cache'
+        })
+        await res.prepare(self.request)
+
+        while loop.time() < until:
+            records = await self.poll(
+                after, limit, shard, min(until, loop.time() + heartbeat)
+            )
+
+            if records:
+                res.write(b''.join(event(record) for record in records))
+                after = records[-1].cursor
+            else:
+                # Keep the connection, and any proxies on the way, open
+                res.write(b':\n\n')
+
+            await res.drain()
+
+        return res
@@ -0,0 +1,81 @@
+import asyncio
+
+from functools import partial
+
+
+__all__ = ['SingleFlight']
+
+
+class SingleFlight:
+    """Coalesces concurrent fetches of the same thing.
+
+    Each fetch is identified by a key, a tuple whose first item is the kind
+    of thing being fetched. A caller asking for a key that's already being
+    fetched waits for that fetch and gets its result, instead of starting
+    another; so a hundred concurrent reads of one user take one connection
+    and one query between them. Results are shared, and mustn't be changed.
+    The fetch is cancelled if every caller waiting for it is.
+    """
+
+    def __init__(self, *, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.flights = {}
+
+        # flight -> how many callers are waiting for it
+        self.waiting = {}
+
+        self.started = 0
+        self.joined = 0
+
+    async def run(self, key, fetch):
+        """The result of the coroutine function `fetch`, called now unless
+        there's a fetch for `key` in flight already."""
+        flight = self.flights.get(key)
+
+        if flight is None:
+            flight = asyncio.ensure_future(fetch(), loop=self.loop)
+            flight.add_done_callback(partial(self._landed, key))
+            self.flights[key] = flight
+            self.started += 1
+        else:
+            self.joined += 1
+
+        self.waiting[flight] = self.waiting.get(flight, 0) + 1
+
+        try:
+            # One caller going away mustn't cancel the fetch for the others
+            return await asyncio.shield(flight, loop=self.loop)
+
+        except asyncio.CancelledError:
+            # ...but once they've all gone, it's fetching for no one
+            if self.waiting[flight] == 1:
+                flight.cancel()
+            raise
+
+        finally:
+            self.waiting[flight] -= 1
+
+            if not self.waiting[flight]:
+                del self.waiting[flight]
+
+    def _landed(self, key, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+        # Everyone waiting may have gone; don't complain about the exception
+        if not flight.cancelled():
+            flight.exception()
+
+    def forget(self, kind, *key):
+        """Stop sharing the fetches in flight for `key`, or for every key of
+        this kind. A write calls this once it's committed, so that reads
+        which start after it don't get results from before it."""
+        if key:
+            self.flights.pop((kind,) + key, None)
+        else:
+            for k in [k for k in self.flights if k[0] == kind]:
+                del self.flights[k]
+
+    def stats(self):
+        return {'in_flight': len(self.flights), 'started': self.started,
+                'joined': self.joined}
@@ -0,0 +1,50 @@
+from os import environ
+
+
+def load_config():
+    defaults = {
+        'database': {}
+    }
+
+    if 'IDENT_SETTINGS' in environ:
+        import toml
+
+        with open(environ['IDENT_SETTINGS']) as fh:
+            text = fh.read()
+            defaults.update(toml.loads(text))
+
+    return defaults
+
+
+def database_args(config):
+    # Connection arguments for Postgres, as accepted by both psycopg2.connect
+    # and aiopg.sa.create_engine
+    default_args = {'database': 'glotpod.ident', 'user': 'postgres'}
+    return config.get('database', {}).get('postgres', default_args)
+
+
+def shard_args(config):
+    # Connection arguments for each shard of the users, in order: those of
+    # database.postgres, with the keys of each of database.shards in turn,
+    # or just the one database if there are no shards
+    shards = config.get('database', {}).get('shards', [])
+    return [dict(database_args(config), **shard) for shard in shards] or \
+        [database_args(config)]
+
+
+def pool_args(config):
+    # Sizing of the pool of Postgres connections, for aiopg.sa.create_engine
+    pool = config.get('database', {}).get('pool', {})
+    return {k: pool[k] for k in ('minsize', 'maxsize') if k in pool}
+
+
+def encryption_keys(config):
+    # The keys access tokens are decrypted with: database.encryption_key,
+    # which they're encrypted with too, then database.old_encryption_keys
+    database = config.get('database', {})
+
+    if 'encryption_key' not in database:
+        return []
+
+    return [database['encryption_key']] + \
+        list(database.get('old_encryption_keys', []))
@@ -0,0 +1,271 @@
+"""Encryption of the access tokens users have on external services.
+
+Tokens are stored encrypted with Fernet, under the first of the configured
+keys. The others are old keys: tokens are still decrypted with them, until
+reencrypt() has encrypted them again under the first, which the
+glotpod-ident-rotate-tokens command does when the keys have changed.
+Decrypted tokens are kept in memory for a little while, so that reading a
+user again doesn't decrypt them again. Tokens under a key which has been
+removed can't be decrypted any more; they're read as if there were none.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+
+from collections import OrderedDict
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from sqlalchemy.sql import select
+
+from glotpod.ident.config import encryption_keys, load_config, shard_args
+from glotpod.ident.model import services
+
+
+__all__ = ['TokenCipher', 'reencrypt', 'rotate_main']
+
+log = logging.getLogger(__name__)
+
+
+class TokenCipher:
+    """Encrypts tokens under the first of `keys`, and decrypts them under
+    any of them.
+
+    Decrypted tokens are kept by their ciphertext for `ttl` seconds, up to
+    `cache_size` of them. When more than `inline_limit` tokens which aren't
+    kept are decrypted at once, as for a list of users, it's done in a
+    thread, so as not to hold up the event loop.
+    """
+
+    def __init__(self, keys, *, ttl=60, cache_size=10000, inline_limit=10,
+                 loop=None):
+        self.primary = Fernet(keys[0])
+        self.fernet = MultiFernet([Fernet(key) for key in keys])
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.inline_limit = inline_limit
+        self.loop = loop or asyncio.get_event_loop()
+
+        # ciphertext -> (token, expiry), least recently used first
+        self.cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalid = 0
+
+    def encrypt(self, token):
+        return self.fernet.encrypt(token.encode('utf-8')).decode('ascii')
+
+    def _decrypt(self, ciphertext):
+        try:
+            data = self.fernet.decrypt(ciphertext.encode('ascii'))
+        except InvalidToken:
+            return None
+
+        return data.decode('utf-8')
+
+    def cached(self, ciphertext):
+        # The token kept for the ciphertext, or None
+        entry = self.cache.get(ciphertext)
+
+        if entry is None:
+            return None
+
+        token, expiry = entry
+
+        if expiry <= self.loop.time():
+            del self.cache[ciphertext]
+            return None
+
+        self.cache.move_to_end(ciphertext)
+        return token
+
+    def keep(self, ciphertext, token):
+        self.cache[ciphertext] = (token, self.loop.time() + self.ttl)
+        self.cache.move_to_end(ciphertext)
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def decrypt(self, ciphertexts):
+        """The tokens of a list of ciphertexts, in order; None for any which
+        are None, or can't be decrypted with any of the keys."""
+        tokens = {}
+        missing = []
+        seen = {None}
+
+        for ciphertext in ciphertexts:
+            if ciphertext in seen:
+                continue
+
+            seen.add(ciphertext)
+            token = self.cached(ciphertext)
+
+            if token is None:
+                missing.append(ciphertext)
+            else:
+                tokens[ciphertext] = token
+
+        self.hits += len(tokens)
+        self.misses += len(missing)
+
+        if len(missing) > self.inline_limit:
+            decrypted = await self.loop.run_in_executor(
+                None, lambda: [self._decrypt(c) for c in missing]
+            )
+        else:
+            decrypted = [self._decrypt(c) for c in missing]
+
+        invalid = 0
+
+        for ciphertext, token in zip(missing, decrypted):
+            if token is None:
+                invalid += 1
+                continue
+
+            self.keep(ciphertext, token)
+            tokens[ciphertext] = token
+
+        if invalid:
+            self.invalid += invalid
+            log.warning("Couldn't decrypt %s access tokens with any of the "
+                        "keys; they're left out.", invalid)
+
+        return [tokens.get(ciphertext) for ciphertext in ciphertexts]
+
+    def rotate(self, ciphertexts):
+        """The ciphertexts encrypted again under the first key, None for
+        those which already are, or can't be decrypted with any of the keys;
+        and how many couldn't be. This blocks; run it in an executor, and
+        count the invalid ones back on the loop."""
+        rotated = []
+        invalid = 0
+
+        for ciphertext in ciphertexts:
+            data = ciphertext.encode('ascii')
+
+            try:
+                self.primary.decrypt(data)
+            except InvalidToken:
+                pass
+            else:
+                rotated.append(None)
+                continue
+
+            try:
+                data = self.fernet.encrypt(self.fernet.decrypt(data))
+            except InvalidToken:
+                invalid += 1
+                rotated.append(None)
+            else:
+                rotated.append(data.decode('ascii'))
+
+        return rotated, invalid
+
+    def stats(self):
+        looked_up = self.hits + self.misses
+        return {'cached': len(self.cache), 'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / looked_up if looked_up else None,
+                'invalid': self.invalid}
+
+
+async def reencrypt(engine, cipher, *, batch_size=100, loop=None):
+    """Encrypt the tokens in the database which are under old keys again,
+    under the first, `batch_size` or so at a time. Returns how many were."""
+    loop = loop or asyncio.get_event_loop()
+    encrypted = services.c.access_token.isnot(None)
+    after = count = 0
+
+    while True:
+        users = select([services.c.user_id]) \
+            .where(encrypted & (services.c.user_id > after)) \
+            .order_by(services.c.user_id).limit(batch_size)
+        query = select([services.c.user_id, services.c.sv_name,
+                        services.c.access_token]) \
+            .where(encrypted & services.c.user_id.in_(users)) \
+            .order_by(services.c.user_id)
+
+        async with engine.acquire() as conn:
+            rows = []
+
+            async for row in conn.execute(query):
+                rows.append((row['user_id'], row['sv_name'],
+                             row['access_token']))
+
+            if not rows:
+                break
+
+            after = rows[-1][0]
+            rotated, invalid = await loop.run_in_executor(
+                None, cipher.rotate, [row[2] for row in rows]
+            )
+            cipher.invalid += invalid
+
+            for (user_id, sv_name, old), new in zip(rows, rotated):
+                if new is None:
+                    continue
+
+                # Unless the token has been changed since
+                result = await conn.execute(services.update().where(
+                    (services.c.user_id == user_id) &
+                    (services.c.sv_name == sv_name) &
+                    (services.c.access_token == old)
+                ).values(access_token=new))
+                count += result.rowcount
+
+    log.info("Encrypted %s access tokens again under the current key.",
+             count)
+    return count
+
+
+async def reencrypt_shards(shards, cipher, *, batch_size=100, loop=None):
+    # Run reencrypt() on the database of each of the connection arguments
+    # `shards`, in turn; returns how many tokens were encrypted again
+    import aiopg.sa
+
+    loop = loop or asyncio.get_event_loop()
+    count = 0
+
+    for args in shards:
+        engine = await aiopg.sa.create_engine(loop=loop, **args)
+
+        try:
+            count += await reencrypt(engine, cipher, batch_size=batch_size,
+                                     loop=loop)
+        finally:
+            engine.close()
+            await engine.wait_closed()
+
+    return count
+
+
+def rotate_main(argv=None):
+    config = load_config()
+    database_cfg = config.get('database', {})
+
+    parser = argparse.ArgumentParser(
+        prog='glotpod-ident-rotate-tokens',
+        description="Encrypt the access tokens stored under old keys again, "
+                    "under the current key, in every shard of the database."
+    )
+    parser.add_argument('-b', '--batch-size', type=int,
+                        default=database_cfg.get('rotation_batch_size', 100),
+                        help="how many tokens to encrypt again at a time "
+                             "(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    keys = encryption_keys(config)
+
+    if not keys:
+        parser.error("database.encryption_key isn't configured")
+
+    loop = asyncio.get_event_loop()
+    cipher = TokenCipher(keys, loop=loop)
+    count = loop.run_until_complete(reencrypt_shards(
+        shard_args(config), cipher, batch_size=args.batch_size, loop=loop
+    ))
+
+    print("Encrypted {} access tokens again under the current key; {} "
+          "couldn't be decrypted.".format(count, cipher.invalid),
+          file=sys.stderr)
@@ -4,3 +4,18 @@ from aiohttp.web import HTTPException
 class HTTPUnprocessableEntity(HTTPException):
     status_code = 422
     reason = "Unprocessable Entity"
+
+
+class Conflict(Exception):
+    """Raised by storage when a write would duplicate an email address, or
+    a user's id on a service."""
+
+
+class NoEncryptionKey(Exception):
+    """Raised by storage when asked to store an access token, with no
+    database.encryption_key to encrypt it with."""
+
+
+class Timeout(Exception):
+    """Raised by storage when a statement runs past the deadline of the
+    request it's for."""
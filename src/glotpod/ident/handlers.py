@@ -1,60 +1,94 @@
+import json
+
 import jsonpatch
 
+from functools import partial
 from urllib.parse import parse_qsl
 
 from aiohttp import web
 from mimetype_match import AcceptHeader
-from psycopg2 import IntegrityError, errorcodes
-from sqlalchemy.sql import select, desc, func
-from voluptuous import All, Any, Coerce, Schema, Range, Required, Remove, \
-    Length, MultipleInvalid
 
-from glotpod.ident import errors
-from glotpod.ident.model import users, services
+from glotpod.ident import errors, media, records, validation
 
 
-__all__ = ['AllUsers', 'User']
+__all__ = ['AllUsers', 'User', 'AccessTokens']
 
-service_name_map = {'fb': 'facebook', 'gh': 'github'}
 
+async def read(request, key, fetch):
+    """The result of the coroutine function `fetch`, shared with any
+    concurrent reads of the same key, and the headers to send with it.
 
-class AllUsers(web.View):
-    params_schema = Schema({
-        'name': str,
-        'email': str,
-        'page_size': All(Coerce(int), Range(min=1)),
-        'after_id': All(Coerce(int), Range(min=1)),
-        'before_id': All(Coerce(int), Range(min=1)),
-        'first': str
-    })
+    The first item of `key` is the name of the route, which may be
+    configured to serve stale results when fetching fails. `fetch` is
+    called with the storage to fetch from: the app's, not the request's,
+    since the fetch may be shared with other requests, or go on refreshing
+    a stale result after this one's finished. This request still gives up
+    on it at its deadline, and it's cancelled once nobody's waiting on it.
+    """
+    fetch = partial(fetch, request.app['storage'])
 
-    @staticmethod
-    def build_query(params, full=False):
-        columns = [users.c.id, users.c.name, users.c.email_address] if full \
-                  else [users.c.id]
+    def shared():
+        return request.app['reads'].run(key, fetch)
 
-        query = select(columns)
+    cache = request.app['stale'].get(key[0])
 
-        query = query.order_by(users.c.id)
+    if cache is None:
+        return await shared(), {}
 
-        if 'email' in params:
-            query = query.where(users.c.email_address == params['email'])
+    return await cache.get(key, shared)
 
-        if 'name' in params:
-            search_string = " & ".join(
-                "{}:*".format(word) for word in params['name'].split(' ')
-            )
-            name_vector = func.to_tsvector(users.c.name)
 
-            query = query.where(name_vector.match(search_string))
-            query = query.order_by(
-                desc(func.ts_rank(name_vector, func.to_tsquery(search_string)))
-            )
+def forget(app, route, *key):
+    # Writes call this once committed, so that later reads don't get
+    # results from before them
+    app['reads'].forget(route, *key)
+    cache = app['stale'].get(route)
+
+    if cache is not None:
+        cache.forget((route,) + key if key else None)
+
+    cache = app['response_cache'].get(route)
+
+    if cache is not None:
+        cache.invalidate()
+
+
+def after_commit(request, callback):
+    """Call `callback`, which makes the changes of a write known, once the
+    write is committed: now, or at the end of the batch it's part of."""
+    pending = request.get('after_commit')
+
+    if pending is None:
+        callback()
+    else:
+        pending.append(callback)
+
+
+def user_id(request):
+    # The id of the user a request is for, from its route
+    try:
+        return int(request.match_info['id'])
+    except (TypeError, ValueError):
+        raise web.HTTPNotFound
+
+
+def index_name(app, id, name):
+    # Keep the typeahead index, if there is one, up to date
+    index = app.get('prefix_index')
 
-        # if 'page_size' in params:
-        #     query = query.limit(params['page_size'])
-        return query
+    if index is not None:
+        index.set(id, name)
 
+
+def changed(app):
+    # Wake up the requests waiting on the change feed
+    feed = app.get('changes')
+
+    if feed is not None:
+        feed.notify()
+
+
+class AllUsers(web.View):
     @staticmethod
     def get_best_mimetype(request, mimetypes):
         # Get the best matching mimetype from the given set, or raise an http
@@ -66,43 +100,70 @@ class AllUsers(web.View):
             if match is None:
                 raise web.HTTPNotAcceptable
 
-            else:
-                return match[1]
+            # MessagePack is only for clients which prefer it; on a tie, as
+            # with */*, the types offered before it win
+            if match[1] == media.msgpack_type:
+                other = accept.get_best_match([
+                    mimetype for mimetype in mimetypes
+                    if mimetype != media.msgpack_type
+                ])
+
+                if other is not None and not match[0] > other[0]:
+                    return other[1]
+
+            return match[1]
 
         else:
             return mimetypes[0]
 
     async def get(self):
-        mimetype = self.get_best_mimetype(self.request, [
-            'application/json', 'application/vnd.glotpod.resource-url+json'
-        ])
-        query = self.build_query(self.params, mimetype == 'application/json')
-        results = []
+        mimetype = self.get_best_mimetype(self.request, media.offered(
+            media.json_type, 'application/vnd.glotpod.resource-url+json'
+        ))
+        full = mimetype != 'application/vnd.glotpod.resource-url+json'
+        charset = None if mimetype == media.msgpack_type else 'utf-8'
+        params = self.params
 
-        async with self.request['db_pool'].acquire() as conn:
-            async for row in conn.execute(query):
-                item = {col: row[col] for col in row
-                        if col in ('id', 'name', 'email_address')}
+        async def fetch(storage):
+            async with storage.session() as session:
+                return await session.list_users(params, full=full)
 
-                if mimetype == 'application/json':
-                    item['email'] = item.pop('email_address')
-                    item['services'] = {}
+        key = ('user-list', tuple(sorted(params.items())), full)
+        cache = self.request.app['response_cache'].get('user-list')
 
-                    qry = services.select().where(
-                        services.c.user_id == row['id'])
+        # Repeated searches may be answered with the body sent last time
+        if cache is not None:
+            body = cache.get(key + (mimetype,))
 
-                    async for service_row in conn.execute(qry):
-                        name = service_name_map[service_row['sv_name']]
-                        item['services'][name] = {'id': service_row['sv_id']}
+            if body is not None:
+                return web.Response(body=body, content_type=mimetype,
+                                    charset=charset)
 
-                else:
-                    item = "/{}".format(row['id'])
+            version = cache.version
 
-                results.append(item)
+        results, headers = await read(self.request, key, fetch)
 
-            return web.json_response(results, content_type=mimetype)
+        if mimetype == media.msgpack_type:
+            body = media.encode(mimetype, [record.representation()
+                                           for record in results])
+        elif full:
+            body = records.json_list(results).encode('utf-8')
+        else:
+            body = json.dumps(["/{}".format(id) for id in results]) \
+                .encode('utf-8')
+
+        # ...unless it was served from the stale cache
+        if cache is not None and not headers:
+            cache.put(key + (mimetype,), body, version)
+
+        return web.Response(body=body, content_type=mimetype,
+                            charset=charset, headers=headers)
 
     async def post(self):
+        mimetype = self.get_best_mimetype(self.request, media.offered(
+            media.json_type
+        ))
+
         try:
             # Make sure the incoming data is in a valid format
             # if request.content_type == "application/x-www-form-urlencoded":
@@ -112,195 +173,176 @@ class AllUsers(web.View):
             #     data = user_schema(await request.json())
 
             # fixme: no standard on nested data structures with urlencoded
-            data = User.schema(await self.request.json())
+            data = validation.user(await media.read(self.request))
+            data.setdefault('services', {})
 
-            # Get a database connection from the pool
-            async with self.request['db_pool'].acquire() as conn:
+            async with self.request['storage'].session() as session:
                 # Create a transaction for the insertion queries; this
                 # is an all or nothing deal
-                async with conn.begin():
-                    # Construct the insert query to create the user object
-                    query = users.insert().values(
-                        name=data['name'],
-                        email_address=data['email']
-                    )
-                    user_id = await conn.scalar(query.returning(users.c.id))
-
-                    data.setdefault('services', {})
-
-                    if 'facebook' in data['services']:
-                        await conn.execute(
-                            services.insert().values(
-                                user_id=user_id,
-                                sv_name='fb',
-                                sv_id=data['services']['facebook']['id']
-                            )
-                        )
-
-                    if 'github' in data['services']:
-                        await conn.execute(
-                            services.insert().values(
-                                user_id=user_id,
-                                sv_name='gh',
-                                sv_id=data['services']['github']['id']
-                            )
-                        )
-
-        except MultipleInvalid:
+                async with session.begin():
+                    user_id = await session.create_user(data)
+
+        except validation.Invalid:
             raise web.HTTPBadRequest
 
-        except IntegrityError as e:
-            if e.pgcode == errorcodes.UNIQUE_VIOLATION:
-                raise web.HTTPConflict
-            else:
-                raise
+        except errors.Conflict:
+            raise web.HTTPConflict
+
+        except errors.NoEncryptionKey:
+            # Access tokens can't be stored without a key to encrypt them
+            raise errors.HTTPUnprocessableEntity
 
         else:
+            app = self.request.app
+
             # Construct the
             data['id'] = user_id
 
             # Construct a URL to the resource
-            user_url = self.request.app.router.named_resources()['user'].url(
+            user_url = app.router.named_resources()['user'].url(
                 parts={'id': user_id}
             )
 
             # ... and headers
             headers = {'Location': user_url}
 
-            # Send a notification about the creation of this user
-            self.request.app['subscribers'].notify(
-                user_id, 'urn:glotpod:user:new', 'user+n', data
-            )
+            def committed():
+                forget(app, 'user', user_id)
+                forget(app, 'user-list')
+                index_name(app, user_id, data['name'])
+                changed(app)
+
+                # Send a notification about the creation of this user,
+                # without the secrets in it
+                app['subscribers'].notify(
+                    user_id, 'urn:glotpod:user:new', 'user+n',
+                    records.redact(data)
+                )
+
+            after_commit(self.request, committed)
 
-            return web.json_response({'id': user_id}, status=201,
-                                     headers=headers)
+            return media.response(mimetype, {'id': user_id}, status=201,
+                                  headers=headers)
 
     @property
     def params(self):
         try:
             items = dict(parse_qsl(self.request.query_string))
-            return self.params_schema(items)
-        except MultipleInvalid:
+            return validation.user_list_params(items)
+        except validation.Invalid:
             raise web.HTTPBadRequest
 
 
 class User(web.View):
-    schema = Schema({
-        Remove('id'): int,
-        Required('name'): All(str, str.strip, Length(min=1)),
-        Required('email'): All(str, str.strip, Length(min=1)),
-        'services': {
-            Any('github', 'facebook'): {
-                Required('id'): All(str, str.strip, Length(min=1))
-            }
-        },
-    })
-
     async def get(self):
-        async with self.request['db_pool'].acquire() as conn:
-            return web.json_response(await self.get_user_data(conn))
+        mimetype = AllUsers.get_best_mimetype(self.request, media.offered(
+            media.json_type
+        ))
+        id = self.id
+
+        async def fetch(storage):
+            async with storage.session() as session:
+                return await session.get_user(id)
+
+        record, headers = await read(self.request, ('user', id), fetch)
+
+        if record is None:
+            raise web.HTTPNotFound(headers=headers)
+
+        if mimetype == media.msgpack_type:
+            return media.response(mimetype, record.representation(),
+                                  headers=headers)
+
+        return web.Response(text=record.json(),
+                            content_type='application/json', headers=headers)
 
     async def patch(self):
-        supported = ("application/json-patch+json", "application/octet-stream")
+        # Patch documents may be sent as MessagePack too
+        formats = media.offered("application/json-patch+json")
+        supported = formats + ["application/octet-stream"]
+
         if self.request.content_type not in supported:
-            headers = {"Accept-Patch": "application/json-patch+json"}
+            headers = {"Accept-Patch": ", ".join(formats)}
             raise web.HTTPUnsupportedMediaType(headers=headers)
 
-        async with self.request['db_pool'].acquire() as conn:
-            async with conn.begin():
-                data = await self.get_user_data(conn, lock_rows=True)
+        mimetype = AllUsers.get_best_mimetype(self.request, media.offered(
+            media.json_type
+        ))
+
+        async with self.request['storage'].session() as session:
+            async with session.begin():
+                record = await self.get_user_data(session, lock=True)
+                data = record.representation(tokens=True)
 
                 try:
-                    ops = await self.request.json()
-                    patched = self.schema(jsonpatch.apply_patch(data, ops))
+                    ops = await media.read(self.request)
+                    patched = validation.user(
+                        jsonpatch.apply_patch(data, ops)
+                    )
                 except (TypeError, ValueError, jsonpatch.InvalidJsonPatch,
                         jsonpatch.JsonPointerException):
                     raise web.HTTPBadRequest
-                except MultipleInvalid:
+                except validation.Invalid:
                     raise errors.HTTPUnprocessableEntity
 
+                patched.setdefault('services', {})
+
                 try:
-                    query = users.update() \
-                        .where(users.c.id == self.id) \
-                        .values(name=patched['name'],
-                                email_address=patched['email'])
-
-                    await conn.execute(query)
-
-                    for key, svc_name in (('facebook', 'fb'),
-                                          ('github', 'gh')):
-                        matched_record = (
-                            (services.c.user_id == self.id) &
-                            (services.c.sv_name == svc_name)
-                        )
-
-                        if (key not in patched['services']
-                                and key in data['services']):
-                            # if the service was there before, it has to be
-                            # removed
-                            qry = services.delete(matched_record)
-                            await conn.execute(qry)
-
-                        elif key in patched['services']:
-                            args = {'sv_id': patched['services'][key]['id']}
-
-                            if key in data['services']:
-                                qry = services.update(matched_record).values(
-                                    args
-                                )
-
-                            else:
-                                qry = services.insert().values(
-                                    sv_name=svc_name,
-                                    user_id=self.id,
-                                    **args
-                                )
-
-                            await conn.execute(qry)
-
-                except IntegrityError as e:
-                    if e.pgcode == errorcodes.UNIQUE_VIOLATION:
-                        raise web.HTTPConflict
-                    else:
-                        raise
-
-                else:
-                    patched['id'] = self.id
-
-                    # Send a notification about this user being patched
-                    self.request.app['subscribers'].notify(
-                        self.id, 'urn:glotpod:user:patch', 'user+n', ops
-                    )
+                    await session.update_user(self.id, data, patched)
 
-                    return web.json_response(patched)
+                except errors.Conflict:
+                    raise web.HTTPConflict
 
-    async def get_user_data(self, conn, *, id=None, lock_rows=False):
-        data = {}
-        query = select([users], for_update=lock_rows)
-        query = query.where(users.c.id == self.id)
+                except errors.NoEncryptionKey:
+                    raise errors.HTTPUnprocessableEntity
 
-        async for row in conn.execute(query):
-            data['id'] = row['id']
-            data['name'] = row['name']
-            data['email'] = row['email_address']
-            data.setdefault('services', {})
+        app, id = self.request.app, self.id
+        patched['id'] = id
 
-            svc_query = select([services], for_update=lock_rows)
-            svc_query = svc_query.where(services.c.user_id == self.id)
+        def committed():
+            forget(app, 'user', id)
+            forget(app, 'user-list')
+            index_name(app, id, patched['name'])
+            changed(app)
+
+            # Send a notification about this user being patched
+            app['subscribers'].notify(
+                id, 'urn:glotpod:user:patch', 'user+n', records.redact(ops)
+            )
 
-            async for svc_row in conn.execute(svc_query):
-                service_data = {'id': svc_row['sv_id']}
-                key = 'facebook' if svc_row['sv_name'] == 'fb' else 'github'
-                data['services'][key] = service_data
+        after_commit(self.request, committed)
 
-        if not data:
+        return media.response(mimetype, records.redact(patched))
+
+    async def get_user_data(self, session, *, lock=False):
+        record = await session.get_user(self.id, lock=lock)
+
+        if record is None:
             raise web.HTTPNotFound
 
-        return data
+        return record
 
     @property
     def id(self):
-        try:
-            return int(self.request.match_info['id'])
-        except TypeError:
+        return user_id(self.request)
+
+
+class AccessTokens(web.View):
+    """The user's access token on each service: GET /{id}/access_tokens.
+    They're left out of the user resource, and aren't cached or shared
+    with other requests."""
+
+    async def get(self):
+        mimetype = AllUsers.get_best_mimetype(self.request, media.offered(
+            media.json_type
+        ))
+        id = user_id(self.request)
+
+        async with self.request['storage'].session() as session:
+            record = await session.get_user(id)
+
+        if record is None:
             raise web.HTTPNotFound
+
+        return media.response(mimetype, record.tokens(),
+                              headers={'Cache-Control': 'no-store'})
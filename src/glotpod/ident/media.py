@@ -0,0 +1,89 @@
+"""The media types resources are represented in, besides JSON.
+
+MessagePack is offered to clients which ask for it, when the optional
+msgpack package is installed (``pip install glotpod.ident[msgpack]``); it's
+smaller and cheaper to encode and decode than JSON, for callers which don't
+need to read what they're sent.
+"""
+import json
+
+from aiohttp import HttpVersion11, web
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+__all__ = ['json_type', 'msgpack_type', 'offered', 'encode', 'decode',
+           'read', 'response']
+
+json_type = 'application/json'
+msgpack_type = 'application/msgpack'
+
+
+def offered(*mimetypes):
+    """The given media types, followed by MessagePack if it's available;
+    the first is the default."""
+    if msgpack is None:
+        return list(mimetypes)
+
+    return list(mimetypes) + [msgpack_type]
+
+
+def encode(mimetype, data):
+    """`data` as the body of a response, in bytes."""
+    if mimetype == msgpack_type:
+        return msgpack.packb(data, use_bin_type=True)
+
+    return json.dumps(data).encode('utf-8')
+
+
+def decode(mimetype, body):
+    """The data in the body of a request; raises ValueError if it can't
+    be decoded."""
+    if mimetype == msgpack_type:
+        return msgpack.unpackb(body, encoding='utf-8')
+
+    return json.loads(body.decode('utf-8'))
+
+
+async def read(request):
+    """The data in the body of `request`: MessagePack if it says so, and
+    JSON otherwise."""
+    mimetype = request.content_type
+
+    if mimetype != msgpack_type:
+        mimetype = json_type
+
+    elif msgpack is None:
+        raise web.HTTPUnsupportedMediaType
+
+    try:
+        return decode(mimetype, await request.read())
+    except ValueError:
+        raise web.HTTPBadRequest
+
+
+def response(mimetype, data, **kwargs):
+    """A response with `data` encoded as `mimetype`."""
+    if mimetype == msgpack_type:
+        return web.Response(body=encode(mimetype, data),
+                            content_type=mimetype, **kwargs)
+
+    return web.Response(body=encode(mimetype, data), content_type=mimetype,
+                        charset='utf-8', **kwargs)
+
+
+def stream(request, **kwargs):
+    """A response to stream a body of unknown length in: chunked for
+    HTTP/1.1, and ended by closing the connection for HTTP/1.0, which
+    can't be chunked."""
+    res = web.StreamResponse(**kwargs)
+
+    if request.version >= HttpVersion11:
+        res.enable_chunked_encoding()
+    else:
+        res.force_close()
+
+    return res
@@ -1,5 +1,7 @@
 import sqlalchemy as sa
 
+from sqlalchemy.dialects import postgresql
+
 
 metadata = sa.MetaData()
 
@@ -12,6 +14,33 @@ users = sa.Table('users', metadata,
                  sa.UniqueConstraint('email_address'))
 
 
+def has_trigrams(ddl, target, bind, **kw):
+    # pg_trgm is in Postgres's contrib package, which isn't always there;
+    # without it, the tables are created all the same, and only fuzzy
+    # search fails
+    return bind.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    ).scalar() is not None
+
+
+def has_trigram_ops(ddl, target, bind, **kw):
+    return bind.execute(
+        "SELECT 1 FROM pg_opclass WHERE opcname = 'gin_trgm_ops'"
+    ).scalar() is not None
+
+
+# Trigram indexes, for fuzzy search
+sa.event.listen(metadata, 'before_create', sa.DDL(
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+).execute_if(callable_=has_trigrams))
+
+for column in ('name', 'email_address'):
+    sa.event.listen(users, 'after_create', sa.DDL(
+        "CREATE INDEX users_{0}_trgm ON users USING gin ({0} gin_trgm_ops)"
+        .format(column)
+    ).execute_if(callable_=has_trigram_ops))
+
+
 services = sa.Table('services', metadata,
                     sa.Column('user_id', sa.Integer, nullable=False),
                     sa.Column('sv_id', sa.String, nullable=False),
@@ -20,7 +49,24 @@ services = sa.Table('services', metadata,
                         sa.Enum('fb', 'gh', name='svc_type'),
                         nullable=False
                     ),
+                    # Fernet ciphertext; see crypto.TokenCipher
+                    sa.Column('access_token', sa.String, nullable=True),
 
                     sa.UniqueConstraint('sv_id', 'sv_name'),
                     sa.PrimaryKeyConstraint('sv_name', 'user_id'),
                     sa.ForeignKeyConstraint(['user_id'], ['users.id']))
+
+
+# Every change to a user made through the service, in the order they were
+# committed; the id is the cursor of the change feed
+changes = sa.Table('changes', metadata,
+                   sa.Column('id', sa.BigInteger(), nullable=False),
+                   sa.Column('user_id', sa.Integer(), nullable=False),
+                   sa.Column('type', sa.Enum('new', 'patch',
+                                             name='change_type'),
+                             nullable=False),
+                   sa.Column('document', postgresql.JSON(), nullable=False),
+                   sa.Column('created_at', sa.DateTime(timezone=True),
+                             server_default=sa.func.now(), nullable=False),
+                   sa.PrimaryKeyConstraint('id'),
+                   sa.ForeignKeyConstraint(['user_id'], ['users.id']))
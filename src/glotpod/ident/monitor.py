@@ -0,0 +1,125 @@
+import asyncio
+import gc
+import math
+import time
+
+from collections import Counter, deque
+
+from aiohttp import web
+
+
+__all__ = ['LoopMonitor', 'Stats', 'percentile', 'runtime_stats']
+
+
+def percentile(values, q):
+    """Return the q-th percentile (0-100) of the values, by nearest rank."""
+    values = sorted(values)
+
+    if not values:
+        return None
+
+    rank = math.ceil(q / 100 * len(values)) - 1
+    return values[max(0, min(len(values) - 1, rank))]
+
+
+class LoopMonitor:
+    """Measures event loop lag: how late the loop runs a timer scheduled
+    every `interval` seconds. Lag means some callback held on to the loop
+    for that long; whenever it reaches `threshold` seconds, the lag is
+    recorded along with the routes that had requests in flight.
+    """
+
+    def __init__(self, loop, *, interval=0.1, threshold=0.05, samples=1000,
+                 history=50):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+
+        self.lags = deque(maxlen=samples)
+        self.slow_callbacks = deque(maxlen=history)
+        self.slow_count = 0
+
+        # Route name -> number of requests currently being handled
+        self.in_flight = Counter()
+
+        self._expected = None
+        self._handle = None
+
+    def start(self):
+        if self._handle is None:
+            self._schedule()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        self._expected = self.loop.time() + self.interval
+        self._handle = self.loop.call_at(self._expected, self._tick)
+
+    def _tick(self):
+        lag = max(0.0, self.loop.time() - self._expected)
+        self.lags.append(lag)
+
+        if lag >= self.threshold:
+            self.slow_count += 1
+            self.slow_callbacks.append({
+                'time': time.time(),
+                'lag': lag,
+                'routes': sorted(k for k, v in self.in_flight.items() if v)
+            })
+
+        self._schedule()
+
+    def stats(self):
+        lags = list(self.lags)
+        return {
+            'samples': len(lags),
+            'lag': {
+                'p50': percentile(lags, 50),
+                'p90': percentile(lags, 90),
+                'p99': percentile(lags, 99),
+                'max': max(lags) if lags else None
+            },
+            'slow_count': self.slow_count,
+            'slow_callbacks': list(self.slow_callbacks)
+        }
+
+
+def runtime_stats(app):
+    stats = {
+        'gc': {'counts': gc.get_count(), 'collections': [
+            s['collections'] for s in gc.get_stats()
+        ]},
+        'tasks': len(asyncio.Task.all_tasks(loop=app.loop))
+    }
+
+    if 'db_engine' in app:
+        engine = app['db_engine']
+        stats['db_pool'] = {'size': engine.size, 'free': engine.freesize,
+                            'maxsize': engine.maxsize}
+
+    if len(app.get('db_engines', [])) > 1:
+        stats['db_pools'] = [
+            {'size': engine.size, 'free': engine.freesize,
+             'maxsize': engine.maxsize}
+            for engine in app['db_engines']
+        ]
+
+    if 'log' in app:
+        stats['log_records_dropped'] = sum(
+            getattr(h, 'dropped', 0) for h in app['log'].handlers
+        )
+
+    return stats
+
+
+class Stats(web.View):
+    # Reports the statistics of every provider registered in app['stats']
+
+    async def get(self):
+        app = self.request.app
+        return web.json_response({
+            name: provider(app) for name, provider in app['stats'].items()
+        })
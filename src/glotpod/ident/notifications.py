@@ -1,26 +1,244 @@
 import asyncio
 import json
+import logging
+
+from collections import deque
 
 import aiohttp
 
+from glotpod.ident import tracing
+
+
+__all__ = ['CircuitBreaker', 'Sender']
+
+log = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Stops calls to a service which keeps failing.
+
+    While closed, the outcome of each of the last `window` calls is kept;
+    once there have been at least `min_calls`, and `failure_rate` of them
+    or more failed, the breaker opens, and no calls are allowed for
+    `reset_timeout` seconds. Then it's half open: up to `probes` calls at
+    once are let through to try the service. If one succeeds, the breaker
+    closes again, and if one fails, it opens for another `reset_timeout`.
+
+    Each change of state starts a new generation of the breaker. Calls are
+    allowed in one, and their outcomes only count in the same one; a call
+    made while closed which finishes once the breaker is half open isn't
+    taken for a probe.
+    """
+
+    def __init__(self, *, failure_rate=0.5, window=20, min_calls=10,
+                 reset_timeout=30, probes=1, loop=None):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.state = 'closed'
+        self.generation = 0
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.probing = 0
+
+        self.opened = 0
+        self.short_circuited = 0
+
+    def allow(self):
+        """Whether a call may be made now: None if not, or else the
+        generation it's made in. Each call allowed must be followed by
+        success() or failure() with its generation."""
+        if self.state == 'open':
+            if self.loop.time() - self.opened_at < self.reset_timeout:
+                self.short_circuited += 1
+                return None
+
+            self.change('half_open')
+
+        if self.state == 'half_open':
+            if self.probing >= self.probes:
+                self.short_circuited += 1
+                return None
+
+            self.probing += 1
+
+        return self.generation
+
+    def success(self, generation):
+        # Calls made before the breaker last changed state don't count
+        if generation != self.generation:
+            return
+
+        if self.state == 'half_open':
+            self.close()
+        else:
+            self.outcomes.append(True)
+
+    def failure(self, generation):
+        if generation != self.generation:
+            return
+
+        if self.state == 'half_open':
+            self.open()
+        else:
+            self.outcomes.append(False)
+
+            failed = self.outcomes.count(False)
+
+            if len(self.outcomes) >= self.min_calls and \
+                    failed >= self.failure_rate * len(self.outcomes):
+                self.open()
+
+    def open(self):
+        if self.state != 'open':
+            log.warning("Circuit breaker opened; calls are stopped for "
+                        "%s seconds.", self.reset_timeout)
+            self.opened += 1
+
+        self.change('open')
+        self.opened_at = self.loop.time()
+
+    def close(self):
+        log.info("Circuit breaker closed.")
+        self.change('closed')
+
+    def change(self, state):
+        self.state = state
+        self.generation += 1
+        self.outcomes.clear()
+        self.probing = 0
+
+    def stats(self):
+        return {'state': self.state, 'opened': self.opened,
+                'short_circuited': self.short_circuited}
+
 
 class Sender:
+    """Sends events about users to the notifications service, in the
+    background, without the requests causing them waiting.
+
+    Each notification is given up on after `timeout` seconds. At most
+    `max_pending` are sent at once, and the rest are dropped; so are those
+    while the breaker is open, without opening a connection. Dropping them
+    is logged, at most once every `warn_interval` seconds.
+    """
     host = "push.gp"
 
-    def __init__(self, loop):
-        self.session = aiohttp.ClientSession(loop=loop)
+    def __init__(self, loop, *, host=None, timeout=5, max_pending=100,
+                 breaker=None, warn_interval=60):
         self.loop = loop
+        self.host = host or self.host
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.breaker = breaker or CircuitBreaker(loop=loop)
+        self.warn_interval = warn_interval
+
+        connector = aiohttp.TCPConnector(limit=max_pending, loop=loop)
+        self.session = aiohttp.ClientSession(connector=connector, loop=loop)
+
+        self.pending = set()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+        # Notifications dropped since the last warning about them
+        self.unlogged = 0
+        self.warned_at = None
 
     async def cleanup(self):
+        # Notifications still being sent are given up on
+        for future in self.pending:
+            future.cancel()
+
+        if self.pending:
+            await asyncio.wait(self.pending, loop=self.loop)
+
         await self.session.close()
 
     def notify(self, *args):
-        coro = self._send_notification(*args)
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            self._drop("{} are being sent already".format(self.max_pending))
+            return
+
+        generation = self.breaker.allow()
+
+        if generation is None:
+            self._drop("the circuit breaker is open")
+            return
+
+        # Sent as part of the trace of the request sending it, if any
+        span = tracing.current_span(self.loop)
+        coro = self._send_notification(*args, generation=generation,
+                                       span=span)
         future = asyncio.ensure_future(coro, loop=self.loop)
-        future.add_done_callback(lambda f: f.result())
+        self.pending.add(future)
+        future.add_done_callback(self._sent)
 
-    async def _send_notification(self, user_id, type, scope, payload):
+    def _drop(self, reason):
+        self.unlogged += 1
+        now = self.loop.time()
+
+        if self.warned_at is not None and \
+                now - self.warned_at < self.warn_interval:
+            return
+
+        log.warning("Dropped %s notifications; the last because %s.",
+                    self.unlogged, reason)
+        self.unlogged = 0
+        self.warned_at = now
+
+    def _sent(self, future):
+        self.pending.discard(future)
+
+        if not future.cancelled():
+            future.result()
+
+    async def _send_notification(self, user_id, type, scope, payload, *,
+                                 generation, span=tracing.no_span):
         url = "http://{}/users/{}".format(self.host, user_id)
         body = {'type': type, 'scope': scope, 'payload': payload}
         headers = {'Content-Type': 'application/json'}
-        await self.session.post(url, json.dumps(body), headers=headers)
+
+        with span.child('notifications.send', **{'notification.type': type,
+                                                 'http.url': url}) as span:
+            if span.traceparent is not None:
+                headers['traceparent'] = span.traceparent
+
+            try:
+                res = await asyncio.wait_for(
+                    self.session.post(url, data=json.dumps(body),
+                                      headers=headers),
+                    self.timeout, loop=self.loop
+                )
+                res.release()
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                log.warning("Couldn't send %s notification about user %s: "
+                            "%r", type, user_id, e)
+                span.set('error', e.__class__.__name__)
+                self.failed += 1
+                self.breaker.failure(generation)
+                return
+
+            span.set('http.status_code', res.status)
+
+            # Only the service's own errors count against it
+            if res.status >= 500:
+                log.warning("Couldn't send %s notification about user %s: "
+                            "%s response.", type, user_id, res.status)
+                self.failed += 1
+                self.breaker.failure(generation)
+            else:
+                self.sent += 1
+                self.breaker.success(generation)
+
+    def stats(self):
+        return dict(self.breaker.stats(), sent=self.sent, failed=self.failed,
+                    dropped=self.dropped, pending=len(self.pending))
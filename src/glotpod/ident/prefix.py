@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import re
+import unicodedata
+
+from bisect import bisect_left, insort
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+from glotpod.ident import validation
+
+
+__all__ = ['PrefixIndex', 'PrefixSearch']
+
+log = logging.getLogger(__name__)
+
+
+def words(text):
+    # Lower-cased words, without accents, in order
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return re.findall(r'[^\W_]+', text.casefold())
+
+
+def tokens(name):
+    return sorted(set(words(name)))
+
+
+class PrefixIndex:
+    """The names of all the users, in memory, for typeahead search.
+
+    Each word of each name is kept with the user's id in one sorted list,
+    so the users with a word starting with some prefix are next to each
+    other and found by bisection. The index holds at most `max_entries`
+    words; past that it stops being `ready`, and searches should go to the
+    database instead, until it's loaded again.
+    """
+
+    def __init__(self, *, max_entries=1000000, loop=None):
+        self.max_entries = max_entries
+        self.loop = loop or asyncio.get_event_loop()
+
+        # (word, id) pairs, sorted
+        self.entries = []
+        # id -> name
+        self.names = {}
+
+        self.ready = False
+        self.loads = 0
+
+        # Names set while loading, to apply to what's loaded
+        self.pending = None
+
+    def build(self, users):
+        # Returns the entries and names for (id, name) pairs, or None if
+        # there are too many
+        entries = []
+        names = {}
+
+        for id, name in users:
+            names[id] = name
+            entries.extend((token, id) for token in tokens(name))
+
+            if len(entries) > self.max_entries:
+                return None
+
+        entries.sort()
+        return entries, names
+
+    async def load(self, storage):
+        """(Re)load the index from `storage`. Searches and writes go on as
+        usual meanwhile."""
+        self.pending = []
+
+        try:
+            # Each user has a word at least, so there's no need for more of
+            # them than there may be words
+            async with storage.session() as session:
+                users = await session.user_names(limit=self.max_entries + 1)
+
+            # Sorting millions of words takes a while
+            if len(users) > self.max_entries:
+                built = None
+            else:
+                built = await self.loop.run_in_executor(None, self.build,
+                                                        users)
+
+            if built is None:
+                log.warning("Too many names for the prefix index; searches "
+                            "will go to the database.")
+                self.ready = False
+                return
+
+            pending, self.pending = self.pending, None
+            self.entries, self.names = built
+            self.ready = True
+            self.loads += 1
+
+            for id, name in pending:
+                self.set(id, name)
+
+        finally:
+            self.pending = None
+
+    async def refresh(self, storage, interval):
+        # Reload every `interval` seconds, to pick up the writes made by
+        # other processes
+        while True:
+            try:
+                await self.load(storage)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Couldn't load the prefix index.")
+
+            await asyncio.sleep(interval, loop=self.loop)
+
+    def set(self, id, name):
+        """Index the name of the user `id`, instead of any old one."""
+        if self.pending is not None:
+            self.pending.append((id, name))
+
+        if not self.ready:
+            return
+
+        old = self.names.get(id)
+
+        if old is not None:
+            for token in tokens(old):
+                index = bisect_left(self.entries, (token, id))
+
+                if index < len(self.entries) and \
+                        self.entries[index] == (token, id):
+                    del self.entries[index]
+
+        self.names[id] = name
+
+        for token in tokens(name):
+            insort(self.entries, (token, id))
+
+        if len(self.entries) > self.max_entries:
+            self.ready = False
+
+    def search(self, text, limit=10):
+        """Up to `limit` (id, name) pairs of users with a word starting
+        with each word of `text`; whole words first, then in alphabetical
+        order of the matching word."""
+        prefixes = words(text)
+
+        if not prefixes:
+            return []
+
+        # Scan the users matching the longest prefix, which are likely the
+        # fewest, and check the others against each one's name
+        longest = max(prefixes, key=len)
+        others = list(prefixes)
+        others.remove(longest)
+
+        found = []
+        seen = set()
+        index = bisect_left(self.entries, (longest,))
+
+        while index < len(self.entries) and len(found) < limit:
+            token, id = self.entries[index]
+            index += 1
+
+            if not token.startswith(longest):
+                break
+
+            if id in seen:
+                continue
+
+            seen.add(id)
+
+            if others:
+                name_tokens = tokens(self.names[id])
+
+                if not all(any(t.startswith(p) for t in name_tokens)
+                           for p in others):
+                    continue
+
+            found.append((id, self.names[id]))
+
+        return found
+
+    def stats(self):
+        return {'ready': self.ready, 'entries': len(self.entries),
+                'users': len(self.names), 'loads': self.loads}
+
+
+class PrefixSearch(web.View):
+    """Typeahead search of user names: GET /search/prefix?q=rob+st&limit=5
+    returns the ids and names of the first few users with a word starting
+    with each word of q, from the prefix index if it's ready."""
+
+    async def get(self):
+        try:
+            items = dict(parse_qsl(self.request.query_string))
+            params = validation.prefix_params(items)
+        except validation.Invalid:
+            raise web.HTTPBadRequest
+
+        limit = params.get('limit', 10)
+        index = self.request.app.get('prefix_index')
+
+        if index is not None and index.ready:
+            found = index.search(params['q'], limit)
+
+        else:
+            found = await self.search_storage(params['q'], limit)
+
+        return web.json_response([{'id': id, 'name': name}
+                                  for id, name in found])
+
+    async def search_storage(self, text, limit):
+        prefixes = words(text)
+
+        if not prefixes:
+            return []
+
+        async with self.request['storage'].session() as session:
+            users = await session.list_users({'name': ' '.join(prefixes)},
+                                             limit=limit)
+
+        return [(user.id, user.name) for user in users]
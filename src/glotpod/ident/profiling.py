@@ -0,0 +1,163 @@
+import cProfile
+import hmac
+import pstats
+import time
+
+from collections import Counter, deque
+from itertools import count
+
+from aiohttp import web
+
+
+__all__ = ['RequestProfiler', 'Profiles']
+
+secret_header = 'X-Ident-Profile'
+profile_id_header = 'X-Ident-Profile-Id'
+
+
+def top_functions(profile, limit):
+    """Summarise a profile as its `limit` most expensive functions, by
+    cumulative time."""
+    stats = pstats.Stats(profile).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+
+    return [
+        {'function': "{}:{}({})".format(*func), 'calls': nc,
+         'total_time': tt, 'cumulative_time': ct}
+        for func, (cc, nc, tt, ct, callers) in rows[:limit]
+    ]
+
+
+class RequestProfiler:
+    """Runs selected requests under cProfile, and keeps the most recent
+    results.
+
+    A request is profiled if it carries the configured secret in the
+    X-Ident-Profile header, or if samples have been armed for its route.
+    cProfile follows the thread rather than the request, so the profile of
+    a request includes whatever else the event loop ran while it was in
+    flight, and only one request is profiled at a time.
+    """
+
+    def __init__(self, secret, *, top=25, history=20):
+        self.secret = secret
+        self.top = top
+        self.profiles = deque(maxlen=history)
+        self.armed = Counter()
+        self.busy = False
+        self._ids = count(1)
+
+    def authorized(self, request):
+        given = request.headers.get(secret_header, '')
+        return hmac.compare_digest(given.encode(), self.secret.encode())
+
+    def arm(self, route, samples):
+        self.armed[route] += samples
+
+    def wants(self, request):
+        if self.busy:
+            return False
+
+        route = request.match_info.route.name
+        return self.armed[route] > 0 or (secret_header in request.headers and
+                                         self.authorized(request))
+
+    async def profile(self, request, handler):
+        route = request.match_info.route.name
+
+        if self.armed[route] > 0:
+            self.armed[route] -= 1
+
+        profile = cProfile.Profile()
+        start = time.time()
+        res = None
+
+        self.busy = True
+        profile.enable()
+
+        try:
+            res = await handler(request)
+            return res
+
+        except web.HTTPException as e:
+            res = e
+            raise
+
+        finally:
+            profile.disable()
+            self.busy = False
+
+            result = {
+                'id': next(self._ids),
+                'time': start,
+                'duration': time.time() - start,
+                'method': request.method,
+                'path': request.path_qs,
+                'route': route,
+                'status': res.status if res is not None else 500,
+                'functions': top_functions(profile, self.top)
+            }
+            self.profiles.append(result)
+
+            if res is not None:
+                res.headers[profile_id_header] = str(result['id'])
+
+    def get(self, id):
+        for result in self.profiles:
+            if result['id'] == id:
+                return result
+
+
+class Profiles(web.View):
+    # Admin interface to the request profiler: GET lists the stored profiles
+    # (or gets one by id), POST arms samples for a route with a body like
+    # {"route": "user-list", "samples": 10}.
+
+    @property
+    def profiler(self):
+        profiler = self.request.app.get('profiler')
+
+        if profiler is None or not profiler.authorized(self.request):
+            raise web.HTTPNotFound
+
+        return profiler
+
+    async def get(self):
+        profiler = self.profiler
+
+        if 'id' in self.request.match_info:
+            try:
+                result = profiler.get(int(self.request.match_info['id']))
+            except ValueError:
+                result = None
+
+            if result is None:
+                raise web.HTTPNotFound
+
+            return web.json_response(result)
+
+        return web.json_response({
+            'armed': {k: v for k, v in profiler.armed.items() if v > 0},
+            'profiles': [
+                {k: v for k, v in result.items() if k != 'functions'}
+                for result in profiler.profiles
+            ]
+        })
+
+    async def post(self):
+        profiler = self.profiler
+        routes = self.request.app.router.named_resources()
+
+        try:
+            data = await self.request.json()
+            route, samples = data['route'], int(data.get('samples', 1))
+        except (TypeError, ValueError, KeyError, AttributeError):
+            raise web.HTTPBadRequest
+
+        if route not in routes or samples < 1:
+            raise web.HTTPBadRequest
+
+        profiler.arm(route, samples)
+        return web.json_response({'route': route,
+                                  'samples': profiler.armed[route]},
+                                 status=202)
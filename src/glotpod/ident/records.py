@@ -0,0 +1,98 @@
+from collections import namedtuple
+from json.encoder import encode_basestring_ascii as quote
+
+
+__all__ = ['UserRecord', 'ChangeRecord', 'json_list', 'redact']
+
+
+class UserRecord(namedtuple('UserRecord', 'id name email facebook github '
+                                          'facebook_token github_token')):
+    """A user as storage returns it: a tuple of the user's columns, the
+    user's id on each service or None, and the user's access token on each
+    service, decrypted, or None. The tokens are left out of the user
+    resource unless asked for.
+
+    Being a tuple, a record is cheap to make, and can be shared between
+    requests without being changed by one of them. It serialises straight
+    to the JSON of the user resource, without building the dicts first.
+    """
+
+    __slots__ = ()
+
+    def service_fields(self):
+        # The key, id and access token of each service
+        return (('facebook', self.facebook, self.facebook_token),
+                ('github', self.github, self.github_token))
+
+    def services(self, *, tokens=False):
+        services = {}
+
+        for key, id, token in self.service_fields():
+            if id is not None:
+                services[key] = {'id': id}
+
+                if tokens and token is not None:
+                    services[key]['access_token'] = token
+
+        return services
+
+    def tokens(self):
+        """The user's access token on each service which has one."""
+        return {key: token for key, id, token in self.service_fields()
+                if id is not None and token is not None}
+
+    def representation(self, *, tokens=False):
+        """The user resource, as a dict which may be changed; with the
+        access tokens if `tokens` is set."""
+        return {'id': self.id, 'name': self.name, 'email': self.email,
+                'services': self.services(tokens=tokens)}
+
+    def json(self):
+        """The user resource, encoded as JSON, without the tokens."""
+        services = ['"%s": {"id": %s}' % (key, quote(id))
+                    for key, id, _ in self.service_fields() if id is not None]
+
+        return '{"id": %d, "name": %s, "email": %s, "services": {%s}}' % (
+            self.id, quote(self.name), quote(self.email), ', '.join(services)
+        )
+
+
+# Users without access tokens needn't say so
+UserRecord.__new__.__defaults__ = (None, None)
+
+
+def json_list(records):
+    """A JSON array of the resources of several records."""
+    return '[' + ', '.join([record.json() for record in records]) + ']'
+
+
+def redact(value):
+    """A copy of a user resource, or of anything with some in it, such as
+    a patch, without the access tokens."""
+    if isinstance(value, dict):
+        return {k: redact(v) for k, v in value.items()
+                if k != 'access_token'}
+
+    if isinstance(value, list):
+        return [redact(item) for item in value
+                if not (isinstance(item, dict) and
+                        str(item.get('path', '')).endswith('/access_token'))]
+
+    return value
+
+
+class ChangeRecord(namedtuple('ChangeRecord', 'cursor user_id type user')):
+    """A change to a user, from the change log: its cursor, the user's id,
+    whether the user was 'new' or a 'patch', and the user resource as the
+    change left it."""
+
+    __slots__ = ()
+
+    def representation(self):
+        return {'cursor': self.cursor, 'type': change_types[self.type],
+                'user': self.user}
+
+
+# The change types, as the notifications of them name them
+change_types = {'new': 'urn:glotpod:user:new',
+                'patch': 'urn:glotpod:user:patch'}
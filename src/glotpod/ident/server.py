@@ -0,0 +1,262 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from glotpod.ident import init_app
+from glotpod.ident.config import load_config
+
+
+__all__ = ['main']
+
+log = logging.getLogger(__name__)
+
+
+def pool_size(config, workers):
+    """Split the total database connection budget between the workers.
+
+    Returns the pool arguments for each worker, or an empty dict if there's
+    no budget configured.
+    """
+    pool = config.get('database', {}).get('pool', {})
+
+    if 'budget' not in pool:
+        return {}
+
+    # Each worker needs a connection, even if that's more than the budget
+    if pool['budget'] < workers:
+        log.warning("A budget of %s database connections is too few for %s "
+                    "workers; allowing each of them one.", pool['budget'],
+                    workers)
+
+    maxsize = max(1, pool['budget'] // workers)
+    return {'minsize': min(pool.get('minsize', 1), maxsize),
+            'maxsize': maxsize}
+
+
+def use_uvloop():
+    try:
+        import uvloop
+    except ImportError:
+        sys.exit("uvloop was requested, but it isn't installed; install "
+                 "glotpod.ident[uvloop].")
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def run_worker(host, port, sock, pool, uvloop, shutdown_timeout, ready):
+    """Serve the application in this process until SIGTERM or SIGINT.
+
+    The worker listens on the inherited socket `sock` if there is one, or
+    else binds its own to (host, port) with SO_REUSEPORT, so that the kernel
+    balances connections between the workers.
+    """
+    # Forget the arbiter's signal handlers
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    if uvloop:
+        use_uvloop()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    app = init_app([], loop=loop)
+    app['config'].setdefault('database', {}).setdefault('pool', {}) \
+        .update(pool)
+
+    handler = app.make_handler()
+
+    if sock is not None:
+        coro = loop.create_server(handler, sock=sock)
+    else:
+        coro = loop.create_server(handler, host, port, reuse_port=True)
+
+    server = loop.run_until_complete(coro)
+
+    def stop():
+        # Only the first signal stops the loop; another would stop it again
+        # in the middle of shutting down. (Ctrl-C sends SIGINT to the
+        # arbiter and the workers, and then the arbiter sends SIGTERM.) The
+        # arbiter kills workers which take too long.
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
+            signal.signal(signum, signal.SIG_IGN)
+
+        loop.stop()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop)
+
+    ready.set()
+
+    try:
+        loop.run_forever()
+    finally:
+        # Stop accepting connections, then let the open ones finish, before
+        # the shutdown handlers take away the pools they may be using
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.run_until_complete(handler.finish_connections(shutdown_timeout))
+        loop.run_until_complete(app.shutdown())
+        loop.run_until_complete(app.cleanup())
+        loop.close()
+
+
+class Arbiter:
+    """Keeps `workers` worker processes running.
+
+    Workers that die are replaced. On SIGHUP, each worker is replaced in
+    turn by a fresh one, which starts listening before the old one stops,
+    so that no connections are refused. SIGTERM and SIGINT stop every
+    worker gracefully.
+    """
+
+    def __init__(self, workers, worker_args, *, start_timeout=30):
+        self.workers = workers
+        self.worker_args = worker_args
+        self.start_timeout = start_timeout
+        self.processes = []
+        self.reloading = False
+        self.stopping = False
+
+    def spawn(self):
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=run_worker,
+                                          args=self.worker_args + (ready,))
+        process.start()
+
+        if not ready.wait(self.start_timeout):
+            log.warning("Worker %s didn't start listening in time.",
+                        process.pid)
+
+        log.info("Started worker %s.", process.pid)
+        return process
+
+    def stop(self, process, timeout=None):
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+
+        self.join(process, timeout)
+
+    def join(self, process, timeout=None):
+        # Wait for a worker which has been asked to stop, and kill it if it
+        # doesn't in time
+        process.join(timeout)
+
+        if process.is_alive():
+            log.warning("Killing worker %s.", process.pid)
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+
+    def reload(self):
+        log.info("Reloading workers.")
+
+        for index, old in enumerate(list(self.processes)):
+            self.processes[index] = self.spawn()
+            self.stop(old, self.worker_args[-1])
+
+    def run(self):
+        def on_reload(signum, frame):
+            self.reloading = True
+
+        def on_stop(signum, frame):
+            self.stopping = True
+
+        signal.signal(signal.SIGHUP, on_reload)
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+
+        self.processes = [self.spawn() for _ in range(self.workers)]
+
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    log.warning("Worker %s exited with %s; replacing it.",
+                                process.pid, process.exitcode)
+                    self.processes[index] = self.spawn()
+
+            time.sleep(0.5)
+
+        log.info("Stopping workers.")
+
+        # All of them stop at once, each with the same deadline
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.worker_args[-1]
+
+        for process in self.processes:
+            self.join(process, max(0, deadline - time.monotonic()))
+
+
+def main(argv=None):
+    config = load_config()
+    server_cfg = config.get('server', {})
+
+    parser = argparse.ArgumentParser(
+        prog='glotpod-ident',
+        description="Serve the GlotPod identity micro-service."
+    )
+    parser.add_argument('-H', '--host',
+                        default=server_cfg.get('host', 'localhost'),
+                        help="host to listen on (default: %(default)s)")
+    parser.add_argument('-P', '--port', type=int,
+                        default=server_cfg.get('port', 5000),
+                        help="port to listen on (default: %(default)s)")
+    parser.add_argument('-w', '--workers', type=int,
+                        default=server_cfg.get('workers', os.cpu_count()),
+                        help="number of worker processes (default: "
+                             "%(default)s)")
+    parser.add_argument('--uvloop', action='store_true',
+                        default=server_cfg.get('uvloop', False),
+                        help="run the workers on uvloop")
+    parser.add_argument('--no-reuse-port', dest='reuse_port',
+                        action='store_false',
+                        default=server_cfg.get('reuse_port', True),
+                        help="share one listening socket between the "
+                             "workers instead of using SO_REUSEPORT")
+    parser.add_argument('--shutdown-timeout', type=float,
+                        default=server_cfg.get('shutdown_timeout', 30),
+                        help="seconds to let open connections finish when "
+                             "stopping (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+    )
+
+    sock = None
+
+    if not args.reuse_port or not hasattr(socket, 'SO_REUSEPORT'):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((args.host, args.port))
+        sock.listen(128)
+        sock.set_inheritable(True)
+
+    pool = pool_size(config, args.workers)
+
+    if pool:
+        log.info("Allowing each worker %s database connections.",
+                 pool['maxsize'])
+
+    worker_args = (args.host, args.port, sock, pool, args.uvloop,
+                   args.shutdown_timeout)
+
+    log.info("Listening on http://%s:%s/ with %s workers.", args.host,
+             args.port, args.workers)
+
+    Arbiter(args.workers, worker_args).run()
@@ -0,0 +1,294 @@
+"""Users spread over several databases, each holding some of them whole.
+
+A user lives in one shard for good, which its id says: ids are allocated
+by each shard as its own sequence times the number of shards, plus its
+index, so the shard of a user is its id modulo the number of shards. New
+users go to the shard their email address hashes to, so that two at once
+with the same address meet in one database, and its unique index. Searches
+and lookups by service go to every shard at once, and their results are
+merged.
+
+The number of shards can't change once they hold users, as their ids would
+no longer say where they are.
+"""
+import asyncio
+import heapq
+import zlib
+
+from itertools import islice
+
+from glotpod.ident import errors
+from glotpod.ident.storage import similarity
+
+
+__all__ = ['ShardRouter', 'ShardedStorage']
+
+
+class ShardRouter:
+    """Which of `count` shards users are in."""
+
+    def __init__(self, count):
+        self.count = count
+
+    def for_id(self, id):
+        """The shard of the user `id`."""
+        return id % self.count
+
+    def for_email(self, email):
+        """The shard for a new user with the address `email`; the same in
+        every process, unlike hash()."""
+        return zlib.crc32(email.encode('utf-8')) % self.count
+
+
+class ShardedStorage:
+    """Storage over several others, its `shards`: PostgresStorages, each
+    created with its index and the number of shards.
+
+    Sessions use a connection from each shard they need. A transaction may
+    read from any of them, but only write to one: with no two-phase commit,
+    writes to several couldn't be committed all at once, and transactions
+    waiting on each other's locks in different databases would never be
+    found out. Writing to another raises errors.Conflict.
+
+    Email addresses and ids on services are unique within a shard by its
+    indexes, and checked with the other shards before a write, which can't
+    stop a racing write to another shard.
+    """
+
+    def __init__(self, shards, *, loop=None):
+        self.storages = list(shards)
+        self.shards = len(self.storages)
+        self.router = ShardRouter(self.shards)
+        self.fuzzy_limit = self.storages[0].fuzzy_limit
+        self.loop = loop or asyncio.get_event_loop()
+
+    def session(self, *, timeout=None):
+        return _ShardedSessionContextManager(self, timeout)
+
+
+class ShardedSession:
+
+    def __init__(self, storage, timeout):
+        self.storage = storage
+        self.router = storage.router
+        self.timeout = timeout
+
+        # index -> (session context manager, session), as they're opened
+        self.opened = {}
+        # The transaction context managers of the shards in the transaction,
+        # or None outside of one, and the shard it's written to
+        self.transactions = None
+        self.written = None
+        # Called with the session of each shard as it's opened, if set; see
+        # tracing.TracedSession
+        self.on_open = None
+
+    async def shard(self, index):
+        # The session on the shard `index`, opened the first time it's
+        # needed, in the transaction if there is one
+        if index not in self.opened:
+            manager = self.storage.storages[index].session(
+                timeout=self.timeout
+            )
+            self.opened[index] = (manager, await manager.__aenter__())
+
+            if self.on_open is not None:
+                self.on_open(self.opened[index][1])
+
+            if self.transactions is not None:
+                await self.join(self.opened[index][1])
+
+        return self.opened[index][1]
+
+    def write(self, index):
+        # Check that a write to the shard `index` may be made
+        if self.transactions is None:
+            return
+
+        if self.written not in (None, index):
+            raise errors.Conflict
+
+        self.written = index
+
+    async def join(self, session):
+        manager = session.begin()
+        await manager.__aenter__()
+        self.transactions.append(manager)
+
+    async def each(self, indexes, method, *args, **kwargs):
+        # Call `method` on the sessions of the shards `indexes` at once;
+        # they're all done before this returns, or raises
+        async def call(index):
+            session = await self.shard(index)
+            return await getattr(session, method)(*args, **kwargs)
+
+        results = await asyncio.gather(*(call(index) for index in indexes),
+                                       loop=self.storage.loop,
+                                       return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        return results
+
+    async def close(self, exc_type, exc, tb):
+        # Close the session on each shard, then raise the first error any
+        # of them raised
+        opened, self.opened = self.opened, {}
+        error = None
+
+        for manager, _ in opened.values():
+            try:
+                await manager.__aexit__(exc_type, exc, tb)
+            except Exception as e:
+                error = error or e
+
+        if error is not None:
+            raise error
+
+    def begin(self):
+        return _ShardedTransaction(self)
+
+    async def get_user(self, id, *, lock=False):
+        session = await self.shard(self.router.for_id(id))
+        return await session.get_user(id, lock=lock)
+
+    async def list_users(self, params, *, full=True, limit=None):
+        every = range(self.storage.shards)
+
+        if 'q' not in params:
+            # Each shard's users are in order of id already
+            found = await self.each(every, 'list_users', params, full=full,
+                                    limit=limit)
+            key = (lambda record: record.id) if full else None
+            return list(islice(heapq.merge(*found, key=key), limit))
+
+        # The most similar users of each shard, ranked again together
+        found = await self.each(every, 'list_users', params, limit=limit)
+        q = params['q']
+
+        def rank(record):
+            score = max(similarity(record.name, q),
+                        similarity(record.email, q))
+            return -score, record.id
+
+        records = sorted((record for results in found for record in results),
+                         key=rank)
+        records = records[:params.get('page_size', self.storage.fuzzy_limit)]
+        records = records[:limit]
+
+        if full:
+            return records
+
+        return [record.id for record in records]
+
+    async def user_names(self, *, limit=None):
+        found = await self.each(range(self.storage.shards), 'user_names',
+                                limit=limit)
+        return [pair for names in found for pair in names][:limit]
+
+    async def find_user_by_service(self, key, sv_id):
+        # Users are placed by email address, so any shard may have the
+        # service id; a directory of them would be a second database to
+        # write with each change, which couldn't be committed with it
+        found = await self.each(range(self.storage.shards),
+                                'find_user_by_service', key, sv_id)
+        return next((id for id in found if id is not None), None)
+
+    async def check_unique(self, data, index, id=None):
+        # Raise errors.Conflict if a shard other than `index` has another
+        # user with the email address or an id on a service in `data`
+        others = [other for other in range(self.storage.shards)
+                  if other != index]
+
+        found = await self.each(others, 'list_users',
+                                {'email': data['email']}, full=False)
+        owners = {owner for ids in found for owner in ids}
+
+        for key, svc in data.get('services', {}).items():
+            found = await self.each(others, 'find_user_by_service', key,
+                                    svc['id'])
+            owners.update(owner for owner in found if owner is not None)
+
+        if owners - {id}:
+            raise errors.Conflict
+
+    async def create_user(self, data):
+        index = self.router.for_email(data['email'])
+        self.write(index)
+        await self.check_unique(data, index)
+
+        session = await self.shard(index)
+        return await session.create_user(data)
+
+    async def update_user(self, id, old, new):
+        index = self.router.for_id(id)
+        self.write(index)
+        await self.check_unique(new, index, id)
+
+        session = await self.shard(index)
+        await session.update_user(id, old, new)
+
+    async def list_changes(self, after, limit, *, shard=0):
+        session = await self.shard(shard)
+        return await session.list_changes(after, limit)
+
+
+class _ShardedTransaction:
+    # Begins a transaction on each shard the session uses in it; only the
+    # outermost one does anything
+
+    def __init__(self, session):
+        self.session = session
+        self.outermost = False
+
+    async def __aenter__(self):
+        session = self.session
+
+        if session.transactions is None:
+            self.outermost = True
+            session.transactions = []
+
+            for _, shard in list(session.opened.values()):
+                await session.join(shard)
+
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if not self.outermost:
+            return
+
+        transactions, self.session.transactions = \
+            self.session.transactions, None
+        self.session.written = None
+        error = None
+
+        # Only one shard has writes to commit; the rest are rolled back if
+        # it fails
+        for manager in transactions:
+            try:
+                await manager.__aexit__(exc_type, exc, tb)
+            except Exception as e:
+                if error is None:
+                    error = e
+                    exc_type, exc, tb = type(e), e, e.__traceback__
+
+        if error is not None:
+            raise error
+
+
+class _ShardedSessionContextManager:
+
+    def __init__(self, storage, timeout):
+        self.storage = storage
+        self.timeout = timeout
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = ShardedSession(self.storage, self.timeout)
+        return self.session
+
+    async def __aexit__(self, exc_type, exc, tb):
+        session, self.session = self.session, None
+        await session.close(exc_type, exc, tb)
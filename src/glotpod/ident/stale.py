@@ -0,0 +1,160 @@
+import asyncio
+
+from collections import OrderedDict
+
+
+__all__ = ['StaleCache']
+
+
+class StaleCache:
+    """Keeps the results last fetched for recently read keys, so that they
+    can be served for a while when fetching them again fails or is too slow.
+
+    A result younger than `max_age` seconds is served without fetching.
+    Older than that, it's fetched again; if that fails, or takes longer than
+    `timeout` seconds, the old result is served with a warning for up to
+    `window` seconds more, while a background task keeps trying to refresh
+    it every `retry_interval` seconds. At most `size` results are kept.
+    """
+
+    warning = '110 - "Response is Stale"'
+
+    def __init__(self, *, max_age=0, window=30, timeout=None, size=10000,
+                 retry_interval=1.0, loop=None):
+        self.max_age = max_age
+        self.window = window
+        self.timeout = timeout
+        self.size = size
+        self.retry_interval = retry_interval
+        self.loop = loop or asyncio.get_event_loop()
+
+        # key -> (time fetched, result), least recently used first
+        self.entries = OrderedDict()
+        self.refreshing = {}
+
+        # Bumped by every write, so that fetches which overlap a write
+        # aren't kept
+        self.writes = 0
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    async def get(self, key, fetch):
+        """The result for `key`, and the headers to send with it. `fetch`
+        is a coroutine function which fetches the result afresh."""
+        entry = self.entries.get(key)
+
+        if entry is not None:
+            age = self.loop.time() - entry[0]
+
+            if age <= self.max_age:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], {'Age': str(int(age))}
+
+            if age > self.max_age + self.window:
+                del self.entries[key]
+                entry = None
+
+        self.misses += 1
+        writes = self.writes
+
+        if entry is None:
+            result = await fetch()
+            self.store(key, result, writes)
+            return result, {}
+
+        flight = asyncio.ensure_future(fetch(), loop=self.loop)
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(flight),
+                                            self.timeout, loop=self.loop)
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            # Serve what we had, and keep trying to refresh it
+            self.stale_hits += 1
+            self.refresh_later(key, fetch, flight, writes)
+
+            age = self.loop.time() - entry[0]
+            return entry[1], {'Age': str(int(age)), 'Warning': self.warning}
+
+        self.store(key, result, writes)
+        return result, {}
+
+    def store(self, key, result, writes):
+        if writes != self.writes:
+            return
+
+        self.entries[key] = (self.loop.time(), result)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def refresh_later(self, key, fetch, flight, writes):
+        if key in self.refreshing:
+            # Somebody's refreshing it already; just let this one land
+            flight.add_done_callback(
+                lambda f: f.cancelled() or f.exception()
+            )
+        else:
+            self.refreshing[key] = asyncio.ensure_future(
+                self.refresh(key, fetch, flight, writes), loop=self.loop
+            )
+
+    async def refresh(self, key, fetch, flight, writes):
+        try:
+            while True:
+                try:
+                    result = await flight
+
+                except asyncio.CancelledError:
+                    raise
+
+                except Exception:
+                    # Give up once there's nothing left worth refreshing
+                    entry = self.entries.get(key)
+
+                    if entry is None or writes != self.writes or \
+                            self.loop.time() - entry[0] > \
+                            self.max_age + self.window:
+                        return
+
+                    await asyncio.sleep(self.retry_interval, loop=self.loop)
+                    writes = self.writes
+                    flight = asyncio.ensure_future(fetch(), loop=self.loop)
+
+                else:
+                    self.store(key, result, writes)
+                    return
+
+        finally:
+            del self.refreshing[key]
+
+    def forget(self, key=None):
+        """Drop the result for `key`, or every result. A write calls this
+        once it's committed."""
+        self.writes += 1
+
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+    async def close(self):
+        tasks = list(self.refreshing.values())
+
+        for task in tasks:
+            task.cancel()
+
+        if tasks:
+            await asyncio.wait(tasks, loop=self.loop)
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits,
+                'stale_hits': self.stale_hits, 'misses': self.misses,
+                'refreshing': len(self.refreshing)}
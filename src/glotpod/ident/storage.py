@@ -0,0 +1,659 @@
+import asyncio
+import re
+
+from collections import defaultdict
+from itertools import count
+
+from psycopg2 import IntegrityError, errorcodes
+from psycopg2.extensions import QueryCanceledError
+from sqlalchemy.sql import select, desc, func
+
+from glotpod.ident import errors
+from glotpod.ident.model import changes, users, services
+from glotpod.ident.records import ChangeRecord, UserRecord, redact
+
+
+__all__ = ['PostgresStorage', 'MemoryStorage', 'DeadlineStorage']
+
+# Service names as stored, and the keys they're represented by
+service_name_map = {'fb': 'facebook', 'gh': 'github'}
+service_key_map = {v: k for k, v in service_name_map.items()}
+
+# Writers hold this advisory lock from recording a change until they
+# commit, so that changes are committed in the order of their cursors, and
+# readers never see a cursor before one that's still to come
+changes_lock = 0x1de47
+
+# Committed changes are announced on this channel, with their cursors
+changes_channel = 'ident_changes'
+
+
+# The storage interface
+# ---------------------
+#
+# Handlers don't talk to the database directly; they open a session on the
+# storage in request['storage'] and work through it::
+#
+#   async with request['storage'].session() as session:
+#       async with session.begin():
+#           user = await session.get_user(id, lock=True)
+#           ...
+#
+# A session has these coroutine methods, which all deal in users in the
+# records.UserRecord tuples, which serialise to the user resource. Access
+# tokens on services are part of it, and are stored encrypted by Postgres
+# storage with its crypto.TokenCipher; without one it can't store them,
+# and raises errors.NoEncryptionKey.
+#
+# get_user(id, *, lock=False)
+#   The user with the given id, or None. With lock, the user can't be
+#   changed by anyone else until the end of the transaction.
+#
+# list_users(params, *, full=True, limit=None)
+#   Users matching the validated search parameters of AllUsers, ordered by
+#   id; just their ids unless full. With a fuzzy search (the 'q' parameter),
+#   only the users whose name or email address is at least `similarity`
+#   similar to it, most similar first, and at most `fuzzy_limit` of them
+#   unless the 'page_size' parameter says otherwise. At most `limit` of
+#   them, if it's given. The records come without access tokens.
+#
+# user_names(*, limit=None)
+#   The id and name of every user, or of up to `limit` users, as a list of
+#   pairs.
+#
+# find_user_by_service(key, sv_id)
+#   The id of the user whose id on the service called `key` ('github' or
+#   'facebook') is sv_id, or None.
+#
+# create_user(data)
+#   Store a new user, and return its id.
+#
+# update_user(id, old, new)
+#   Store the changes to a user from `old` to `new`.
+#
+# list_changes(after, limit, *, shard=0)
+#   Up to `limit` records.ChangeRecords of the changes made by the writes
+#   above, with cursors after `after`, in order. Each write records its
+#   change in the same transaction; cursors only ever increase, in the order
+#   the changes were committed. Each of the storage's `shards` has its own
+#   changes, and cursors; storages which aren't sharded have one.
+#
+# Writes raise errors.Conflict instead of breaking the uniqueness of email
+# addresses, or of ids on a service. begin() returns an async context manager
+# which makes everything inside it one transaction.
+#
+# session() takes an optional timeout, in seconds; statements still running
+# after it are cancelled, and raise errors.Timeout.
+
+
+def trigrams(text):
+    # The trigrams of text as pg_trgm counts them: those of each word,
+    # lower-cased and padded with two spaces in front and one behind
+    found = set()
+
+    for word in re.findall(r'[^\W_]+', text.lower()):
+        word = '  {} '.format(word)
+        found.update(word[i:i + 3] for i in range(len(word) - 2))
+
+    return found
+
+
+def similarity(a, b):
+    # The same as pg_trgm's similarity(): shared trigrams over all of them
+    a, b = trigrams(a), trigrams(b)
+
+    if not a or not b:
+        return 0.0
+
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+def change_document(id, data):
+    # The user resource as a write leaves it, but for the access tokens,
+    # which aren't kept unencrypted
+    return {'id': id, 'name': data['name'], 'email': data['email'],
+            'services': redact(data.get('services', {}))}
+
+
+class PostgresSession:
+
+    def __init__(self, conn, *, similarity=0.3, fuzzy_limit=50, shard=None,
+                 cipher=None):
+        self.conn = conn
+        self.similarity = similarity
+        self.fuzzy_limit = fuzzy_limit
+        self.shard = shard
+        self.cipher = cipher
+
+    def begin(self):
+        return self.conn.begin()
+
+    @staticmethod
+    def search_query(params, full=True, *, similarity=0.3, fuzzy_limit=50,
+                     limit=None):
+        if full:
+            # The columns of a UserRecord, with the user's id on each service
+            # joined in; lists don't serve access tokens, so needn't decrypt
+            # them
+            columns = [users.c.id, users.c.name, users.c.email_address]
+            joined = users
+
+            for key in UserRecord._fields[3:5]:
+                svc = services.alias(key)
+                joined = joined.outerjoin(
+                    svc, (svc.c.user_id == users.c.id) &
+                         (svc.c.sv_name == service_key_map[key])
+                )
+                columns.append(svc.c.sv_id.label(key))
+
+            query = select(columns).select_from(joined)
+
+        else:
+            query = select([users.c.id])
+
+        query = query.order_by(users.c.id)
+
+        if 'email' in params:
+            query = query.where(users.c.email_address == params['email'])
+
+        if 'name' in params:
+            search_string = " & ".join(
+                "{}:*".format(word) for word in params['name'].split(' ')
+            )
+            name_vector = func.to_tsvector(users.c.name)
+
+            query = query.where(name_vector.match(search_string))
+            query = query.order_by(
+                desc(func.ts_rank(name_vector, func.to_tsquery(search_string)))
+            )
+
+        if 'q' in params:
+            # The % operator can use the trigram indexes, but only filters by
+            # pg_trgm.similarity_threshold; the score filters by ours
+            q = params['q']
+            score = func.greatest(func.similarity(users.c.name, q),
+                                  func.similarity(users.c.email_address, q))
+
+            query = query.where(users.c.name.op('%%')(q) |
+                                users.c.email_address.op('%%')(q))
+            query = query.where(score >= similarity)
+            query = query.order_by(None).order_by(desc(score), users.c.id)
+            count = params.get('page_size', fuzzy_limit)
+            query = query.limit(count if limit is None else min(count, limit))
+
+        elif limit is not None:
+            query = query.limit(limit)
+
+        # if 'page_size' in params:
+        #     query = query.limit(params['page_size'])
+        return query
+
+    async def get_user(self, id, *, lock=False):
+        query = select([users], for_update=lock).where(users.c.id == id)
+        row = await (await self.conn.execute(query)).first()
+
+        if row is None:
+            return None
+
+        # The services are locked too, so they can't be joined in; Postgres
+        # can't lock the nullable side of an outer join
+        svc_ids = {}
+        tokens = {}
+        svc_query = select([services], for_update=lock)
+        svc_query = svc_query.where(services.c.user_id == id)
+
+        async for svc_row in self.conn.execute(svc_query):
+            key = service_name_map[svc_row['sv_name']]
+            svc_ids[key] = svc_row['sv_id']
+            tokens[key] = svc_row['access_token']
+
+        record = UserRecord(row['id'], row['name'], row['email_address'],
+                            svc_ids.get('facebook'), svc_ids.get('github'),
+                            tokens.get('facebook'), tokens.get('github'))
+        return (await self.decrypt([record]))[0]
+
+    async def list_users(self, params, *, full=True, limit=None):
+        query = self.search_query(params, full, similarity=self.similarity,
+                                  fuzzy_limit=self.fuzzy_limit, limit=limit)
+
+        if not full:
+            ids = []
+
+            async for row in self.conn.execute(query):
+                ids.append(row['id'])
+
+            return ids
+
+        results = []
+
+        async for row in self.conn.execute(query):
+            results.append(UserRecord(*row.as_tuple()))
+
+        return results
+
+    async def decrypt(self, records):
+        # The records, with their access tokens decrypted all at once; with
+        # no key to decrypt them, they're left out
+        if all(record[5:] == (None, None) for record in records):
+            return records
+
+        if self.cipher is None:
+            return [record._replace(facebook_token=None, github_token=None)
+                    for record in records]
+
+        tokens = iter(await self.cipher.decrypt([
+            token for record in records for token in record[5:]
+        ]))
+
+        return [record._replace(facebook_token=next(tokens),
+                                github_token=next(tokens))
+                for record in records]
+
+    def encrypt(self, svc):
+        # The access token of a service to store, encrypted, or None
+        if 'access_token' not in svc:
+            return None
+
+        if self.cipher is None:
+            raise errors.NoEncryptionKey
+
+        return self.cipher.encrypt(svc['access_token'])
+
+    async def user_names(self, *, limit=None):
+        names = []
+        query = select([users.c.id, users.c.name]).limit(limit)
+
+        async for row in self.conn.execute(query):
+            names.append((row['id'], row['name']))
+
+        return names
+
+    async def find_user_by_service(self, key, sv_id):
+        query = select([services.c.user_id]).where(
+            (services.c.sv_name == service_key_map[key]) &
+            (services.c.sv_id == sv_id)
+        )
+        return await self.conn.scalar(query)
+
+    async def create_user(self, data):
+        try:
+            # Construct the insert query to create the user object
+            query = users.insert().values(
+                name=data['name'],
+                email_address=data['email'],
+                **self.new_id()
+            )
+            user_id = await self.conn.scalar(query.returning(users.c.id))
+
+            for key, svc in sorted(data.get('services', {}).items()):
+                await self.conn.execute(
+                    services.insert().values(
+                        user_id=user_id,
+                        sv_name=service_key_map[key],
+                        sv_id=svc['id'],
+                        access_token=self.encrypt(svc)
+                    )
+                )
+
+        except IntegrityError as e:
+            if e.pgcode == errorcodes.UNIQUE_VIOLATION:
+                raise errors.Conflict from e
+            else:
+                raise
+
+        await self.record_change(user_id, 'new', data)
+        return user_id
+
+    def new_id(self):
+        # In a shard, ids say which shard they're in: they're the shard's
+        # own sequence, times the number of shards, plus its index
+        if self.shard is None:
+            return {}
+
+        index, count = self.shard
+        return {'id': func.nextval('users_id_seq') * count + index}
+
+    async def update_user(self, id, old, new):
+        try:
+            query = users.update() \
+                .where(users.c.id == id) \
+                .values(name=new['name'], email_address=new['email'])
+
+            await self.conn.execute(query)
+
+            for key, svc_name in (('facebook', 'fb'), ('github', 'gh')):
+                matched_record = (
+                    (services.c.user_id == id) &
+                    (services.c.sv_name == svc_name)
+                )
+
+                if key not in new['services'] and key in old['services']:
+                    # if the service was there before, it has to be removed
+                    qry = services.delete(matched_record)
+                    await self.conn.execute(qry)
+
+                elif key in new['services']:
+                    svc = new['services'][key]
+                    args = {'sv_id': svc['id']}
+
+                    # Tokens are only encrypted again when they change
+                    old_token = old['services'].get(key, {}).get(
+                        'access_token'
+                    )
+
+                    if key not in old['services'] or \
+                            svc.get('access_token') != old_token:
+                        args['access_token'] = self.encrypt(svc)
+
+                    if key in old['services']:
+                        qry = services.update(matched_record).values(args)
+
+                    else:
+                        qry = services.insert().values(
+                            sv_name=svc_name,
+                            user_id=id,
+                            **args
+                        )
+
+                    await self.conn.execute(qry)
+
+        except IntegrityError as e:
+            if e.pgcode == errorcodes.UNIQUE_VIOLATION:
+                raise errors.Conflict from e
+            else:
+                raise
+
+        await self.record_change(id, 'patch', new)
+
+    async def record_change(self, id, type, data):
+        # Last in the transaction, as the lock is held until it ends
+        await self.conn.execute(select([func.pg_advisory_xact_lock(
+            changes_lock
+        )]))
+
+        cursor = await self.conn.scalar(changes.insert().values(
+            user_id=id, type=type, document=change_document(id, data)
+        ).returning(changes.c.id))
+
+        # Other processes waiting for changes hear of it once committed
+        await self.conn.execute(select([func.pg_notify(changes_channel,
+                                                       str(cursor))]))
+
+    async def list_changes(self, after, limit, *, shard=0):
+        query = select([changes.c.id, changes.c.user_id, changes.c.type,
+                        changes.c.document]) \
+            .where(changes.c.id > after).order_by(changes.c.id).limit(limit)
+
+        results = []
+
+        async for row in self.conn.execute(query):
+            results.append(ChangeRecord._make(row.as_tuple()))
+
+        return results
+
+
+class PostgresStorage:
+    """Storage in Postgres, through a pool of aiopg connections. Each
+    session holds one pooled connection.
+
+    As one shard of a shards.ShardedStorage, `shard` is its index and the
+    number of shards, which the ids it gives new users encode.
+
+    Access tokens are encrypted, and decrypted, with `cipher`, a
+    crypto.TokenCipher; without one, they can't be stored.
+    """
+    shards = 1
+
+    def __init__(self, engine, *, similarity=0.3, fuzzy_limit=50,
+                 shard=None, cipher=None):
+        self.engine = engine
+        self.similarity = similarity
+        self.fuzzy_limit = fuzzy_limit
+        self.shard = shard
+        self.cipher = cipher
+
+    def session(self, *, timeout=None):
+        return _PostgresSessionContextManager(self, timeout)
+
+
+class _PostgresSessionContextManager:
+
+    def __init__(self, storage, timeout):
+        self.storage = storage
+        self.engine = storage.engine
+        self.timeout = timeout
+        self.conn = None
+        self.transaction = None
+
+    async def __aenter__(self):
+        self.conn = await self.engine.acquire()
+
+        if self.timeout is not None:
+            # SET LOCAL only lasts until the end of a transaction, so the
+            # whole session is one; transactions begun in it are nested
+            try:
+                self.transaction = await self.conn.begin()
+                await self.conn.execute(
+                    "SET LOCAL statement_timeout = {:d}".format(
+                        max(1, int(self.timeout * 1000))
+                    )
+                )
+            except BaseException:
+                await self.engine.release(self.conn)
+                self.conn = None
+                raise
+
+        return PostgresSession(self.conn,
+                               similarity=self.storage.similarity,
+                               fuzzy_limit=self.storage.fuzzy_limit,
+                               shard=self.storage.shard,
+                               cipher=self.storage.cipher)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if self.transaction is not None and self.transaction.is_active:
+                if exc_type is None:
+                    await self.transaction.commit()
+                else:
+                    await self.transaction.rollback()
+        finally:
+            await self.engine.release(self.conn)
+            self.conn = None
+            self.transaction = None
+
+        if isinstance(exc, QueryCanceledError):
+            raise errors.Timeout from exc
+
+
+class MemorySession:
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def begin(self):
+        # Transactions are serialised; nothing else can interleave with the
+        # reads and writes of a transaction
+        return self.storage.lock
+
+    @staticmethod
+    def matches(params, name, email):
+        # The same search as Postgres does, roughly: an exact email address,
+        # and every word of the name as a prefix of some word in the name
+        if 'email' in params and email != params['email']:
+            return False
+
+        if 'name' in params:
+            words = name.lower().split()
+
+            for prefix in params['name'].lower().split():
+                if not any(word.startswith(prefix) for word in words):
+                    return False
+
+        return True
+
+    def record(self, id):
+        name, email = self.storage.users[id]
+        svcs = self.storage.services[id]
+        facebook, facebook_token = svcs.get('facebook', (None, None))
+        github, github_token = svcs.get('github', (None, None))
+        return UserRecord(id, name, email, facebook, github, facebook_token,
+                          github_token)
+
+    async def get_user(self, id, *, lock=False):
+        if id not in self.storage.users:
+            return None
+
+        return self.record(id)
+
+    async def list_users(self, params, *, full=True, limit=None):
+        ids = [id for id, (name, email) in sorted(self.storage.users.items())
+               if self.matches(params, name, email)]
+
+        if 'q' in params:
+            scores = {}
+
+            for id in ids:
+                name, email = self.storage.users[id]
+                score = max(similarity(name, params['q']),
+                            similarity(email, params['q']))
+
+                if score >= self.storage.similarity:
+                    scores[id] = score
+
+            ids = sorted(scores, key=lambda id: (-scores[id], id))
+            ids = ids[:params.get('page_size', self.storage.fuzzy_limit)]
+
+        ids = ids[:limit]
+
+        if full:
+            return [self.record(id)._replace(facebook_token=None,
+                                             github_token=None)
+                    for id in ids]
+
+        return ids
+
+    async def user_names(self, *, limit=None):
+        return [(id, name) for id, (name, email)
+                in self.storage.users.items()][:limit]
+
+    async def find_user_by_service(self, key, sv_id):
+        return self.storage.service_ids.get((key, sv_id))
+
+    def check_unique(self, data, id=None):
+        owner = self.storage.emails.get(data['email'])
+
+        if owner is not None and owner != id:
+            raise errors.Conflict
+
+        for key, svc in data.get('services', {}).items():
+            owner = self.storage.service_ids.get((key, svc['id']))
+
+            if owner is not None and owner != id:
+                raise errors.Conflict
+
+    async def create_user(self, data):
+        self.check_unique(data)
+
+        id = next(self.storage.ids)
+        self.storage.users[id] = (data['name'], data['email'])
+        self.storage.emails[data['email']] = id
+
+        for key, svc in data.get('services', {}).items():
+            self.storage.services[id][key] = (svc['id'],
+                                              svc.get('access_token'))
+            self.storage.service_ids[key, svc['id']] = id
+
+        self.record_change(id, 'new', data)
+        return id
+
+    async def update_user(self, id, old, new):
+        self.check_unique(new, id)
+
+        del self.storage.emails[old['email']]
+        self.storage.users[id] = (new['name'], new['email'])
+        self.storage.emails[new['email']] = id
+
+        for key, svc in old['services'].items():
+            del self.storage.service_ids[key, svc['id']]
+
+        self.storage.services[id] = {}
+
+        for key, svc in new['services'].items():
+            self.storage.services[id][key] = (svc['id'],
+                                              svc.get('access_token'))
+            self.storage.service_ids[key, svc['id']] = id
+
+        self.record_change(id, 'patch', new)
+
+    def record_change(self, id, type, data):
+        changes = self.storage.changes
+        changes.append(ChangeRecord(len(changes) + 1, id, type,
+                                    change_document(id, data)))
+
+    async def list_changes(self, after, limit, *, shard=0):
+        # Cursors count up from 1, so they're one past their index
+        return self.storage.changes[after:after + limit]
+
+
+class MemoryStorage:
+    """Storage in the memory of this process, with the same semantics as
+    Postgres storage. Nothing is persisted; this is meant for tests and for
+    measuring the handlers on their own."""
+    shards = 1
+
+    def __init__(self, *, similarity=0.3, fuzzy_limit=50, shard=None,
+                 loop=None):
+        self.similarity = similarity
+        self.fuzzy_limit = fuzzy_limit
+        self.lock = asyncio.Lock(loop=loop)
+        self.ids = count(1)
+
+        if shard is not None:
+            # Ids say which shard they're in, as in Postgres
+            index, shards = shard
+            self.ids = (id * shards + index for id in count(1))
+
+        # id -> (name, email)
+        self.users = {}
+        # id -> {service key: (service id, access token)}; as nothing is
+        # persisted, the tokens aren't encrypted
+        self.services = defaultdict(dict)
+
+        # Indexes for uniqueness
+        self.emails = {}
+        self.service_ids = {}
+
+        # ChangeRecords, in order
+        self.changes = []
+
+    def session(self, *, timeout=None):
+        # Nothing here takes long enough to need a timeout
+        return _MemorySessionContextManager(self)
+
+
+class DeadlineStorage:
+    """Wraps another storage, so that each session opened through it times
+    out at `deadline`, in the time of `loop`."""
+
+    def __init__(self, storage, deadline, *, loop):
+        self.storage = storage
+        self.shards = storage.shards
+        self.deadline = deadline
+        self.loop = loop
+
+    def session(self):
+        remaining = max(0.001, self.deadline - self.loop.time())
+        return self.storage.session(timeout=remaining)
+
+
+class _MemorySessionContextManager:
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def __aenter__(self):
+        return MemorySession(self.storage)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
@@ -0,0 +1,466 @@
+"""Tracing of requests, through the database and on to the notifications
+they send.
+
+Each request is a span, with a child span for each storage call it makes,
+and for each statement those run in Postgres; notifications sent because of
+it are spans too, and carry the trace on to push.gp in their `traceparent`
+header (https://www.w3.org/TR/trace-context/). Requests which come with a
+`traceparent` continue the trace they belong to.
+
+Finished spans are exported in batches, in a thread, by an exporter: any
+object with an `export(records)` method taking a list of span records,
+which are dicts. The ones here write them to a file as newline-delimited
+JSON, or keep them in memory for tests.
+"""
+import asyncio
+import importlib
+import json
+import logging
+import random
+import re
+import time
+import weakref
+
+from collections import deque
+
+from sqlalchemy.sql.util import find_tables
+
+
+__all__ = ['Tracer', 'TracedStorage', 'FileExporter', 'MemoryExporter',
+           'current_span', 'activate', 'no_span']
+
+log = logging.getLogger(__name__)
+
+traceparent_re = re.compile(
+    r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$'
+)
+
+
+def new_id(bits):
+    return '{:0{}x}'.format(random.getrandbits(bits), bits // 4)
+
+
+def parse_traceparent(header):
+    # The trace id, parent span id and whether the trace is sampled, from a
+    # traceparent header; None if it isn't one
+    match = traceparent_re.match(header.strip().lower())
+
+    if match is None:
+        return None
+
+    version, trace_id, parent_id, flags = match.groups()
+
+    if version == 'ff' or not int(trace_id, 16) or not int(parent_id, 16):
+        return None
+
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+class Span:
+    """Something being done, from when it's started until finish() is
+    called; as a context manager, until the end of the with block."""
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(64)
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.error = None
+
+        self.timestamp = time.time()
+        self.start = tracer.loop.time()
+        self.duration = None
+
+    @property
+    def traceparent(self):
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    def child(self, name, **attributes):
+        """A new span for something done as part of this one."""
+        return Span(self.tracer, name, self.trace_id, self.span_id,
+                    attributes)
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self, error=None):
+        if self.duration is not None:
+            return
+
+        self.duration = self.tracer.loop.time() - self.start
+        self.error = error
+        self.tracer.finished(self)
+
+    def record(self):
+        return {'trace_id': self.trace_id, 'span_id': self.span_id,
+                'parent_id': self.parent_id, 'name': self.name,
+                'timestamp': self.timestamp, 'duration': self.duration,
+                'attributes': self.attributes, 'error': self.error}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish(exc_type.__name__ if exc_type is not None else None)
+
+
+class NullSpan:
+    """A span which isn't recorded, for traces which aren't sampled, and
+    for things done outside of any request; its children are itself."""
+
+    def __init__(self, trace_id=None, span_id=None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+    @property
+    def traceparent(self):
+        if self.trace_id is None:
+            return None
+
+        return '00-{}-{}-00'.format(self.trace_id, self.span_id)
+
+    def child(self, name, **attributes):
+        return self
+
+    def set(self, key, value):
+        pass
+
+    def finish(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+no_span = NullSpan()
+
+# task -> the span of the request it's handling
+_current = weakref.WeakKeyDictionary()
+
+
+def current_span(loop):
+    """The span of the request being handled by the running task, or
+    no_span."""
+    task = asyncio.Task.current_task(loop=loop)
+
+    if task is None:
+        return no_span
+
+    return _current.get(task, no_span)
+
+
+class activate:
+    """Makes `span` the current span of the running task, for the with
+    block."""
+
+    def __init__(self, span, *, loop):
+        self.span = span
+        self.task = asyncio.Task.current_task(loop=loop)
+
+    def __enter__(self):
+        _current[self.task] = self.span
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.pop(self.task, None)
+
+
+class Tracer:
+    """Starts the spans of requests, sampling `sample_rate` of those which
+    don't say whether they're sampled, and exports them once they're
+    finished: `batch_size` at a time, or what's there every
+    `flush_interval` seconds. Past `max_pending` spans waiting to be
+    exported, the rest are dropped.
+    """
+
+    def __init__(self, exporter, *, sample_rate=1.0, batch_size=100,
+                 flush_interval=5, max_pending=10000, loop=None):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.pending = []
+        self.timer = None
+        self.flushing = None
+
+        self.started = 0
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self, name, *, traceparent=None, **attributes):
+        """The span of a request, continuing the trace of its traceparent
+        header if it has one."""
+        parent = parse_traceparent(traceparent) if traceparent else None
+
+        if parent is None:
+            trace_id, parent_id = new_id(128), None
+            sampled = random.random() < self.sample_rate
+        else:
+            trace_id, parent_id, sampled = parent
+
+        if not sampled:
+            return NullSpan(trace_id, new_id(64))
+
+        self.started += 1
+        return Span(self, name, trace_id, parent_id, attributes)
+
+    def finished(self, span):
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            return
+
+        self.pending.append(span.record())
+
+        if len(self.pending) >= self.batch_size:
+            self.flush_soon()
+        elif self.timer is None:
+            self.timer = self.loop.call_later(self.flush_interval,
+                                              self.flush_soon)
+
+    def flush_soon(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.flushing is None:
+            self.flushing = asyncio.ensure_future(self.flush(),
+                                                  loop=self.loop)
+
+    async def flush(self):
+        """Export the spans finished so far."""
+        try:
+            while self.pending:
+                batch, self.pending = self.pending, []
+
+                try:
+                    await self.loop.run_in_executor(None, self.exporter.export,
+                                                    batch)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.exception("Couldn't export %s spans.", len(batch))
+                    self.failed += len(batch)
+                else:
+                    self.exported += len(batch)
+
+        finally:
+            self.flushing = None
+
+    async def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.flushing is not None:
+            await self.flushing
+
+        await self.flush()
+
+    def stats(self):
+        return {'started': self.started, 'exported': self.exported,
+                'pending': len(self.pending), 'dropped': self.dropped,
+                'failed': self.failed}
+
+
+class FileExporter:
+    """Appends span records to the file at `path`, one JSON object per
+    line."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, records):
+        lines = ''.join(json.dumps(record) + '\n' for record in records)
+
+        # One write, so the batches of several processes don't interleave
+        with open(self.path, 'a') as fh:
+            fh.write(lines)
+
+
+class MemoryExporter:
+    """Keeps the last `max_spans` span records, in `spans`."""
+
+    def __init__(self, max_spans=10000):
+        self.spans = deque(maxlen=max_spans)
+
+    def export(self, records):
+        self.spans.extend(records)
+
+
+exporters = {'file': FileExporter, 'memory': MemoryExporter}
+
+
+def make_exporter(cfg):
+    """The exporter for the tracing configuration: "file" or "memory", or
+    the "module:Class" of another, made with the keys of tracing.options."""
+    name = cfg.get('exporter', 'file')
+    options = dict(cfg.get('options', {}))
+
+    if name == 'file':
+        options.setdefault('path', 'traces.ndjson')
+
+    if name in exporters:
+        return exporters[name](**options)
+
+    module, _, attr = name.partition(':')
+    return getattr(importlib.import_module(module), attr)(**options)
+
+
+def operation(query):
+    # What a statement does, and to which tables, without compiling it
+    if isinstance(query, str):
+        return query.split(None, 1)[0].upper() if query.strip() else ''
+
+    tables = []
+    target = getattr(query, 'table', None)
+
+    for table in ([target] if target is not None else []) + \
+            find_tables(query):
+        if table.name not in tables:
+            tables.append(table.name)
+
+    return '{} {}'.format(query.__visit_name__.upper(),
+                          ','.join(tables)).strip()
+
+
+class TracedStorage:
+    """Wraps another storage, so that each call to the sessions opened
+    through it is a child of `span`, and each statement they run in
+    Postgres a child of that."""
+
+    def __init__(self, storage, span):
+        self.storage = storage
+        self.span = span
+
+    def session(self, **kwargs):
+        return _TracedSessionContextManager(self.storage.session(**kwargs),
+                                            self.span)
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+
+class _TracedSessionContextManager:
+
+    def __init__(self, manager, span):
+        self.manager = manager
+        self.span = span
+
+    async def __aenter__(self):
+        return TracedSession(await self.manager.__aenter__(), self.span)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self.manager.__aexit__(exc_type, exc, tb)
+
+
+class TracedSession:
+
+    def __init__(self, session, span):
+        self._session = session
+        self._span = self._current = span
+        self._conns = []
+
+        # Postgres sessions run their statements through a TracedConnection,
+        # and so do the sessions a sharded one opens on each of its shards
+        if hasattr(session, 'on_open'):
+            session.on_open = self._trace
+        else:
+            self._trace(session)
+
+    def _trace(self, session):
+        if getattr(session, 'conn', None) is not None:
+            session.conn = TracedConnection(session.conn, self._current)
+            self._conns.append(session.conn)
+
+    def _activate(self, span):
+        # Make the statements run from now on children of `span`
+        self._current = span
+
+        for conn in self._conns:
+            conn.span = span
+
+    def __getattr__(self, name):
+        attr = getattr(self._session, name)
+
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def traced(*args, **kwargs):
+            with self._span.child('storage.' + name) as span:
+                self._activate(span)
+
+                try:
+                    return await attr(*args, **kwargs)
+                finally:
+                    self._activate(self._span)
+
+        return traced
+
+
+class TracedConnection:
+    """Wraps an aiopg.sa connection, so that each statement it runs is a
+    child of its `span`."""
+
+    def __init__(self, conn, span):
+        self.conn = conn
+        self.span = span
+
+    def execute(self, query, *args, **kwargs):
+        return _TracedExecution(self, query, args, kwargs)
+
+    async def scalar(self, query, *args, **kwargs):
+        span = self.span.child('db.scalar', **{
+            'db.operation': operation(query)
+        })
+
+        with span:
+            return await self.conn.scalar(query, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class _TracedExecution:
+    # What conn.execute() returns: awaited, or iterated over in async for
+
+    def __init__(self, traced, query, args, kwargs):
+        self.traced = traced
+        self.query = query
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+
+    async def run(self):
+        span = self.traced.span.child('db.execute', **{
+            'db.operation': operation(self.query)
+        })
+
+        with span:
+            return await self.traced.conn.execute(self.query, *self.args,
+                                                  **self.kwargs)
+
+    def __await__(self):
+        return self.run().__await__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.result is None:
+            self.result = await self.run()
+
+        row = await self.result.fetchone()
+
+        if row is None:
+            raise StopAsyncIteration
+
+        return row
@@ -39,13 +39,14 @@ class ModelFixture:
         ).fetchone()
 
 
+def connect_url(cfg):
+    return 'postgresql://{user}:{password}' \
+           '@{host}:{port}/{database}'.format(**cfg)
+
+
 @pytest.fixture(scope="session")
 def dbengine(config):
-    cfg = config['database']['postgres']
-    connect_url = 'postgresql://{user}:{password}' \
-                  '@{host}:{port}/{database}'.format(**cfg)
-
-    engine = create_engine(connect_url)
+    engine = create_engine(connect_url(config['database']['postgres']))
     metadata.drop_all(engine)  # remove traces of any old data
     return engine
 
@@ -62,6 +63,64 @@ def model(dbconn, dbengine):
     metadata.drop_all(dbengine)
 
 
+@pytest.yield_fixture
+def shard_engines(app, config, dbengine):
+    # Pools for two more databases, created alongside the test database if
+    # they aren't there, as the shards of a sharded storage
+    cfg = config['database']['postgres']
+    conn = dbengine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    engines, shards = [], []
+
+    for index in range(2):
+        database = '{}.shard{}'.format(cfg['database'], index)
+        shard_cfg = dict(cfg, database=database)
+        exists = conn.execute("SELECT 1 FROM pg_database WHERE datname = %s",
+                              database).scalar()
+
+        if not exists:
+            conn.execute('CREATE DATABASE "{}"'.format(database))
+
+        engine = create_engine(connect_url(shard_cfg))
+        metadata.drop_all(engine)
+        metadata.create_all(engine)
+        engines.append(engine)
+
+        shards.append(app.loop.run_until_complete(
+            aiopg.sa.create_engine(loop=app.loop, **shard_cfg)
+        ))
+
+    yield shards
+
+    for shard, engine in zip(shards, engines):
+        shard.close()
+        app.loop.run_until_complete(shard.wait_closed())
+        metadata.drop_all(engine)
+
+    conn.close()
+
+
+class Clock:
+    # Stands in for an event loop's time(), for tests to move on by hand
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.yield_fixture
+def loop():
+    # A fresh event loop, for tests which don't need the app's
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
 @pytest.fixture(scope="session")
 def config():
     cfg = load_config()
@@ -97,9 +156,11 @@ def app(config):
         )
     )
     yield app
+    # Shutting down stops the tasks holding pooled connections, such as the
+    # change listener, which closing the pool waits for
+    event_loop.run_until_complete(app.shutdown())
     app['db_engine'].close()
     event_loop.run_until_complete(app['db_engine'].wait_closed())
-    event_loop.run_until_complete(app.shutdown())
 
 
 @pytest.fixture
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from glotpod.ident.admission import Limiter, Overloaded
+
+
+def test_limiter_queues_then_admits(loop):
+    limiter = Limiter(1, queue_size=1, deadline=1.0, loop=loop)
+
+    async def run():
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire(), loop=loop)
+        await asyncio.sleep(0, loop=loop)
+        assert limiter.stats()['queued'] == 1
+
+        limiter.release(0.01)
+        await waiting
+        assert limiter.active == 1
+        limiter.release(0.01)
+
+    loop.run_until_complete(run())
+    assert limiter.active == 0
+    assert limiter.admitted == 2
+
+
+def test_limiter_rejects_when_queue_full(loop):
+    limiter = Limiter(1, queue_size=1, deadline=1.0, loop=loop)
+
+    async def run():
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire(), loop=loop)
+        await asyncio.sleep(0, loop=loop)
+
+        with pytest.raises(Overloaded) as e:
+            await limiter.acquire()
+
+        assert e.value.retry_after >= 1
+        waiting.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    loop.run_until_complete(run())
+    assert limiter.rejected == 1
+
+
+def test_limiter_rejects_long_waits(loop):
+    limiter = Limiter(1, queue_size=10, deadline=0.5, loop=loop)
+    limiter.service_time = 2.0
+
+    async def run():
+        await limiter.acquire()
+
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+
+    loop.run_until_complete(run())
+    assert limiter.rejected == 1
+
+
+def test_limiter_times_out(loop):
+    limiter = Limiter(1, queue_size=10, deadline=0.01, loop=loop)
+
+    async def run():
+        await limiter.acquire()
+
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+
+    loop.run_until_complete(run())
+    assert limiter.timed_out == 1
+    assert limiter.stats()['queued'] == 0
@@ -0,0 +1,108 @@
+import pytest
+
+from glotpod.ident import admission
+
+
+@pytest.fixture
+def model(model):
+    id = model.add_user(name="Ned Stark", email_address="hand@headless.north")
+    model.add_github_info(sv_id=1000, user_id=id)
+
+    model.add_user(name="Jon Snow", email_address="clueless@wall.north")
+    return model
+
+
+def test_batch(model, client):
+    result = client.post_json('/batch', {'requests': [
+        {'method': 'GET', 'path': '/1'},
+        {'method': 'GET', 'path': '/?name=Snow',
+         'headers': {'Accept': 'application/vnd.glotpod.resource-url+json'}},
+        {'method': 'POST', 'path': '/',
+         'body': {'name': "Arya Stark", 'email': "needle@faceless.east"}},
+        {'method': 'PATCH', 'path': '/2',
+         'body': [{'op': 'replace', 'path': '/name', 'value': "Jon"}]},
+        {'method': 'GET', 'path': '/5'},
+        {'method': 'GET', 'path': '/_stats'},
+    ]})
+    assert result.status_code == 200
+
+    responses = result.json
+    assert [response['status'] for response in responses] == \
+        [200, 200, 201, 200, 404, 404]
+
+    assert responses[0]['body'] == {
+        'id': 1, 'name': "Ned Stark", 'email': "hand@headless.north",
+        'services': {'github': {'id': '1000'}}
+    }
+    assert responses[1]['body'] == ['/2']
+    assert responses[2]['headers']['Location'] == '/3'
+    assert responses[3]['body']['name'] == "Jon"
+
+    assert client.get('/3').json['name'] == "Arya Stark"
+    assert client.get('/2').json['name'] == "Jon"
+
+
+def test_batch_order(model, client):
+    # Reads see the writes sent before them, and only those
+    result = client.post_json('/batch', {'requests': [
+        {'method': 'GET', 'path': '/2'},
+        {'method': 'PATCH', 'path': '/2',
+         'body': [{'op': 'replace', 'path': '/name', 'value': "Jon"}]},
+        {'method': 'GET', 'path': '/2'},
+    ]})
+    assert [response['body']['name'] for response in result.json] == \
+        ["Jon Snow", "Jon", "Jon"]
+
+
+def test_batch_atomic(model, client):
+    result = client.post_json('/batch', {'atomic': True, 'requests': [
+        {'method': 'POST', 'path': '/',
+         'body': {'name': "Arya Stark", 'email': "needle@faceless.east"}},
+        {'method': 'PATCH', 'path': '/1', 'body': [
+            {'op': 'replace', 'path': '/email', 'value': "clueless@wall.north"}
+        ]},
+        {'method': 'PATCH', 'path': '/2',
+         'body': [{'op': 'replace', 'path': '/name', 'value': "Jon"}]},
+    ]})
+    assert result.status_code == 200
+    assert [response['status'] for response in result.json] == \
+        [424, 409, 424]
+
+    # None of it was done
+    assert client.get('/?name=Arya').json == []
+    assert client.get('/2').json['name'] == "Jon Snow"
+
+
+def test_batch_admission(model, client, app, monkeypatch):
+    # Reads are admitted like requests of their own...
+    monkeypatch.setitem(app, 'admission', admission.AdmissionController(
+        {'read_limit': 1, 'queue_size': 0}, loop=app.loop
+    ))
+    requests = [{'method': 'GET', 'path': '/1'}] * 3
+
+    # Which of them is admitted is up to the order they're scheduled in
+    result = client.post_json('/batch', {'requests': requests})
+    assert sorted(response['status'] for response in result.json) == \
+        [200, 503, 503]
+
+    # ...and only so many at once
+    monkeypatch.setitem(app['config'], 'batch', {'read_concurrency': 1})
+
+    result = client.post_json('/batch', {'requests': requests})
+    assert [response['status'] for response in result.json] == \
+        [200, 200, 200]
+
+
+@pytest.mark.parametrize('data, code', [
+    ([], 400),
+    ({'requests': [{'method': 'DELETE', 'path': '/1'}]}, 400),
+    ({'requests': [{'method': 'GET'}]}, 400),
+    ({'requests': [{'method': 'GET', 'path': '/1'}] * 51}, 413),
+    ({'atomic': True, 'requests': [
+        {'method': 'PATCH', 'path': '/1', 'body': []},
+        {'method': 'GET', 'path': '/1'},
+    ]}, 400),
+])
+def test_batch_errors(model, client, data, code):
+    result = client.post_json('/batch', data, expect_errors=True)
+    assert result.status_code == code
@@ -0,0 +1,209 @@
+import csv
+import io
+import json
+
+import msgpack
+import pytest
+
+from glotpod.ident.bulk import copy_export, copy_import
+from glotpod.ident.config import shard_args
+from glotpod.ident.shards import ShardRouter
+
+
+@pytest.fixture
+def model(model):
+    id = model.add_user(name="Ned Stark", email_address="hand@headless.north")
+    model.add_github_info(sv_id=1000, user_id=id)
+
+    model.add_user(name="Jon Snow", email_address="clueless@wall.north")
+
+    id = model.add_user(name="Robb Stark", email_address="king@deceased.north")
+    model.add_github_info(sv_id=25, user_id=id)
+    model.add_facebook_info(sv_id=75, user_id=id)
+
+    return model
+
+
+@pytest.fixture
+def db_args(config):
+    return shard_args(config)
+
+
+def export(args, fmt):
+    fh = io.BytesIO()
+    copy_export(args, fmt, fh)
+    return fh.getvalue()
+
+
+def test_export(model, client):
+    # WebTest can only read bodies with a Content-Length, so this only
+    # checks how the response is framed; the formats are tested below
+    result = client.get('/export', headers={'Accept': 'text/csv'})
+    assert result.status_code == 200
+    assert result.content_type == 'text/csv'
+    assert 'Transfer-Encoding' not in result.headers
+
+    result = client.get('/export', headers={'Accept': 'text/csv'},
+                        extra_environ={'SERVER_PROTOCOL': 'HTTP/1.1'})
+    assert result.status_code == 200
+    assert result.headers['Transfer-Encoding'] == 'chunked'
+
+
+def test_export_csv(model, db_args):
+    rows = list(csv.DictReader(io.StringIO(export(db_args, 'csv').decode())))
+    assert rows == [
+        {'id': '1', 'name': "Ned Stark", 'email': "hand@headless.north",
+         'facebook': '', 'github': '1000'},
+        {'id': '2', 'name': "Jon Snow", 'email': "clueless@wall.north",
+         'facebook': '', 'github': ''},
+        {'id': '3', 'name': "Robb Stark", 'email': "king@deceased.north",
+         'facebook': '75', 'github': '25'},
+    ]
+
+
+def test_export_ndjson(model, db_args):
+    model.add_user(name='Back\\slash "Quoted"', email_address="odd@name.net")
+
+    text = export(db_args, 'ndjson').decode()
+    items = [json.loads(line) for line in text.splitlines()]
+    assert items == [
+        {'id': 1, 'name': "Ned Stark", 'email': "hand@headless.north",
+         'services': {'github': {'id': '1000'}}},
+        {'id': 2, 'name': "Jon Snow", 'email': "clueless@wall.north",
+         'services': {}},
+        {'id': 3, 'name': "Robb Stark", 'email': "king@deceased.north",
+         'services': {'facebook': {'id': '75'}, 'github': {'id': '25'}}},
+        {'id': 4, 'name': 'Back\\slash "Quoted"', 'email': "odd@name.net",
+         'services': {}},
+    ]
+
+
+def test_export_msgpack(model, db_args):
+    data = io.BytesIO(export(db_args, 'msgpack'))
+    items = list(msgpack.Unpacker(data, encoding='utf-8'))
+    assert [item['id'] for item in items] == [1, 2, 3]
+    assert items[2] == {
+        'id': 3, 'name': "Robb Stark", 'email': "king@deceased.north",
+        'services': {'facebook': {'id': '75'}, 'github': {'id': '25'}}
+    }
+
+
+def test_export_media_type(model, client):
+    result = client.get('/export', headers={'Accept': 'text/html'},
+                        expect_errors=True)
+    assert result.status_code == 406
+
+
+def test_import_csv(model, client, db_args):
+    data = io.BytesIO(
+        b"name,email,github,facebook\n"
+        b"Arya Stark,needle@faceless.east,,2000\n"
+        b"Sansa Stark,lady@vale.north,25,\n"
+        b"Bran Stark,,,\n"
+        b"Rickon Stark,needle@faceless.east,,\n"
+        b"Theon Greyjoy,reek@dreadfort.north, 500 ,\n"
+    )
+    rejects = io.BytesIO()
+
+    counts = copy_import(db_args, 'csv', data, rejects)
+    assert counts == {'users': 2, 'services': 2, 'rejected': 3}
+
+    result = client.get('/?name=Greyjoy')
+    assert result.json[0]['services'] == {'github': {'id': '500'}}
+
+    rows = list(csv.DictReader(io.StringIO(rejects.getvalue().decode())))
+    assert [(row['record'], row['reason']) for row in rows] == [
+        ('2', "github id already in use"),
+        ('3', "missing email"),
+        ('4', "duplicate email in input"),
+    ]
+
+
+def test_import_ndjson(model, client, db_args):
+    data = io.BytesIO(
+        b'{"id": 10, "name": "Arya Stark", "email": "needle@faceless.east",'
+        b' "services": {"facebook": {"id": "2000"}}}\n'
+        b'{"name": "Bran Stark", "email": "raven@tree.north"}\n'
+        b'{"name": 9, "email": "reek@dreadfort.north"}\n'
+        b'{"id": 1, "name": "Ned Stark", "email": "ned@headless.north"}\n'
+    )
+
+    counts = copy_import(db_args, 'ndjson', data)
+    assert counts == {'users': 2, 'services': 1, 'rejected': 2}
+
+    assert client.get('/10').json['services'] == {'facebook': {'id': '2000'}}
+    assert client.get('/11').json['name'] == "Bran Stark"
+
+
+def test_import_msgpack(model, client, db_args):
+    docs = [
+        {'id': 10, 'name': "Arya Stark", 'email': "needle@faceless.east",
+         'services': {'facebook': {'id': '2000'}}},
+        {'name': "Bran Stark", 'email': "raven@tree.north"},
+        {'name': 9, 'email': "reek@dreadfort.north"},
+        ["Rickon Stark"],
+    ]
+    data = io.BytesIO(b''.join(msgpack.packb(doc) for doc in docs))
+
+    counts = copy_import(db_args, 'msgpack', data)
+    assert counts == {'users': 2, 'services': 1, 'rejected': 2}
+
+    assert client.get('/10').json['services'] == {'facebook': {'id': '2000'}}
+    assert client.get('/11').json['name'] == "Bran Stark"
+
+
+def test_import_csv_header(model, db_args):
+    with pytest.raises(ValueError):
+        copy_import(db_args, 'csv', io.BytesIO(b"name,password\n"))
+
+
+@pytest.fixture
+def shards(config, shard_engines):
+    cfg = config['database']['postgres']
+    return [dict(cfg, database='{}.shard{}'.format(cfg['database'], index))
+            for index in range(2)]
+
+
+def test_shards(shards):
+    data = io.BytesIO(
+        b"id,name,email,github\n"
+        b"3,Ned Stark,hand@headless.north,1000\n"
+        b",Arya Stark,needle@faceless.east,\n"
+        b",Sansa Stark,lady@vale.north,\n"
+        b",Bran Stark,raven@tree.north,\n"
+        b",Theon Greyjoy,reek@dreadfort.north,1000\n"
+    )
+    counts = copy_import(shards, 'csv', data)
+    assert counts == {'users': 4, 'services': 1, 'rejected': 1}
+
+    # Users already in either shard are checked against
+    data = io.BytesIO(
+        b"name,email,github\n"
+        b"Robb Stark,king@deceased.north,1000\n"
+        b"Benjen Stark,hand@headless.north,\n"
+    )
+    rejects = io.BytesIO()
+
+    counts = copy_import(shards, 'csv', data, rejects)
+    assert counts == {'users': 0, 'services': 0, 'rejected': 2}
+
+    rows = list(csv.DictReader(io.StringIO(rejects.getvalue().decode())))
+    assert [row['reason'] for row in rows] == \
+        ["github id already in use", "email already in use"]
+
+    # Each is in the shard the service would have put it in, with an id
+    # which says so
+    items = [json.loads(line)
+             for line in export(shards, 'ndjson').decode().splitlines()]
+    router = ShardRouter(2)
+    ids = {item['email']: item['id'] for item in items}
+
+    assert len(set(ids.values())) == 4
+    assert ids['hand@headless.north'] == 3
+
+    for email, id in ids.items():
+        if id != 3:
+            assert router.for_id(id) == router.for_email(email)
+
+    assert [router.for_id(item['id']) for item in items] == \
+        sorted(router.for_id(id) for id in ids.values())
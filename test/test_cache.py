@@ -0,0 +1,40 @@
+from glotpod.ident.cache import ResponseCache
+
+
+def test_hit_and_expiry(clock):
+    cache = ResponseCache(ttl=5, loop=clock)
+
+    assert cache.get('key') is None
+    cache.put('key', b'[1, 2]', cache.version)
+    assert cache.get('key') == b'[1, 2]'
+
+    clock.now = 6
+    assert cache.get('key') is None
+    assert cache.stats() == {'entries': 0, 'bytes': 0, 'hits': 1,
+                             'misses': 2, 'hit_ratio': 1 / 3}
+
+
+def test_invalidate(clock):
+    cache = ResponseCache(loop=clock)
+    version = cache.version
+
+    cache.put('key', b'[1]', version)
+    cache.invalidate()
+    assert cache.get('key') is None
+
+    # Fetched before the write, so not kept
+    cache.put('key', b'[1]', version)
+    assert cache.get('key') is None
+
+
+def test_max_bytes(clock):
+    cache = ResponseCache(max_bytes=10, loop=clock)
+
+    cache.put('a', b'1234', cache.version)
+    cache.put('b', b'1234', cache.version)
+    cache.get('a')
+    cache.put('c', b'1234', cache.version)
+    cache.put('d', b'12345678901', cache.version)
+
+    assert list(cache.entries) == ['a', 'c']
+    assert cache.size == 8
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from glotpod.ident.changes import ChangeFeed, event
+from glotpod.ident.records import ChangeRecord
+
+
+@pytest.fixture
+def model(model):
+    model.add_user(name="Ned Stark", email_address="hand@headless.north")
+    return model
+
+
+def test_feed_notify(loop):
+    feed = ChangeFeed(loop=loop)
+
+    async def waiter():
+        return await feed.wait(feed.changed, 1)
+
+    async def run():
+        waiting = loop.create_task(waiter())
+        await asyncio.sleep(0, loop=loop)
+        assert feed.stats()['waiting'] == 1
+
+        feed.notify()
+        return await waiting
+
+    assert loop.run_until_complete(run()) is True
+    assert feed.stats() == {'waiting': 0, 'notifications': 1,
+                            'listening': 0}
+
+
+def test_feed_missed_change(loop):
+    # A change between taking the event and waiting on it still counts
+    feed = ChangeFeed(loop=loop)
+    changed = feed.changed
+    feed.notify()
+
+    assert loop.run_until_complete(feed.wait(changed, 1)) is True
+    assert loop.run_until_complete(feed.wait(feed.changed, 0.01)) is False
+
+
+def test_event():
+    record = ChangeRecord(3, 1, 'new', {'id': 1, 'name': "Ned"})
+    assert event(record) == (b'id: 3\nevent: urn:glotpod:user:new\n'
+                             b'data: {"id": 1, "name": "Ned"}\n\n')
+
+
+def test_changes(model, client):
+    assert client.get('/changes').json == {'changes': [], 'cursor': 0}
+
+    client.post_json('/', {'name': "Arya Stark",
+                           'email': "needle@faceless.east"})
+    client.patch_json('/1', [{'op': 'replace', 'path': '/name',
+                              'value': "Eddard Stark"}],
+                      headers={'Content-Type': 'application/json-patch+json'})
+
+    result = client.get('/changes?wait=1').json
+    assert [(change['type'], change['user']['name'])
+            for change in result['changes']] == [
+        ('urn:glotpod:user:new', "Arya Stark"),
+        ('urn:glotpod:user:patch', "Eddard Stark"),
+    ]
+    assert result['cursor'] == result['changes'][-1]['cursor']
+
+    after = result['changes'][0]['cursor']
+    result = client.get('/changes?after={}&limit=1'.format(after)).json
+    assert [change['user']['id'] for change in result['changes']] == [1]
+
+    result = client.get('/changes?after={}'.format(result['cursor'])).json
+    assert result['changes'] == []
+
+
+@pytest.mark.parametrize('query, code', [
+    ('after=-1', 400), ('limit=0', 400), ('wait=soon', 400),
+    ('since=1', 400), ('shard=1', 404),
+])
+def test_changes_params(model, client, query, code):
+    result = client.get('/changes?' + query, expect_errors=True)
+    assert result.status_code == code
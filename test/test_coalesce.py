@@ -0,0 +1,129 @@
+import asyncio
+
+from glotpod.ident.coalesce import SingleFlight
+
+
+class Fetcher:
+    # Counts its calls, and returns once released
+
+    def __init__(self, loop, result):
+        self.calls = 0
+        self.release = asyncio.Event(loop=loop)
+        self.result = result
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+
+        if isinstance(self.result, Exception):
+            raise self.result
+
+        return self.result
+
+
+def test_concurrent_fetches_are_shared(loop):
+    reads = SingleFlight(loop=loop)
+    fetch = Fetcher(loop, {'id': 1})
+
+    async def run():
+        waiting = [asyncio.ensure_future(reads.run(('user', 1), fetch),
+                                         loop=loop) for _ in range(5)]
+        await asyncio.sleep(0, loop=loop)
+        fetch.release.set()
+        return await asyncio.gather(*waiting, loop=loop)
+
+    results = loop.run_until_complete(run())
+    assert results == [{'id': 1}] * 5
+    assert fetch.calls == 1
+    assert reads.stats() == {'in_flight': 0, 'started': 1, 'joined': 4}
+
+
+def test_different_keys_are_fetched_separately(loop):
+    reads = SingleFlight(loop=loop)
+    fetch = Fetcher(loop, None)
+    fetch.release.set()
+
+    async def run():
+        return await asyncio.gather(reads.run(('user', 1), fetch),
+                                    reads.run(('user', 2), fetch), loop=loop)
+
+    loop.run_until_complete(run())
+    assert fetch.calls == 2
+
+
+def test_errors_are_shared(loop):
+    reads = SingleFlight(loop=loop)
+    fetch = Fetcher(loop, ValueError())
+
+    async def run():
+        waiting = [asyncio.ensure_future(reads.run(('user', 1), fetch),
+                                         loop=loop) for _ in range(2)]
+        await asyncio.sleep(0, loop=loop)
+        fetch.release.set()
+        return await asyncio.gather(*waiting, loop=loop,
+                                    return_exceptions=True)
+
+    results = loop.run_until_complete(run())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert fetch.calls == 1
+
+
+def test_cancelled_caller_leaves_the_fetch(loop):
+    reads = SingleFlight(loop=loop)
+    fetch = Fetcher(loop, 'result')
+
+    async def run():
+        first = asyncio.ensure_future(reads.run(('user', 1), fetch),
+                                      loop=loop)
+        second = asyncio.ensure_future(reads.run(('user', 1), fetch),
+                                       loop=loop)
+        await asyncio.sleep(0, loop=loop)
+
+        first.cancel()
+        fetch.release.set()
+        return await second
+
+    assert loop.run_until_complete(run()) == 'result'
+    assert fetch.calls == 1
+
+
+def test_fetch_cancelled_with_its_last_caller(loop):
+    reads = SingleFlight(loop=loop)
+    fetch = Fetcher(loop, 'result')
+
+    async def run():
+        caller = asyncio.ensure_future(reads.run(('user', 1), fetch),
+                                       loop=loop)
+        await asyncio.sleep(0, loop=loop)
+        flight = reads.flights[('user', 1)]
+
+        caller.cancel()
+        await asyncio.sleep(0.01, loop=loop)
+        return flight
+
+    flight = loop.run_until_complete(run())
+    assert flight.cancelled()
+    assert not reads.flights and not reads.waiting
+
+
+def test_forget_starts_a_new_fetch(loop):
+    reads = SingleFlight(loop=loop)
+    fetch = Fetcher(loop, 'result')
+
+    async def run():
+        first = asyncio.ensure_future(
+            reads.run(('user-list', (), True), fetch), loop=loop
+        )
+        await asyncio.sleep(0, loop=loop)
+
+        reads.forget('user-list')
+        second = asyncio.ensure_future(
+            reads.run(('user-list', (), True), fetch), loop=loop
+        )
+        await asyncio.sleep(0, loop=loop)
+
+        fetch.release.set()
+        await asyncio.gather(first, second, loop=loop)
+
+    loop.run_until_complete(run())
+    assert fetch.calls == 2
@@ -0,0 +1,135 @@
+import pytest
+
+from cryptography.fernet import Fernet
+from sqlalchemy.sql import select
+
+from glotpod.ident import crypto, errors
+from glotpod.ident.config import shard_args
+from glotpod.ident.model import services
+from glotpod.ident.storage import PostgresStorage
+
+
+def test_encrypt_and_decrypt(loop):
+    cipher = crypto.TokenCipher([Fernet.generate_key()], loop=loop)
+    ciphertext = cipher.encrypt('gho_☃')
+
+    assert ciphertext != cipher.encrypt('gho_☃')
+    assert loop.run_until_complete(cipher.decrypt([None, ciphertext])) == \
+        [None, 'gho_☃']
+
+
+def test_cache(loop, clock):
+    cipher = crypto.TokenCipher([Fernet.generate_key()], ttl=5, cache_size=2,
+                                loop=clock)
+    a, b, c = (cipher.encrypt(token) for token in 'abc')
+
+    def decrypt(*ciphertexts):
+        return loop.run_until_complete(cipher.decrypt(list(ciphertexts)))
+
+    assert decrypt(a, b, a) == ['a', 'b', 'a']
+    assert decrypt(a) == ['a']
+    decrypt(c)
+
+    # b was used least recently, and a has expired
+    assert list(cipher.cache) == [a, c]
+    clock.now = 5
+    assert cipher.cached(a) is None
+    assert cipher.stats() == {'cached': 1, 'hits': 1, 'misses': 3,
+                              'hit_ratio': 0.25, 'invalid': 0}
+
+
+def test_decrypt_in_executor(loop):
+    cipher = crypto.TokenCipher([Fernet.generate_key()], inline_limit=1,
+                                loop=loop)
+    ciphertexts = [cipher.encrypt(str(i)) for i in range(20)]
+
+    assert loop.run_until_complete(cipher.decrypt(ciphertexts)) == \
+        [str(i) for i in range(20)]
+
+
+def test_rotate(loop):
+    old, new = Fernet.generate_key(), Fernet.generate_key()
+    ciphertext = crypto.TokenCipher([old], loop=loop).encrypt('gho_1')
+    cipher = crypto.TokenCipher([new, old], loop=loop)
+
+    (rotated, same), invalid = cipher.rotate([ciphertext,
+                                              cipher.encrypt('gho_2')])
+    assert same is None and invalid == 0
+    assert Fernet(new).decrypt(rotated.encode('ascii')) == b'gho_1'
+
+    # Tokens under a key which has been removed are left as they are, and
+    # counted by the caller, on the loop
+    cipher = crypto.TokenCipher([Fernet.generate_key()], loop=loop)
+    assert cipher.rotate([ciphertext]) == ([None], 1)
+    assert cipher.stats()['invalid'] == 0
+
+
+def test_decrypt_removed_key(loop):
+    ciphertext = crypto.TokenCipher([Fernet.generate_key()],
+                                    loop=loop).encrypt('gho_1')
+    cipher = crypto.TokenCipher([Fernet.generate_key()], loop=loop)
+    valid = cipher.encrypt('gho_2')
+
+    assert loop.run_until_complete(cipher.decrypt([ciphertext, valid])) == \
+        [None, 'gho_2']
+    assert list(cipher.cache) == [valid]
+    assert cipher.stats()['invalid'] == 1
+
+
+def test_postgres_access_tokens(app, model, config, fernet):
+    key = config['database']['encryption_key']
+    storage = PostgresStorage(app['db_engine'],
+                              cipher=crypto.TokenCipher([key], loop=app.loop))
+    data = {'name': "Arya Stark", 'email': "noone@braavos.ess",
+            'services': {'github': {'id': '8', 'access_token': 'gho_8'}}}
+
+    async def run(storage, method, *args):
+        async with storage.session() as session:
+            return await getattr(session, method)(*args)
+
+    def stored():
+        async def get():
+            async with app['db_engine'].acquire() as conn:
+                return await conn.scalar(select([services.c.access_token]))
+
+        return app.loop.run_until_complete(get())
+
+    id = app.loop.run_until_complete(run(storage, 'create_user', data))
+
+    assert fernet.decrypt(stored().encode('ascii')) == b'gho_8'
+    assert app.loop.run_until_complete(
+        run(storage, 'get_user', id)
+    ).github_token == 'gho_8'
+    assert app.loop.run_until_complete(
+        run(storage, 'get_user', id)
+    ).representation(tokens=True)['services'] == data['services']
+
+    # Lists don't serve the tokens, so don't decrypt them
+    assert app.loop.run_until_complete(
+        run(storage, 'list_users', {})
+    )[0].github_token is None
+
+    # Encrypted again under a new key
+    new_key = Fernet.generate_key()
+    cipher = crypto.TokenCipher([new_key, key], loop=app.loop)
+
+    assert app.loop.run_until_complete(
+        crypto.reencrypt(app['db_engine'], cipher, loop=app.loop)
+    ) == 1
+    assert Fernet(new_key).decrypt(stored().encode('ascii')) == b'gho_8'
+    assert app.loop.run_until_complete(crypto.reencrypt_shards(
+        shard_args(config), cipher, loop=app.loop
+    )) == 0
+
+    # Without a key, tokens can't be stored, or read
+    storage = PostgresStorage(app['db_engine'])
+
+    with pytest.raises(errors.NoEncryptionKey):
+        app.loop.run_until_complete(run(storage, 'create_user', dict(
+            data, email="arya@winterfell.north",
+            services={'facebook': {'id': '9', 'access_token': 'EAA9'}}
+        )))
+
+    assert app.loop.run_until_complete(
+        run(storage, 'get_user', id)
+    ).github_token is None
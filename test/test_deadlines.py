@@ -0,0 +1,58 @@
+import pytest
+
+from aiohttp.multidict import CIMultiDict
+
+from glotpod.ident import errors
+from glotpod.ident.application import deadline_header, request_timeout
+from glotpod.ident.storage import PostgresStorage
+
+
+class Route:
+    def __init__(self, name):
+        self.name = name
+
+
+class MatchInfo:
+    def __init__(self, name):
+        self.route = Route(name)
+
+
+class Request:
+    # Just what request_timeout looks at
+
+    def __init__(self, route, headers=None):
+        self.match_info = MatchInfo(route)
+        self.headers = CIMultiDict(headers or {})
+
+
+@pytest.mark.parametrize('cfg, route, header, expected', [
+    ({}, 'user', None, None),
+    ({'default': 2}, 'user', None, 2),
+    ({'default': 2, 'routes': {'user-list': 5}}, 'user-list', None, 5),
+    ({'default': 2}, 'user', '0.5', 0.5),
+    ({'default': 2}, 'user', '10', 2),
+    ({}, 'user', '0.5', 0.5),
+    ({'default': 2}, 'user', 'soon', 2),
+    ({'default': 2}, 'user', '-1', 2),
+    ({'default': 2}, 'user', 'inf', 2),
+    ({'default': 2}, 'user', 'nan', 2),
+    ({}, 'user', 'inf', None),
+    ({}, 'user', 'nan', None),
+    ({}, 'user', '1e20', 300),
+    ({'max': 30}, 'user', '1e20', 30),
+    ({'default': 2}, 'user', '1e20', 2),
+])
+def test_request_timeout(cfg, route, header, expected):
+    headers = {deadline_header: header} if header is not None else {}
+    assert request_timeout(Request(route, headers), cfg) == expected
+
+
+def test_statement_timeout(app):
+    store = PostgresStorage(app['db_engine'])
+
+    async def run():
+        async with store.session(timeout=0.05) as session:
+            await session.conn.execute("SELECT pg_sleep(1)")
+
+    with pytest.raises(errors.Timeout):
+        app.loop.run_until_complete(run())
@@ -1,13 +1,19 @@
 import re
 
+from types import SimpleNamespace
+
+import msgpack
 import pytest
 
 from urllib.parse import urlencode
 
+from cryptography.fernet import Fernet
 from hypothesis import given
 from hypothesis.strategies import integers
 from webtest_aiohttp import TestApp as WebtestApp
 
+from glotpod.ident import handlers, storage
+
 
 @pytest.fixture
 def model(model):
@@ -166,6 +172,24 @@ def test_search_users(model, client, params, matched_ids):
     assert [item['id'] for item in result.json] == matched_ids
 
 
+@pytest.mark.parametrize('params, matched_ids', [
+    (dict(q="Rob Stark"), [3, 1]),
+    (dict(q="stark"), [1, 3]),
+    (dict(q="jon snw"), [2]),
+    (dict(q="Rob Stark", page_size=1), [3]),
+    (dict(q="Tyrion Lannister"), []),
+])
+def test_fuzzy_search_users(model, client, params, matched_ids):
+    result = client.get('/?{}'.format(urlencode(params)))
+    assert result.status_code == 200
+    assert [item['id'] for item in result.json] == matched_ids
+
+
+def test_fuzzy_search_needs_a_query(model, client):
+    result = client.get('/?q=+', expect_errors=True)
+    assert result.status_code == 400
+
+
 @pytest.mark.skip(reason="not implemented")
 @given(integers(min_value=1))
 def test_search_item_limit(model, client, page_size):
@@ -338,6 +362,62 @@ def test_patch_user_errors(model, client, ops, id, code):
     assert result.status_code == code
 
 
+def test_get_user_msgpack(model, client):
+    result = client.get("/3", headers={'Accept': 'application/msgpack'})
+    assert result.content_type == 'application/msgpack'
+    assert msgpack.unpackb(result.body, encoding='utf-8') == {
+        'id': 3, 'name': "Robb Stark", 'email': "king@deceased.north",
+        'services': {'facebook': {'id': '75'}, 'github': {'id': '25'}}
+    }
+
+
+@pytest.mark.parametrize('accept, mediatype', [
+    ('*/*', 'application/json'),
+    ('application/*', 'application/json'),
+    ('application/json;q=0.5, application/msgpack', 'application/msgpack'),
+    ('application/msgpack, */*;q=0.1', 'application/msgpack'),
+])
+def test_get_user_prefers_json(model, client, accept, mediatype):
+    result = client.get("/3", headers={'Accept': accept})
+    assert result.content_type == mediatype
+
+
+def test_search_users_msgpack(model, client):
+    result = client.get("/?name=Stark",
+                        headers={'Accept': 'application/msgpack'})
+    assert result.content_type == 'application/msgpack'
+
+    users = msgpack.unpackb(result.body, encoding='utf-8')
+    assert [user['id'] for user in users] == [1, 3]
+    assert users[0] == client.get("/1").json
+
+
+def test_create_and_patch_user_msgpack(model, client):
+    data = {'name': "Clara Oswald", 'email': "gone@tardis.vortex",
+            'services': {'github': {'id': '75'}}}
+    headers = {'Content-Type': 'application/msgpack',
+               'Accept': 'application/msgpack'}
+
+    result = client.post("/", msgpack.packb(data, use_bin_type=True),
+                         headers=headers)
+    assert result.status_code == 201
+
+    id = msgpack.unpackb(result.body, encoding='utf-8')['id']
+    assert client.get("/{}".format(id)).json == dict(data, id=id)
+
+    ops = [{'op': 'replace', 'path': '/name', 'value': "Oswin"}]
+    result = client.patch("/{}".format(id), msgpack.packb(ops),
+                          headers=headers)
+    assert result.status_code == 200
+    assert msgpack.unpackb(result.body, encoding='utf-8')['name'] == "Oswin"
+
+
+def test_create_user_undecodable(model, client):
+    result = client.post("/", b'\xc1', expect_errors=True,
+                         headers={'Content-Type': 'application/msgpack'})
+    assert result.status_code == 400
+
+
 def test_patch_user_invalid_media_type(model, client):
     result = client.patch_json("/1", [], expect_errors=True)
     assert result.status_code == 415
@@ -347,3 +427,76 @@ def test_get_user_no_service(model, client):
     id = model.add_user(name="Jimmy Olsen", email_address="jo@daily.com")
     result = client.get("/{}".format(id))
     assert result.status_code != 404
+
+
+def test_access_token_without_key(model, client, app, monkeypatch):
+    # Tokens can't be stored without a key to encrypt them with
+    monkeypatch.setitem(app, 'storage',
+                        storage.PostgresStorage(app['db_engine']))
+    data = {'name': "Clara Oswald", 'email': "gone@tardis.vortex",
+            'services': {'github': {'id': '75', 'access_token': 'gho_75'}}}
+
+    result = client.post_json("/", data, expect_errors=True)
+    assert result.status_code == 422
+
+    ops = [{'op': 'add', 'path': '/services/github/access_token',
+            'value': 'gho_1000'}]
+    result = client.patch_json(
+        "/1", ops, expect_errors=True,
+        headers={'Content-Type': 'application/json-patch+json'}
+    )
+    assert result.status_code == 422
+    assert client.get("/1").json['services'] == {'github': {'id': '1000'}}
+
+
+def test_access_token_under_removed_key(model, client):
+    # Tokens under a key which is no longer configured are left out
+    fernet = Fernet(Fernet.generate_key())
+    id = model.add_user(name="Jimmy Olsen", email_address="jo@daily.com")
+    model.add_github_info(sv_id=8, user_id=id,
+                          access_token=fernet.encrypt(b'gho_8').decode())
+
+    result = client.get("/{}".format(id))
+    assert result.status_code == 200
+    assert result.json['services'] == {'github': {'id': '8'}}
+
+
+def test_access_tokens(model, client):
+    # Tokens are only served by their own route
+    data = {'name': "Clara Oswald", 'email': "gone@tardis.vortex",
+            'services': {'github': {'id': '75', 'access_token': 'gho_75'}}}
+    id = client.post_json("/", data).json['id']
+
+    assert client.get("/{}".format(id)).json['services'] == \
+        {'github': {'id': '75'}}
+    assert client.get("/?name=Oswald").json[0]['services'] == \
+        {'github': {'id': '75'}}
+
+    ops = [{'op': 'add', 'path': '/services/facebook',
+            'value': {'id': '8', 'access_token': 'EAA8'}}]
+    result = client.patch_json(
+        "/{}".format(id), ops,
+        headers={'Content-Type': 'application/json-patch+json'}
+    )
+    assert result.json['services'] == \
+        {'github': {'id': '75'}, 'facebook': {'id': '8'}}
+
+    result = client.get("/{}/access_tokens".format(id))
+    assert result.json == {'github': 'gho_75', 'facebook': 'EAA8'}
+    assert result.headers['Cache-Control'] == 'no-store'
+
+    assert client.get("/99/access_tokens", expect_errors=True).status_code \
+        == 404
+
+
+def test_reads_fetch_from_the_app_storage(app):
+    # Fetches may be shared with other requests, or outlive this one, so
+    # they don't get its storage, with its deadline
+    async def fetch(storage):
+        return storage
+
+    request = SimpleNamespace(app=app)
+    result, _ = app.loop.run_until_complete(
+        handlers.read(request, ('user', 1), fetch)
+    )
+    assert result is app['storage']
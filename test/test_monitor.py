@@ -0,0 +1,57 @@
+import asyncio
+import json
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+from glotpod.ident.monitor import LoopMonitor, Stats, percentile
+
+
+@pytest.mark.parametrize('values, q, expected', [
+    ([], 50, None),
+    ([3], 99, 3),
+    ([5, 1, 4, 2, 3], 50, 3),
+    (list(range(1, 101)), 90, 90),
+    (list(range(1, 101)), 100, 100),
+])
+def test_percentile(values, q, expected):
+    assert percentile(values, q) == expected
+
+
+def test_loop_monitor_records_stalls():
+    loop = asyncio.new_event_loop()
+    monitor = LoopMonitor(loop, interval=0.01, threshold=0.05)
+    monitor.in_flight['user'] += 1
+
+    async def stall():
+        await asyncio.sleep(0.05, loop=loop)
+        time.sleep(0.1)  # block the loop
+        await asyncio.sleep(0.05, loop=loop)
+
+    try:
+        monitor.start()
+        loop.run_until_complete(stall())
+        monitor.stop()
+    finally:
+        loop.close()
+
+    stats = monitor.stats()
+    assert stats['samples'] > 0
+    assert stats['slow_count'] >= 1
+    assert stats['lag']['max'] >= 0.05
+    assert stats['slow_callbacks'][0]['routes'] == ['user']
+
+
+def test_stats(app):
+    request = SimpleNamespace(app=app)
+    res = app.loop.run_until_complete(Stats(request).get())
+    stats = json.loads(res.text)
+    assert 'gc' in stats['runtime']
+
+
+def test_stats_route_needs_monitor(client):
+    # The test settings leave the monitor disabled
+    result = client.get('/_stats', expect_errors=True)
+    assert result.status_code == 404
@@ -1,3 +1,6 @@
+import asyncio
+import logging
+
 import pytest
 
 from glotpod.ident import notifications
@@ -40,3 +43,206 @@ def test_create_user_notification(client, events):
         'user_id': result.json['id'], 'type': 'urn:glotpod:user:new',
         'scope': 'user+n', 'payload': data
     }]
+
+
+def test_breaker_trips_and_recovers(clock):
+    breaker = notifications.CircuitBreaker(
+        failure_rate=0.5, window=4, min_calls=4, reset_timeout=10, loop=clock
+    )
+
+    for outcome in (breaker.success, breaker.failure, breaker.success):
+        call = breaker.allow()
+        assert call is not None
+        outcome(call)
+
+    assert breaker.state == 'closed'
+    breaker.failure(breaker.allow())
+    assert breaker.state == 'open'
+    assert breaker.allow() is None
+
+    # Half open after the timeout, with one probe at a time
+    clock.now = 10
+    probe = breaker.allow()
+    assert probe is not None
+    assert breaker.allow() is None
+    breaker.failure(probe)
+    assert breaker.state == 'open'
+
+    clock.now = 20
+    breaker.success(breaker.allow())
+    assert breaker.state == 'closed'
+    assert breaker.stats() == {'state': 'closed', 'opened': 2,
+                               'short_circuited': 2}
+
+
+def test_breaker_needs_min_calls(clock):
+    breaker = notifications.CircuitBreaker(min_calls=3, loop=clock)
+
+    breaker.failure(breaker.allow())
+    breaker.failure(breaker.allow())
+    assert breaker.state == 'closed'
+
+    breaker.failure(breaker.allow())
+    assert breaker.state == 'open'
+
+
+def test_breaker_ignores_earlier_calls(clock):
+    breaker = notifications.CircuitBreaker(min_calls=1, reset_timeout=10,
+                                           loop=clock)
+    slow = breaker.allow()
+    breaker.failure(breaker.allow())
+    assert breaker.state == 'open'
+
+    # A call from before the breaker opened finishes while it's half open,
+    # and is taken neither for the probe nor against it
+    clock.now = 10
+    probe = breaker.allow()
+    breaker.success(slow)
+    breaker.failure(slow)
+    assert breaker.state == 'half_open'
+    assert breaker.probing == 1
+    assert breaker.allow() is None
+
+    breaker.success(probe)
+    assert breaker.state == 'closed'
+
+
+class StubProtocol(asyncio.Protocol):
+    def __init__(self, stub):
+        self.stub = stub
+        self.buffer = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.stub.transports.append(transport)
+
+    def data_received(self, data):
+        self.buffer += data
+
+        if b'\r\n\r\n' not in self.buffer:
+            return
+
+        self.stub.requests.append(self.buffer.split(b'\r\n', 1)[0])
+        self.buffer = b''
+
+        # Without a status, the request is never answered
+        if self.stub.status is not None:
+            self.transport.write(
+                'HTTP/1.1 {} Stub\r\nContent-Length: 0\r\n'
+                'Connection: close\r\n\r\n'.format(self.stub.status)
+                .encode('ascii')
+            )
+            self.transport.close()
+
+
+class Stub:
+    # A stand-in for push.gp, answering every request with `status`
+    def __init__(self, loop):
+        self.status = 204
+        self.requests = []
+        self.transports = []
+        self.server = loop.run_until_complete(loop.create_server(
+            lambda: StubProtocol(self), '127.0.0.1', 0
+        ))
+        self.host = '127.0.0.1:{}'.format(
+            self.server.sockets[0].getsockname()[1]
+        )
+
+    def close(self):
+        self.server.close()
+
+        for transport in self.transports:
+            transport.close()
+
+
+@pytest.fixture
+def stub(loop):
+    stub = Stub(loop)
+    yield stub
+    stub.close()
+    loop.run_until_complete(stub.server.wait_closed())
+
+
+def make_sender(loop, stub, **kwargs):
+    breaker = notifications.CircuitBreaker(
+        failure_rate=1.0, window=2, min_calls=2, reset_timeout=60,
+        loop=loop
+    )
+    return notifications.Sender(loop, host=stub.host, breaker=breaker,
+                                **kwargs)
+
+
+def send(loop, sender, count=1):
+    async def run():
+        for _ in range(count):
+            sender.notify(1, 'urn:glotpod:user:patch', 'user+n', [])
+
+            if sender.pending:
+                await asyncio.wait(sender.pending, loop=loop)
+
+    loop.run_until_complete(run())
+
+
+def test_sender_breaker(loop, stub):
+    sender = make_sender(loop, stub)
+
+    send(loop, sender)
+    assert stub.requests == [b'POST /users/1 HTTP/1.1']
+
+    stub.status = 503
+    send(loop, sender, 3)
+    loop.run_until_complete(sender.cleanup())
+
+    # The third never reached the service
+    assert len(stub.requests) == 3
+    assert sender.stats() == {'state': 'open', 'opened': 1,
+                              'short_circuited': 1, 'sent': 1, 'failed': 2,
+                              'dropped': 0, 'pending': 0}
+
+
+def test_sender_timeout(loop, stub):
+    sender = make_sender(loop, stub, timeout=0.05)
+    stub.status = None
+
+    send(loop, sender, 2)
+    loop.run_until_complete(sender.cleanup())
+
+    assert sender.failed == 2
+    assert sender.breaker.state == 'open'
+
+
+def test_sender_max_pending(loop, stub):
+    sender = make_sender(loop, stub, max_pending=1)
+    stub.status = None
+
+    sender.notify(1, 'urn:glotpod:user:patch', 'user+n', [])
+    sender.notify(2, 'urn:glotpod:user:patch', 'user+n', [])
+    loop.run_until_complete(sender.cleanup())
+
+    assert sender.dropped == 1
+    assert sender.stats()['pending'] == 0
+
+
+def test_sender_warns_of_drops(loop, stub, clock, caplog):
+    sender = make_sender(loop, stub, max_pending=0, warn_interval=10)
+    sender.loop = clock
+
+    with caplog.at_level(logging.WARNING,
+                         logger='glotpod.ident.notifications'):
+        for _ in range(3):
+            sender.notify(1, 'urn:glotpod:user:patch', 'user+n', [])
+
+        clock.now = 10
+        sender.notify(1, 'urn:glotpod:user:patch', 'user+n', [])
+
+    sender.loop = loop
+    loop.run_until_complete(sender.cleanup())
+
+    warnings = [r.getMessage() for r in caplog.records]
+    assert warnings == [
+        "Dropped 1 notifications; the last because 0 are being sent "
+        "already.",
+        "Dropped 3 notifications; the last because 0 are being sent "
+        "already."
+    ]
+    assert sender.dropped == 4
@@ -0,0 +1,79 @@
+import pytest
+
+from glotpod.ident.prefix import PrefixIndex, words
+from glotpod.ident.storage import MemoryStorage
+
+
+@pytest.fixture
+def storage(loop):
+    storage = MemoryStorage(loop=loop)
+
+    async def seed():
+        async with storage.session() as session:
+            for name, email in (("Ned Stark", "hand@headless.north"),
+                                ("Jon Snow", "clueless@wall.north"),
+                                ("Robb Stark", "king@deceased.north"),
+                                ("Robert Baratheon", "king@dead.south"),
+                                ("Rob Stárk", "rob@stark.north")):
+                await session.create_user({'name': name, 'email': email})
+
+    loop.run_until_complete(seed())
+    return storage
+
+
+@pytest.fixture
+def index(loop, storage):
+    index = PrefixIndex(loop=loop)
+    loop.run_until_complete(index.load(storage))
+    return index
+
+
+def test_words():
+    assert words("Jon  Snow-Targaryen") == ['jon', 'snow', 'targaryen']
+    assert words("Dany_Stormborn") == ['dany', 'stormborn']
+    assert words("Rhaégal") == ['rhaegal']
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("rob", [5, 3, 4]),
+    ("Rob", [5, 3, 4]),
+    ("robb", [3]),
+    ("stark", [1, 3, 5]),
+    ("st ro", [3, 5]),
+    ("ned", [1]),
+    ("tyrion", []),
+    ("", []),
+])
+def test_search(index, text, expected):
+    assert [id for id, name in index.search(text)] == expected
+
+
+def test_search_limit(index):
+    assert index.search("rob", limit=2) == [(5, "Rob Stárk"),
+                                            (3, "Robb Stark")]
+
+
+def test_set(index):
+    index.set(2, "Jon Stark")
+    assert [id for id, name in index.search("stark")] == [1, 2, 3, 5]
+    assert index.search("snow") == []
+
+    index.set(6, "Arya Stark")
+    assert index.search("arya") == [(6, "Arya Stark")]
+
+
+def test_max_entries(loop, index):
+    index.max_entries = len(index.entries) + 1
+    index.set(6, "Arya Stark")
+    assert index.ready is False
+
+
+def test_load_max_entries(loop, storage):
+    # With more users than entries, there are too many words
+    index = PrefixIndex(max_entries=4, loop=loop)
+    loop.run_until_complete(index.load(storage))
+    assert index.ready is False
+
+    index.max_entries = 11
+    loop.run_until_complete(index.load(storage))
+    assert index.ready is True
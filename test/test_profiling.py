@@ -0,0 +1,56 @@
+import asyncio
+
+from types import SimpleNamespace
+
+import pytest
+
+from aiohttp import web
+
+from glotpod.ident.profiling import RequestProfiler
+
+
+def make_request(route, headers=None):
+    match_info = SimpleNamespace(route=SimpleNamespace(name=route))
+    return SimpleNamespace(match_info=match_info, headers=headers or {},
+                           method='GET', path_qs='/')
+
+
+@pytest.fixture
+def profiler():
+    return RequestProfiler('sesame', top=5)
+
+
+async def handler(request):
+    sum(i * i for i in range(1000))
+    return web.Response(body=b'')
+
+
+@pytest.mark.parametrize('headers, wanted', [
+    ({}, False),
+    ({'X-Ident-Profile': 'sesame'}, True),
+    ({'X-Ident-Profile': 'guess'}, False),
+])
+def test_profiler_secret(profiler, headers, wanted):
+    assert profiler.wants(make_request('user', headers)) == wanted
+
+
+def test_profiler_armed_samples(profiler):
+    loop = asyncio.get_event_loop()
+    profiler.arm('user', 2)
+
+    for _ in range(2):
+        request = make_request('user')
+        assert profiler.wants(request)
+        res = loop.run_until_complete(profiler.profile(request, handler))
+        assert 'X-Ident-Profile-Id' in res.headers
+
+    assert not profiler.wants(make_request('user'))
+    assert not profiler.wants(make_request('user-list'))
+
+    assert [p['id'] for p in profiler.profiles] == [1, 2]
+    assert len(profiler.get(1)['functions']) == 5
+
+
+def test_profile_admin_requires_secret(client):
+    result = client.get('/_profile', expect_errors=True)
+    assert result.status_code == 404
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from glotpod.ident.records import UserRecord, json_list, redact
+
+
+@pytest.mark.parametrize('record', [
+    UserRecord(1, "Ned Stark", "hand@headless.north", None, '1000'),
+    UserRecord(2, "Jon Snow", "clueless@wall.north", '1000', None),
+    UserRecord(3, "Robb Stark", "king@deceased.north", '75', '25'),
+    UserRecord(4, "Daenerys \"Stormborn\" Targaryen", "mhysa@ess.os",
+               None, None),
+    UserRecord(5, "Hodor\\Wylis ☃", "hodor@hodor.north", 'h\nd', None),
+    UserRecord(6, "Arya Stark", "noone@braavos.ess", '7', '8',
+               facebook_token='EAA"1', github_token=None),
+    UserRecord(7, "Sansa Stark", "lady@winterfell.north", None, '9',
+               github_token='gho_☃'),
+])
+def test_json(record):
+    assert json.loads(record.json()) == record.representation()
+
+
+def test_json_list():
+    records = [UserRecord(1, "Ned Stark", "hand@headless.north", None, '1'),
+               UserRecord(2, "Jon Snow", "clueless@wall.north", '2', None)]
+
+    assert json.loads(json_list(records)) == \
+        [record.representation() for record in records]
+    assert json_list([]) == '[]'
+
+
+def test_redact():
+    user = {'id': 1, 'name': "Ned Stark", 'email': "hand@headless.north",
+            'services': {'github': {'id': '1', 'access_token': 'gho_1'}}}
+    ops = [{'op': 'replace', 'path': '/services/github/access_token',
+            'value': 'gho_2'},
+           {'op': 'add', 'path': '/services/facebook',
+            'value': {'id': '2', 'access_token': 'EAA2'}},
+           {'op': 'replace', 'path': '/name', 'value': "Eddard Stark"}]
+
+    assert redact(user)['services'] == {'github': {'id': '1'}}
+    assert redact(ops) == [
+        {'op': 'add', 'path': '/services/facebook', 'value': {'id': '2'}},
+        {'op': 'replace', 'path': '/name', 'value': "Eddard Stark"}
+    ]
+    assert user['services']['github']['access_token'] == 'gho_1'
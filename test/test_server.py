@@ -0,0 +1,27 @@
+import logging
+
+import pytest
+
+from glotpod.ident.server import pool_size
+
+
+@pytest.mark.parametrize('pool, workers, expected', [
+    ({}, 4, {}),
+    ({'budget': 40}, 4, {'minsize': 1, 'maxsize': 10}),
+    ({'budget': 3}, 8, {'minsize': 1, 'maxsize': 1}),
+    ({'budget': 40, 'minsize': 5}, 4, {'minsize': 5, 'maxsize': 10}),
+    ({'budget': 40, 'minsize': 20}, 4, {'minsize': 10, 'maxsize': 10}),
+])
+def test_pool_size(pool, workers, expected):
+    config = {'database': {'pool': pool}}
+    assert pool_size(config, workers) == expected
+
+
+def test_pool_size_over_budget(caplog):
+    # Each worker has a connection, even if that's more than the budget
+    config = {'database': {'pool': {'budget': 3}}}
+
+    with caplog.at_level(logging.WARNING, logger='glotpod.ident.server'):
+        assert pool_size(config, 8) == {'minsize': 1, 'maxsize': 1}
+
+    assert "too few for 8 workers" in caplog.text
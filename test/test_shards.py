@@ -0,0 +1,190 @@
+import asyncio
+
+import pytest
+
+from glotpod.ident import errors
+from glotpod.ident.shards import ShardRouter, ShardedStorage
+from glotpod.ident.storage import MemoryStorage, PostgresStorage, \
+    similarity
+
+
+users = [
+    {'name': "Ned Stark", 'email': "hand@headless.north",
+     'services': {'github': {'id': '1000'}}},
+    {'name': "Jon Snow", 'email': "clueless@wall.north",
+     'services': {'facebook': {'id': '1000'}}},
+    {'name': "Robb Stark", 'email': "king@deceased.north",
+     'services': {'github': {'id': '25'}, 'facebook': {'id': '75'}}},
+    {'name': "Arya Stark", 'email': "needle@faceless.east", 'services': {}},
+]
+
+
+@pytest.fixture
+def loop():
+    return asyncio.get_event_loop()
+
+
+@pytest.fixture
+def storage(loop):
+    return ShardedStorage([MemoryStorage(shard=(index, 2), loop=loop)
+                           for index in range(2)], loop=loop)
+
+
+@pytest.fixture
+def ids(loop, storage):
+    async def seed():
+        async with storage.session() as session:
+            return [await session.create_user(data) for data in users]
+
+    return loop.run_until_complete(seed())
+
+
+def run(loop, storage, method, *args, **kwargs):
+    async def call():
+        async with storage.session() as session:
+            return await getattr(session, method)(*args, **kwargs)
+
+    return loop.run_until_complete(call())
+
+
+def test_router():
+    router = ShardRouter(3)
+    assert [router.for_id(id) for id in (3, 4, 5, 6)] == [0, 1, 2, 0]
+
+    # The same in every process
+    assert router.for_email("hand@headless.north") == 2
+    assert router.for_email("needle@faceless.east") == 0
+
+
+def test_placement(storage, ids):
+    # Users are in the shard of their email address, and their ids say so
+    for id, data in zip(ids, users):
+        shard = storage.router.for_email(data['email'])
+        assert storage.router.for_id(id) == shard
+        assert id in storage.storages[shard].users
+
+    assert {storage.router.for_id(id) for id in ids} == {0, 1}
+
+
+def test_get_user(loop, storage, ids):
+    for id, data in zip(ids, users):
+        record = run(loop, storage, 'get_user', id)
+        assert record.representation() == dict(data, id=id)
+
+
+@pytest.mark.parametrize('params, full', [
+    ({}, True), ({}, False), ({'name': "Stark"}, True),
+])
+def test_list_users(loop, storage, ids, params, full):
+    found = run(loop, storage, 'list_users', params, full=full)
+    expected = sorted(id for id, data in zip(ids, users)
+                      if params.get('name', '') in data['name'])
+
+    if full:
+        found = [record.id for record in found]
+
+    assert found == expected
+
+
+def test_list_users_limit(loop, storage, ids):
+    found = run(loop, storage, 'list_users', {'name': "Stark"}, full=False,
+                limit=2)
+    assert found == sorted(id for id, data in zip(ids, users)
+                           if "Stark" in data['name'])[:2]
+    assert len(run(loop, storage, 'user_names', limit=3)) == 3
+
+
+def test_fuzzy_search(loop, storage, ids):
+    found = run(loop, storage, 'list_users', {'q': "stark"}, full=False)
+    assert set(found) == {ids[0], ids[2], ids[3]}
+
+    # Most similar first, across the shards, then by id
+    def rank(id):
+        data = users[ids.index(id)]
+        return -max(similarity(data['name'], "stark"),
+                    similarity(data['email'], "stark")), id
+
+    assert found == sorted(found, key=rank)
+    assert storage.router.for_id(found[0]) != storage.router.for_id(found[1])
+
+    first = run(loop, storage, 'list_users', {'q': "stark", 'page_size': 1})
+    assert [record.id for record in first] == found[:1]
+
+
+def test_find_user_by_service(loop, storage, ids):
+    assert run(loop, storage, 'find_user_by_service', 'github', '25') == \
+        ids[2]
+    assert run(loop, storage, 'find_user_by_service', 'github', '26') is None
+
+
+def test_conflicts_across_shards(loop, storage, ids):
+    # Services of a user on another shard
+    with pytest.raises(errors.Conflict):
+        run(loop, storage, 'create_user', {
+            'name': "Walder Frey", 'email': "frey@twins.river",
+            'services': {'facebook': {'id': '75'}}
+        })
+
+    # Email addresses of users on another shard
+    other = next(id for id in ids
+                 if storage.router.for_id(id) != storage.router.for_id(ids[0]))
+    old = dict(users[ids.index(other)], id=other)
+
+    with pytest.raises(errors.Conflict):
+        run(loop, storage, 'update_user', other, old,
+            dict(old, email=users[0]['email']))
+
+    # A user keeps their own
+    run(loop, storage, 'update_user', other, old, dict(old, name="Snow"))
+
+
+def test_one_shard_per_transaction(loop, storage, ids):
+    by_shard = {storage.router.for_id(id): id for id in ids}
+
+    async def patch_both():
+        async with storage.session() as session:
+            async with session.begin():
+                for id in by_shard.values():
+                    old = (await session.get_user(id)).representation()
+                    await session.update_user(id, old, dict(old, name="X"))
+
+    with pytest.raises(errors.Conflict):
+        loop.run_until_complete(patch_both())
+
+
+def test_list_changes(loop, storage, ids):
+    for shard in range(2):
+        changes = run(loop, storage, 'list_changes', 0, 10, shard=shard)
+        assert [change.user_id for change in changes] == \
+            [id for id in ids if storage.router.for_id(id) == shard]
+        assert [change.cursor for change in changes] == \
+            list(range(1, len(changes) + 1))
+
+
+def test_postgres_shards(app, shard_engines):
+    storage = ShardedStorage([
+        PostgresStorage(engine, shard=(index, 2))
+        for index, engine in enumerate(shard_engines)
+    ], loop=app.loop)
+
+    async def seed():
+        async with storage.session() as session:
+            async with session.begin():
+                return await session.create_user(users[0])
+
+    ids = [app.loop.run_until_complete(seed())]
+    ids += [run(app.loop, storage, 'create_user', data)
+            for data in users[1:]]
+
+    for id, data in zip(ids, users):
+        assert storage.router.for_id(id) == \
+            storage.router.for_email(data['email'])
+        assert run(app.loop, storage, 'get_user', id).representation() == \
+            dict(data, id=id)
+
+    assert run(app.loop, storage, 'list_users', {}, full=False) == sorted(ids)
+    assert run(app.loop, storage, 'find_user_by_service', 'facebook',
+               '75') == ids[2]
+
+    with pytest.raises(errors.Conflict):
+        run(app.loop, storage, 'create_user', dict(users[3], name="Arry"))
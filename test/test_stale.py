@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from glotpod.ident.stale import StaleCache
+
+
+class Database:
+    # Answers fetches with a counter, until it goes down
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.reads = 0
+        self.down = False
+        self.delay = 0
+
+    async def fetch(self):
+        await asyncio.sleep(self.delay, loop=self.loop)
+
+        if self.down:
+            raise OSError("Connection refused")
+
+        self.reads += 1
+        return self.reads
+
+
+def test_fresh_results_are_fetched(loop):
+    cache = StaleCache(loop=loop)
+    db = Database(loop)
+
+    assert loop.run_until_complete(cache.get(('user', 1), db.fetch)) == \
+        (1, {})
+    assert loop.run_until_complete(cache.get(('user', 1), db.fetch)) == \
+        (2, {})
+
+
+def test_results_within_max_age_are_reused(loop):
+    cache = StaleCache(max_age=60, loop=loop)
+    db = Database(loop)
+
+    loop.run_until_complete(cache.get(('user', 1), db.fetch))
+    result, headers = loop.run_until_complete(
+        cache.get(('user', 1), db.fetch)
+    )
+
+    assert result == 1
+    assert headers == {'Age': '0'}
+    assert db.reads == 1
+
+
+def test_stale_result_served_on_error(loop):
+    cache = StaleCache(window=30, retry_interval=0.01, loop=loop)
+    db = Database(loop)
+
+    loop.run_until_complete(cache.get(('user', 1), db.fetch))
+
+    db.down = True
+    result, headers = loop.run_until_complete(
+        cache.get(('user', 1), db.fetch)
+    )
+
+    assert result == 1
+    assert headers['Warning'] == StaleCache.warning
+    assert 'Age' in headers
+    assert ('user', 1) in cache.refreshing
+
+    # The background refresh picks up the fresh result once it can
+    db.down = False
+    loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+
+    assert not cache.refreshing
+    assert cache.entries[('user', 1)][1] == 2
+
+
+def test_stale_result_served_on_timeout(loop):
+    cache = StaleCache(window=30, timeout=0.01, loop=loop)
+    db = Database(loop)
+
+    loop.run_until_complete(cache.get(('user', 1), db.fetch))
+
+    db.delay = 0.05
+    result, headers = loop.run_until_complete(
+        cache.get(('user', 1), db.fetch)
+    )
+    assert result == 1
+    assert 'Warning' in headers
+
+    loop.run_until_complete(asyncio.sleep(0.1, loop=loop))
+    assert cache.entries[('user', 1)][1] == 2
+
+
+def test_errors_without_stale_result(loop):
+    cache = StaleCache(loop=loop)
+    db = Database(loop)
+    db.down = True
+
+    with pytest.raises(OSError):
+        loop.run_until_complete(cache.get(('user', 1), db.fetch))
+
+
+def test_forget(loop):
+    cache = StaleCache(loop=loop)
+    db = Database(loop)
+
+    loop.run_until_complete(cache.get(('user', 1), db.fetch))
+    cache.forget(('user', 1))
+
+    db.down = True
+    with pytest.raises(OSError):
+        loop.run_until_complete(cache.get(('user', 1), db.fetch))
+
+
+def test_size_is_bounded(loop):
+    cache = StaleCache(size=2, loop=loop)
+    db = Database(loop)
+
+    for id in range(5):
+        loop.run_until_complete(cache.get(('user', id), db.fetch))
+
+    assert list(cache.entries) == [('user', 3), ('user', 4)]
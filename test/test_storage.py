@@ -0,0 +1,152 @@
+import asyncio
+
+import pytest
+
+from glotpod.ident import errors
+from glotpod.ident.records import UserRecord
+from glotpod.ident.storage import MemoryStorage
+
+
+@pytest.fixture
+def loop():
+    return asyncio.get_event_loop()
+
+
+@pytest.fixture
+def session(loop):
+    storage = MemoryStorage(loop=loop)
+    session = loop.run_until_complete(storage.session().__aenter__())
+
+    for data in (
+        {'name': "Ned Stark", 'email': "hand@headless.north",
+         'services': {'github': {'id': '1000'}}},
+        {'name': "Jon Snow", 'email': "clueless@wall.north",
+         'services': {'facebook': {'id': '1000'}}},
+        {'name': "Robb Stark", 'email': "king@deceased.north",
+         'services': {'github': {'id': '25'}, 'facebook': {'id': '75'}}},
+    ):
+        loop.run_until_complete(session.create_user(data))
+
+    return session
+
+
+def test_memory_get_user(loop, session):
+    assert loop.run_until_complete(session.get_user(3)) == UserRecord(
+        3, "Robb Stark", "king@deceased.north", facebook='75', github='25'
+    )
+    assert loop.run_until_complete(session.get_user(4)) is None
+
+
+@pytest.mark.parametrize('params, full, expected', [
+    ({}, False, [1, 2, 3]),
+    ({'name': "Stark"}, False, [1, 3]),
+    ({'name': "sta ro"}, False, [3]),
+    ({'email': "clueless@wall.north"}, False, [2]),
+    ({'name': "Stark", 'email': "clueless@wall.north"}, False, []),
+    ({'name': "Snow"}, True, [UserRecord(2, "Jon Snow", "clueless@wall.north",
+                                         facebook='1000', github=None)]),
+])
+def test_memory_list_users(loop, session, params, full, expected):
+    result = loop.run_until_complete(session.list_users(params, full=full))
+    assert result == expected
+
+
+def test_memory_list_users_limit(loop, session):
+    assert loop.run_until_complete(
+        session.list_users({'name': "Stark"}, full=False, limit=1)
+    ) == [1]
+    assert loop.run_until_complete(
+        session.list_users({'q': "Rob Stark"}, full=False, limit=1)
+    ) == [3]
+    assert len(loop.run_until_complete(session.user_names(limit=2))) == 2
+
+
+@pytest.mark.parametrize('params, expected', [
+    ({'q': "Rob Stark"}, [3, 1]),
+    ({'q': "jon snw"}, [2]),
+    ({'q': "Rob Stark", 'page_size': 1}, [3]),
+    ({'q': "Rob Stark", 'name': "Ned"}, [1]),
+    ({'q': "Tyrion Lannister"}, []),
+])
+def test_memory_fuzzy_search(loop, session, params, expected):
+    result = loop.run_until_complete(session.list_users(params, full=False))
+    assert result == expected
+
+
+def test_memory_find_user_by_service(loop, session):
+    find = session.find_user_by_service
+    assert loop.run_until_complete(find('github', '25')) == 3
+    assert loop.run_until_complete(find('facebook', '25')) is None
+
+
+@pytest.mark.parametrize('data', [
+    {'name': "Jack", 'email': "clueless@wall.north", 'services': {}},
+    {'name': "Jack", 'email': "jack@tw.erth",
+     'services': {'github': {'id': '1000'}}},
+])
+def test_memory_create_conflict(loop, session, data):
+    with pytest.raises(errors.Conflict):
+        loop.run_until_complete(session.create_user(data))
+
+    # Nothing is left behind
+    users = loop.run_until_complete(session.list_users({}, full=False))
+    assert users == [1, 2, 3]
+
+
+def test_memory_update_user(loop, session):
+    old = loop.run_until_complete(session.get_user(3)).representation()
+    new = {'id': 3, 'name': "Robb Stark", 'email': "wolf@deceased.north",
+           'services': {'github': {'id': '26'}}}
+
+    loop.run_until_complete(session.update_user(3, old, new))
+    assert loop.run_until_complete(session.get_user(3)).representation() == \
+        new
+
+    # The old values are free to take again
+    loop.run_until_complete(session.create_user({
+        'name': "Walder Frey", 'email': "king@deceased.north",
+        'services': {'github': {'id': '25'}, 'facebook': {'id': '75'}}
+    }))
+
+
+def test_memory_update_conflict(loop, session):
+    old = loop.run_until_complete(session.get_user(1)).representation()
+    new = dict(old, services={'github': {'id': '25'}})
+
+    with pytest.raises(errors.Conflict):
+        loop.run_until_complete(session.update_user(1, old, new))
+
+    assert loop.run_until_complete(session.get_user(1)).representation() == \
+        old
+
+
+def test_memory_list_changes(loop, session):
+    old = loop.run_until_complete(session.get_user(2)).representation()
+    new = dict(old, name="Jon")
+    loop.run_until_complete(session.update_user(2, old, new))
+
+    changes = loop.run_until_complete(session.list_changes(0, 10))
+    assert [change.cursor for change in changes] == [1, 2, 3, 4]
+    assert [change.type for change in changes] == ['new'] * 3 + ['patch']
+    assert changes[-1].user == dict(new, id=2)
+
+    changes = loop.run_until_complete(session.list_changes(2, 1))
+    assert [change.cursor for change in changes] == [3]
+    assert loop.run_until_complete(session.list_changes(4, 10)) == []
+
+
+def test_memory_access_tokens(loop, session):
+    data = {'name': "Arya Stark", 'email': "noone@braavos.ess",
+            'services': {'github': {'id': '8', 'access_token': 'gho_8'}}}
+    id = loop.run_until_complete(session.create_user(data))
+
+    record = loop.run_until_complete(session.get_user(id))
+    assert record.github_token == 'gho_8'
+    assert record.representation(tokens=True)['services'] == \
+        data['services']
+    assert record.representation()['services'] == {'github': {'id': '8'}}
+    assert record.tokens() == {'github': 'gho_8'}
+
+    # Tokens aren't kept in the change log
+    change, = loop.run_until_complete(session.list_changes(3, 10))
+    assert change.user['services'] == {'github': {'id': '8'}}
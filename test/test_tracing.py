@@ -0,0 +1,200 @@
+import asyncio
+
+import pytest
+
+from sqlalchemy.sql import func, select
+
+from glotpod.ident import notifications, tracing
+from glotpod.ident.model import services, users
+from glotpod.ident.shards import ShardedStorage
+from glotpod.ident.storage import MemoryStorage, PostgresStorage
+
+
+@pytest.fixture
+def exporter():
+    return tracing.MemoryExporter()
+
+
+@pytest.fixture
+def tracer(loop, exporter):
+    return tracing.Tracer(exporter, loop=loop)
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01',
+     ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331', True)),
+    ('00-0AF7651916CD43DD8448EB211C80319C-B7AD6B7169203331-00',
+     ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331', False)),
+    ('00-00000000000000000000000000000000-b7ad6b7169203331-01', None),
+    ('00-0af7651916cd43dd8448eb211c80319c-0000000000000000-01', None),
+    ('ff-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01', None),
+    ('00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331', None),
+    ('garbage', None),
+])
+def test_parse_traceparent(header, expected):
+    assert tracing.parse_traceparent(header) == expected
+
+
+@pytest.mark.parametrize('query, expected', [
+    (users.insert().values(name="Ned"), 'INSERT users'),
+    (select([users.c.id, services.c.sv_id]).select_from(
+        users.outerjoin(services, services.c.user_id == users.c.id)
+    ), 'SELECT users,services'),
+    (select([func.pg_notify('ident_changes', '1')]), 'SELECT'),
+    ("SET LOCAL statement_timeout = 100", 'SET'),
+])
+def test_operation(query, expected):
+    assert tracing.operation(query) == expected
+
+
+def test_spans(loop, tracer, exporter):
+    parent = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+    span = tracer.start('GET user', traceparent=parent)
+
+    with span.child('storage.get_user') as child:
+        child.set('found', True)
+
+    with pytest.raises(KeyError):
+        with span.child('storage.list_users'):
+            raise KeyError
+
+    span.finish()
+    loop.run_until_complete(tracer.close())
+
+    records = list(exporter.spans)
+    assert [record['name'] for record in records] == \
+        ['storage.get_user', 'storage.list_users', 'GET user']
+    assert {record['trace_id'] for record in records} == \
+        {'0af7651916cd43dd8448eb211c80319c'}
+
+    get, search, request = records
+    assert request['parent_id'] == 'b7ad6b7169203331'
+    assert get['parent_id'] == search['parent_id'] == request['span_id']
+    assert get['attributes'] == {'found': True}
+    assert search['error'] == 'KeyError'
+    assert tracer.stats()['exported'] == 3
+
+
+def test_unsampled(loop, exporter):
+    tracer = tracing.Tracer(exporter, sample_rate=0, loop=loop)
+    span = tracer.start('GET user')
+
+    # Not recorded, but passed on
+    with span.child('storage.get_user') as child:
+        assert child.traceparent.endswith('-00')
+
+    span.finish()
+    loop.run_until_complete(tracer.close())
+    assert list(exporter.spans) == []
+
+    parent = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+    assert isinstance(tracer.start('GET user', traceparent=parent),
+                      tracing.Span)
+
+
+def test_max_pending(loop, exporter):
+    tracer = tracing.Tracer(exporter, max_pending=2, loop=loop)
+
+    for _ in range(3):
+        tracer.start('GET user').finish()
+
+    loop.run_until_complete(tracer.close())
+    assert len(exporter.spans) == 2
+    assert tracer.stats()['dropped'] == 1
+
+
+def test_traced_storage(loop, tracer, exporter):
+    span = tracer.start('POST user-list')
+    storage = tracing.TracedStorage(MemoryStorage(loop=loop), span)
+
+    async def run():
+        async with storage.session() as session:
+            async with session.begin():
+                id = await session.create_user({
+                    'name': "Ned Stark", 'email': "hand@headless.north"
+                })
+            return await session.get_user(id)
+
+    assert loop.run_until_complete(run()).name == "Ned Stark"
+    span.finish()
+    loop.run_until_complete(tracer.close())
+
+    assert [record['name'] for record in exporter.spans] == \
+        ['storage.create_user', 'storage.get_user', 'POST user-list']
+
+
+def test_traced_shards(app, shard_engines, exporter):
+    # The statements run on each shard are traced too
+    tracer = tracing.Tracer(exporter, loop=app.loop)
+    span = tracer.start('GET user-list')
+    storage = tracing.TracedStorage(ShardedStorage([
+        PostgresStorage(engine, shard=(index, 2))
+        for index, engine in enumerate(shard_engines)
+    ], loop=app.loop), span)
+
+    async def run():
+        async with storage.session() as session:
+            return await session.list_users({}, full=False)
+
+    assert app.loop.run_until_complete(run()) == []
+    span.finish()
+    app.loop.run_until_complete(tracer.close())
+
+    *statements, search, request = exporter.spans
+    assert [record['name'] for record in statements] == ['db.execute'] * 2
+    assert {record['parent_id'] for record in statements} == \
+        {search['span_id']}
+    assert search['name'] == 'storage.list_users'
+
+
+class Response:
+    status = 204
+
+    def release(self):
+        pass
+
+
+class Session:
+    def __init__(self):
+        self.sent = []
+
+    async def post(self, url, *, data, headers):
+        self.sent.append(headers)
+        return Response()
+
+
+def test_notification_traceparent(loop, tracer, exporter):
+    sender = notifications.Sender(loop)
+    loop.run_until_complete(sender.cleanup())
+    sender.session = Session()
+
+    span = tracer.start('PATCH user')
+
+    async def patch():
+        with tracing.activate(span, loop=loop):
+            sender.notify(1, 'urn:glotpod:user:patch', 'user+n', [])
+
+        await asyncio.wait(sender.pending, loop=loop)
+
+    loop.run_until_complete(patch())
+    span.finish()
+    loop.run_until_complete(tracer.close())
+
+    send, request = exporter.spans
+    assert send['name'] == 'notifications.send'
+    assert send['parent_id'] == request['span_id']
+    assert send['attributes']['http.status_code'] == 204
+    assert sender.session.sent[0]['traceparent'] == \
+        '00-{}-{}-01'.format(request['trace_id'], send['span_id'])
+
+
+def test_file_exporter(tmpdir):
+    path = str(tmpdir.join('traces.ndjson'))
+    exporter = tracing.make_exporter({'exporter': 'file',
+                                      'options': {'path': path}})
+
+    exporter.export([{'name': 'a'}])
+    exporter.export([{'name': 'b'}, {'name': 'c'}])
+
+    with open(path) as fh:
+        assert fh.read() == '{"name": "a"}\n{"name": "b"}\n{"name": "c"}\n'
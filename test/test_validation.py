@@ -0,0 +1,126 @@
+import pytest
+
+from voluptuous import All, Any, Coerce, Length, MultipleInvalid, Range, \
+    Remove, Required, Schema
+
+from glotpod.ident import validation
+
+
+# The schemas the validators replace, which they should agree with
+user_schema = Schema({
+    Remove('id'): int,
+    Required('name'): All(str, str.strip, Length(min=1)),
+    Required('email'): All(str, str.strip, Length(min=1)),
+    'services': {
+        Any('github', 'facebook'): {
+            Required('id'): All(str, str.strip, Length(min=1)),
+            'access_token': All(str, str.strip, Length(min=1))
+        }
+    },
+})
+
+params_schema = Schema({
+    'name': str,
+    'email': str,
+    'page_size': All(Coerce(int), Range(min=1)),
+    'after_id': All(Coerce(int), Range(min=1)),
+    'before_id': All(Coerce(int), Range(min=1)),
+    'first': str,
+    'q': All(str, str.strip, Length(min=1))
+})
+
+prefix_schema = Schema({
+    Required('q'): All(str, Length(min=1)),
+    'limit': All(Coerce(int), Range(min=1, max=100))
+})
+
+
+def outcome(validate, exception, data):
+    try:
+        return validate(data)
+    except exception:
+        return 'invalid'
+
+
+@pytest.mark.parametrize('data', [
+    {'name': "Ned Stark", 'email': "hand@headless.north"},
+    {'id': 1, 'name': " Ned Stark ", 'email': "hand@headless.north\n",
+     'services': {'github': {'id': ' 1000 '}, 'facebook': {'id': '75'}}},
+    {'id': True, 'name': "Ned", 'email': "ned@north", 'services': {}},
+    {'id': '1', 'name': "Ned", 'email': "ned@north"},
+    {'id': None, 'name': "Ned", 'email': "ned@north"},
+    {'name': "Ned"},
+    {'email': "ned@north"},
+    {'name': "   ", 'email': "ned@north"},
+    {'name': "Ned", 'email': ""},
+    {'name': 1, 'email': "ned@north"},
+    {'name': None, 'email': "ned@north"},
+    {'name': "Ned", 'email': "ned@north", 'phone': "555"},
+    {'name': "Ned", 'email': "ned@north", 'services': None},
+    {'name': "Ned", 'email': "ned@north", 'services': []},
+    {'name': "Ned", 'email': "ned@north", 'services': {'gitlab': {'id': '1'}}},
+    {'name': "Ned", 'email': "ned@north", 'services': {'github': {}}},
+    {'name': "Ned", 'email': "ned@north", 'services': {'github': '1'}},
+    {'name': "Ned", 'email': "ned@north",
+     'services': {'github': {'id': 1}}},
+    {'name': "Ned", 'email': "ned@north",
+     'services': {'github': {'id': ' '}}},
+    {'name': "Ned", 'email': "ned@north",
+     'services': {'github': {'id': '1', 'login': 'ned'}}},
+    {'name': "Ned", 'email': "ned@north",
+     'services': {'github': {'id': '1', 'access_token': 'gho_1'}}},
+    {'name': "Ned", 'email': "ned@north",
+     'services': {'github': {'id': '1', 'access_token': ''}}},
+    {'name': "Ned", 'email': "ned@north",
+     'services': {'github': {'access_token': 'gho_1'}}},
+    [],
+    "Ned Stark",
+    None,
+])
+def test_user(data):
+    assert outcome(validation.user, validation.Invalid, data) == \
+        outcome(user_schema, MultipleInvalid, data)
+
+
+@pytest.mark.parametrize('data', [
+    {},
+    {'name': "Stark", 'email': "ned@north", 'first': "10"},
+    {'page_size': "10", 'after_id': " 5", 'before_id': "7 "},
+    {'page_size': "0"},
+    {'page_size': "-1"},
+    {'after_id': "ten"},
+    {'before_id': ""},
+    {'q': " rob stark "},
+    {'q': "  "},
+    {'q': ""},
+    {'sort': "name"},
+])
+def test_user_list_params(data):
+    assert outcome(validation.user_list_params, validation.Invalid, data) == \
+        outcome(params_schema, MultipleInvalid, data)
+
+
+@pytest.mark.parametrize('data', [
+    {'q': "rob st"},
+    {'q': " rob ", 'limit': "5"},
+    {'q': "rob", 'limit': "100"},
+    {'q': "rob", 'limit': "101"},
+    {'q': "rob", 'limit': "0"},
+    {'q': "rob", 'limit': "five"},
+    {'q': ""},
+    {'limit': "5"},
+    {'q': "rob", 'page': "2"},
+])
+def test_prefix_params(data):
+    assert outcome(validation.prefix_params, validation.Invalid, data) == \
+        outcome(prefix_schema, MultipleInvalid, data)
+
+
+def test_invalid_path():
+    with pytest.raises(validation.Invalid) as info:
+        validation.user({'name': "Ned", 'email': "ned@north",
+                         'services': {'github': {'id': ' '}}})
+
+    assert info.value.path == ['services', 'github', 'id']
+    assert str(info.value) == \
+        "length of value must be at least 1 @ data['services']['github']['id']"